@@ -0,0 +1,182 @@
+import os
+import json
+import glob
+import shutil
+import hashlib
+import uuid
+from datetime import datetime
+from experiment_util import RESOURCE_FOLDER
+"""
+表示学习产物（concept embedding、患者表示）的内容寻址注册表
+每个产物由 (kind, 各输入的hash, 超参数) 确定一个key，保存在 <registry>/<kind>/<key>/ 下:
+    manifest.json: kind, key, 输入的hash, 超参数, 产物文件及其hash, 创建时间
+    产物文件本身
+输入可以是单个文件或目录（目录按其中全部.npy文件计算hash），例如预处理数据目录与KG文件
+文件hash按(路径, 大小, mtime)缓存，未改动的文件不会重复读取
+生产者先lookup，命中则直接复用；未命中时写入stage目录再commit
+消费者按当前的输入find最新的有效产物，输入或产物文件发生变化时不会命中
+"""
+
+DEFAULT_FOLDER = os.path.join(RESOURCE_FOLDER, 'registry')
+CONCEPT_EMBEDDING = 'concept_embedding'
+PATIENT_REPRESENTATION = 'patient_representation'
+_HASH_BLOCK = 1 << 20
+
+
+class Artifact(object):
+    def __init__(self, folder, manifest):
+        self.folder = folder
+        self.manifest = manifest
+        self.key = manifest['key']
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def export(self, target_folder, registry):
+        """将产物文件复制到target_folder（兼容按固定路径读取的旧代码），内容相同的文件跳过"""
+        if not os.path.exists(target_folder):
+            os.makedirs(target_folder)
+        for name, digest in self.manifest['files'].items():
+            target = os.path.join(target_folder, name)
+            if os.path.exists(target) and registry.file_hash(target) == digest:
+                continue
+            shutil.copyfile(self.path(name), target)
+
+
+class ArtifactRegistry(object):
+    def __init__(self, folder=None):
+        self.folder = DEFAULT_FOLDER if folder is None else folder
+        self._hash_cache_path = os.path.join(self.folder, 'hash_cache.json')
+        self._hash_cache = None
+        self._hash_dirty = False
+
+    def _load_hash_cache(self):
+        if self._hash_cache is None:
+            self._hash_cache = dict()
+            if os.path.exists(self._hash_cache_path):
+                with open(self._hash_cache_path, 'r', encoding='utf-8') as f:
+                    self._hash_cache = json.load(f)
+        return self._hash_cache
+
+    def _save_hash_cache(self):
+        if not self._hash_dirty:
+            return
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        # 先写临时文件再替换，并行的worker不会读到写了一半的缓存
+        tmp_path = '{}.{}'.format(self._hash_cache_path, uuid.uuid4().hex)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._hash_cache, f)
+        os.replace(tmp_path, self._hash_cache_path)
+        self._hash_dirty = False
+
+    def _file_hash(self, path):
+        """只更新内存中的缓存，由调用方在一次操作结束后统一写回"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        cache = self._load_hash_cache()
+        item = cache.get(path)
+        if item is not None and item[0] == stat.st_size and item[1] == stat.st_mtime_ns:
+            return item[2]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(_HASH_BLOCK), b''):
+                sha.update(block)
+        cache[path] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        self._hash_dirty = True
+        return cache[path][2]
+
+    def _input_hash(self, path):
+        if not os.path.isdir(path):
+            return self._file_hash(path)
+        sha = hashlib.sha256()
+        for file in sorted(glob.glob(os.path.join(path, '*.npy'))):
+            sha.update('{}:{};'.format(os.path.basename(file), self._file_hash(file)).encode('utf-8'))
+        return sha.hexdigest()
+
+    def file_hash(self, path):
+        digest = self._file_hash(path)
+        self._save_hash_cache()
+        return digest
+
+    def input_hash(self, path):
+        """文件直接计算hash；目录按其中全部.npy文件的(文件名, hash)计算"""
+        digest = self._input_hash(path)
+        self._save_hash_cache()
+        return digest
+
+    def make_key(self, kind, inputs, params):
+        """:param inputs: {name: 文件或目录路径}; params: 可JSON序列化的超参数"""
+        spec = {'kind': kind, 'inputs': {name: self._input_hash(path) for name, path in inputs.items()},
+                'params': params}
+        key = hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:24]
+        self._save_hash_cache()
+        return key, spec
+
+    def _load(self, folder):
+        manifest_path = os.path.join(folder, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            artifact = Artifact(folder, json.load(f))
+        # 产物文件缺失或被改动时视为无效
+        for name, digest in artifact.manifest['files'].items():
+            if not os.path.exists(artifact.path(name)) or self._file_hash(artifact.path(name)) != digest:
+                return None
+        return artifact
+
+    def lookup(self, kind, inputs, params):
+        key, _ = self.make_key(kind, inputs, params)
+        artifact = self._load(os.path.join(self.folder, kind, key))
+        self._save_hash_cache()
+        return artifact
+
+    def find(self, kind, inputs, params=None):
+        """
+        按输入查找最新的有效产物，供不知道完整超参数的消费者使用
+        :param params: 只要求给出的超参数一致，None表示不限制
+        """
+        input_hash = {name: self._input_hash(path) for name, path in inputs.items()}
+        candidate = []
+        for manifest_path in glob.glob(os.path.join(self.folder, kind, '*', 'manifest.json')):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest['inputs'] != input_hash:
+                continue
+            if params is not None and any(manifest['params'].get(k) != v for k, v in params.items()):
+                continue
+            candidate.append((manifest['created'], os.path.dirname(manifest_path)))
+        artifact = None
+        for _, folder in sorted(candidate, reverse=True):
+            artifact = self._load(folder)
+            if artifact is not None:
+                break
+        self._save_hash_cache()
+        return artifact
+
+    def stage(self, kind):
+        """返回一个临时目录，生产者将产物文件写入其中后调用commit"""
+        folder = os.path.join(self.folder, kind, '.stage_{}'.format(uuid.uuid4().hex))
+        os.makedirs(folder)
+        return folder
+
+    def commit(self, stage_folder, kind, inputs, params):
+        key, spec = self.make_key(kind, inputs, params)
+        files = {name: self._file_hash(os.path.join(stage_folder, name)) for name in sorted(os.listdir(stage_folder))}
+        manifest = dict(spec, key=key, files=files, created=datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
+                        input_path={name: os.path.abspath(path) for name, path in inputs.items()})
+        with open(os.path.join(stage_folder, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        folder = os.path.join(self.folder, kind, key)
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+        os.rename(stage_folder, folder)
+        # 目录改名后文件的大小与mtime不变，hash缓存直接从stage路径移到新路径，不保留stage路径
+        cache = self._load_hash_cache()
+        for name in files:
+            item = cache.pop(os.path.abspath(os.path.join(stage_folder, name)), None)
+            if item is not None:
+                cache[os.path.abspath(os.path.join(folder, name))] = item
+        self._hash_dirty = True
+        self._save_hash_cache()
+        return Artifact(folder, manifest)
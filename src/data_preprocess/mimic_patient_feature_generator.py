@@ -539,10 +539,10 @@ def get_vital_sign(visit_dict, save_root, vital_sign_path, read_from_cache=True,
 
 def get_medicine(visit_dict, save_root, medicine_path, mapping_file, read_from_cache=True, file_name='medicine.csv',
                  off_set=48):
-     '''
+    '''
         从原始药物数据文件中提取患者的用药信息，并将其映射到特定的药物类别。
         它按照患者和就诊 ID 组织成嵌套字典结构，用于标记每个患者在每次就诊中使用的药物类别。
-     '''
+    '''
     if read_from_cache:
         medicine_dict = dict()
         with open(os.path.join(save_root, file_name), 'r', encoding='utf-8-sig', newline='') as file:
@@ -634,9 +634,9 @@ def get_medicine(visit_dict, save_root, medicine_path, mapping_file, read_from_c
 
 def get_lab_test(visit_dict, save_root, lab_test_path, code_name_path, read_from_cache=True, file_name='lab_test.csv',
                  min_count=10000):
-     '''
-     从实验室检查数据文件中提取患者的实验室检查结果，并将其按患者和就诊 ID 组织成嵌套字典结构。
-     '''
+    '''
+    从实验室检查数据文件中提取患者的实验室检查结果，并将其按患者和就诊 ID 组织成嵌套字典结构。
+    '''
     if read_from_cache:
         lab_test_dict = dict()
         with open(os.path.join(save_root, file_name), 'r', encoding='utf-8-sig', newline='') as file:
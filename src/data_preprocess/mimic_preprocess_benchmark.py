@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import multiprocessing
+import mimic_patient_feature_generator as generator
+"""
+mimic_patient_feature_generator中各extractor的吞吐评测，数据可以是真实的MIMIC-III，也可以是mimic_synthetic_data生成的合成数据
+每个extractor在独立的(spawn)子进程中运行，以获得各自的峰值RSS；除admission外，子进程先从缓存读入visit dict再计时
+报告: 输入行数、耗时、rows/s、峰值RSS，以及峰值RSS相对于计时开始时RSS的增量（即extractor自身的内存占用）
+reconstruct一项从各extractor的缓存读入结果，计时风险因素、疾病大类与宽表的生成，行数为入院数
+"""
+
+EXTRACTOR = ['admission', 'sex_age', 'medicine', 'procedure', 'lab_test', 'diagnosis', 'vital_sign', 'reconstruct']
+# extractor读取的原始表
+INPUT_TABLE = {'admission': 'ADMISSIONS', 'sex_age': 'PATIENTS', 'medicine': 'PRESCRIPTIONS',
+               'procedure': 'PROCEDURES_ICD', 'lab_test': 'LABEVENTS', 'diagnosis': 'DIAGNOSES_ICD',
+               'vital_sign': 'CHARTEVENTS', 'reconstruct': 'ADMISSIONS'}
+CARDIAC_OPERATION = {'PCI', 'CABG', '瓣膜手术', '除颤器', '心脏再同步化治疗', '起搏器'}
+
+
+def count_rows(path, block_size=1 << 24):
+    """不含表头的行数"""
+    count = 0
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            count += block.count(b'\n')
+    return count - 1
+
+
+def current_rss_mb():
+    with open('/proc/self/statm', 'r') as file:
+        return int(file.read().split()[1]) * resource.getpagesize() / 1024 ** 2
+
+
+def peak_rss_mb():
+    # Linux下ru_maxrss的单位为KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def path_dict(data_root, mapping_root):
+    table = dict((name, os.path.join(data_root, name + '.csv')) for name in set(INPUT_TABLE.values()))
+    table['D_LABITEMS'] = os.path.join(data_root, 'D_LABITEMS.csv')
+    table['DIAGNOSIS_MAP'] = os.path.join(mapping_root, 'DIAGNOSIS.csv')
+    table['MEDICINE_MAP'] = os.path.join(mapping_root, 'MEDICINE_NAME_MAP.csv')
+    table['OPERATION_MAP'] = os.path.join(mapping_root, 'OPERATION_MAP.csv')
+    return table
+
+
+def _run(name, path, save_root, lab_min_count):
+    """在子进程中运行一个extractor，返回(耗时, 开始时RSS, 峰值RSS)"""
+    visit_dict = None
+    if name != 'admission':
+        visit_dict = generator.get_admissions(path['ADMISSIONS'], save_root, read_from_cache=True)
+    if name == 'reconstruct':
+        # 各extractor的结果均从缓存读入，不计入耗时
+        age_sex = generator.get_sex_age(visit_dict, save_root, path['PATIENTS'])
+        medicine = generator.get_medicine(visit_dict, save_root, path['PRESCRIPTIONS'], path['MEDICINE_MAP'])
+        operation = generator.get_procedure(visit_dict, save_root, path['PROCEDURES_ICD'], path['OPERATION_MAP'])
+        lab_test = generator.get_lab_test(visit_dict, save_root, path['LABEVENTS'], path['D_LABITEMS'])
+        diagnosis = generator.get_diagnosis(visit_dict, save_root, path['DIAGNOSES_ICD'], path['DIAGNOSIS_MAP'])
+        vital_sign = generator.get_vital_sign(visit_dict, save_root, path['CHARTEVENTS'])
+
+    start_rss = current_rss_mb()
+    start = time.perf_counter()
+    if name == 'admission':
+        generator.get_admissions(path['ADMISSIONS'], save_root, read_from_cache=False)
+    elif name == 'sex_age':
+        generator.get_sex_age(visit_dict, save_root, path['PATIENTS'], read_from_cache=False)
+    elif name == 'medicine':
+        generator.get_medicine(visit_dict, save_root, path['PRESCRIPTIONS'], path['MEDICINE_MAP'],
+                               read_from_cache=False)
+    elif name == 'procedure':
+        generator.get_procedure(visit_dict, save_root, path['PROCEDURES_ICD'], path['OPERATION_MAP'],
+                                read_from_cache=False)
+    elif name == 'lab_test':
+        generator.get_lab_test(visit_dict, save_root, path['LABEVENTS'], path['D_LABITEMS'], read_from_cache=False,
+                               min_count=lab_min_count)
+    elif name == 'diagnosis':
+        generator.get_diagnosis(visit_dict, save_root, path['DIAGNOSES_ICD'], path['DIAGNOSIS_MAP'],
+                                read_from_cache=False)
+    elif name == 'vital_sign':
+        generator.get_vital_sign(visit_dict, save_root, path['CHARTEVENTS'], read_from_cache=False)
+    elif name == 'reconstruct':
+        risk_factor = generator.get_risk_factor(visit_dict, vital_sign, age_sex, operation, CARDIAC_OPERATION)
+        category = generator.disease_category_fuse(visit_dict, diagnosis)
+        generator.reconstruct(visit_dict, lab_test, operation, age_sex, vital_sign, medicine, diagnosis, risk_factor,
+                              category, os.path.join(save_root, 'mimic_unpreprocessed.csv'))
+    else:
+        raise ValueError('unknown extractor: {}'.format(name))
+    return time.perf_counter() - start, start_rss, peak_rss_mb()
+
+
+def run(extractor_list, data_root, mapping_root, save_root, lab_min_count):
+    path = path_dict(data_root, mapping_root)
+    # 后续的extractor依赖admission的缓存，reconstruct依赖全部extractor的缓存
+    order = [name for name in EXTRACTOR if name in extractor_list or name == 'admission' or
+             'reconstruct' in extractor_list]
+    context = multiprocessing.get_context('spawn')
+    result = list()
+    for name in order:
+        num_row = count_rows(path[INPUT_TABLE[name]])
+        with context.Pool(1) as pool:
+            elapsed, start_rss, peak_rss = pool.apply(_run, (name, path, save_root, lab_min_count))
+        if name not in extractor_list:
+            continue
+        result.append({'name': name, 'table': INPUT_TABLE[name], 'rows': num_row, 'seconds': elapsed,
+                       'rows_per_second': num_row / elapsed if elapsed > 0 else float('inf'),
+                       'start_rss_mb': start_rss, 'peak_rss_mb': peak_rss,
+                       'extractor_rss_mb': max(peak_rss - start_rss, 0)})
+        print('{:<12}{:<16}{:>12}{:>10.2f} s{:>14.0f} rows/s{:>10.1f} MB peak{:>10.1f} MB own'
+              .format(name, INPUT_TABLE[name], num_row, elapsed, result[-1]['rows_per_second'], peak_rss,
+                      result[-1]['extractor_rss_mb']))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', type=str, default=os.path.abspath('../../resource/raw_data/mimic_synthetic'))
+    parser.add_argument('--mapping_root', type=str, default=os.path.abspath('../../resource/mapping_file/mimic'))
+    parser.add_argument('--save_root', type=str, default=None,
+                        help='cache folder written by the extractors, default: a temporary folder.')
+    parser.add_argument('--extractor', type=str, nargs='*', default=EXTRACTOR)
+    parser.add_argument('--lab_min_count', type=int, default=0,
+                        help='get_lab_test keeps lab items with more records than this (10000 in the pipeline).')
+    parser.add_argument('--output', type=str, default=None, help='json file for the results.')
+    args = parser.parse_args()
+
+    for name in args.extractor:
+        if name not in EXTRACTOR:
+            raise ValueError('unknown extractor: {}, options: {}'.format(name, EXTRACTOR))
+    save_root = tempfile.mkdtemp() if args.save_root is None else args.save_root
+    if not os.path.exists(save_root):
+        os.makedirs(save_root)
+    try:
+        result = run(args.extractor, args.data_root, args.mapping_root, save_root, args.lab_min_count)
+    finally:
+        if args.save_root is None:
+            shutil.rmtree(save_root)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'data_root': args.data_root, 'lab_min_count': args.lab_min_count, 'results': result}, f,
+                      indent=1)
+        print('results saved to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
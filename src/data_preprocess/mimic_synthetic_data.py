@@ -0,0 +1,302 @@
+import csv
+import os
+import argparse
+import numpy as np
+from itertools import islice
+"""
+生成与MIMIC-III格式一致的合成数据，用于在没有真实数据的环境中测试与评测预处理流程的吞吐
+生成的表: ADMISSIONS, PATIENTS, LABEVENTS, CHARTEVENTS, PRESCRIPTIONS, DIAGNOSES_ICD, PROCEDURES_ICD, D_LABITEMS
+列顺序与MIMIC-III一致（mimic_patient_feature_generator按列号读取），时间格式为'%Y-%m-%d %H:%M:%S'
+诊断、手术编码与药物名称取自mapping_file中的映射表，检验项目取自LABTEST_LIST与feature_order中用到的检验，
+生命体征的item id与get_vital_sign中识别的一致；另按mapped_rate混入映射表之外的记录，模拟真实数据中大量无关的行
+患者按chunk生成并追加写入，内存占用与总规模无关
+"""
+
+# feature_order中用到、但LABTEST_LIST中没有的检验 (item id, label, fluid)
+FEATURE_LAB_ITEM = [
+    ('51301', 'White Blood Cells', 'Blood'), ('51498', 'Specific Gravity', 'Urine'),
+    ('51279', 'Red Blood Cells', 'Blood'), ('51277', 'RDW', 'Blood'), ('51275', 'PTT', 'Blood'),
+    ('51274', 'PT', 'Blood'), ('51265', 'Platelet Count', 'Blood'), ('50970', 'Phosphate', 'Blood'),
+    ('51491', 'pH', 'Urine'), ('51256', 'Neutrophils', 'Blood'), ('51254', 'Monocytes', 'Blood'),
+    ('51250', 'MCV', 'Blood'), ('51249', 'MCHC', 'Blood'), ('51248', 'MCH', 'Blood'), ('50960', 'Magnesium', 'Blood'),
+    ('51244', 'Lymphocytes', 'Blood'), ('51237', 'INR(PT)', 'Blood'), ('51221', 'Hematocrit', 'Blood'),
+    ('51200', 'Eosinophils', 'Blood'), ('50902', 'Chloride', 'Blood'), ('50882', 'Bicarbonate', 'Blood'),
+    ('51146', 'Basophils', 'Blood'), ('50868', 'Anion Gap', 'Blood')
+]
+# get_vital_sign识别的item id，[(item id列表, 单位列表, 取值范围, 单位换算)]
+VITAL_SIGN_ITEM = [
+    (['51', '455', '220179', '220050'], ['mmHg'], (90, 180), [1]),
+    (['8368', '8441', '220180', '220051'], ['mmHg'], (50, 110), [1]),
+    (['216', '1394', '226707', '226730', '920'], ['cm', 'Inch'], (150, 195), [1, 1 / 2.54]),
+    (['3580', '763', '224639', '226512', '762'], ['kg', 'lbs'], (45, 130), [1, 1 / 0.453592]),
+]
+# 与上述无关的常见生命体征（心率、呼吸、体温、血氧），真实CHARTEVENTS中的绝大多数行属于此类
+OTHER_CHART_ITEM = [('211', 'bpm', (50, 130)), ('220045', 'bpm', (50, 130)), ('618', 'BPM', (10, 30)),
+                    ('220210', 'insp/min', (10, 30)), ('678', 'Deg. F', (96, 102)), ('646', '%', (88, 100))]
+OTHER_DRUG = ['Sodium Chloride 0.9%  Flush', 'Potassium Chloride', 'Insulin', 'Heparin', 'Acetaminophen',
+              'Docusate Sodium', 'Senna', 'Magnesium Sulfate', 'Pantoprazole', 'Ondansetron', 'D5W', 'Lorazepam']
+ETHNICITY = ['WHITE', 'BLACK/AFRICAN AMERICAN', 'HISPANIC OR LATINO', 'ASIAN', 'UNKNOWN/NOT SPECIFIED', 'OTHER']
+
+ADMISSIONS_HEAD = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'ADMITTIME', 'DISCHTIME', 'DEATHTIME', 'ADMISSION_TYPE',
+                   'ADMISSION_LOCATION', 'DISCHARGE_LOCATION', 'INSURANCE', 'LANGUAGE', 'RELIGION', 'MARITAL_STATUS',
+                   'ETHNICITY', 'EDREGTIME', 'EDOUTTIME', 'DIAGNOSIS', 'HOSPITAL_EXPIRE_FLAG', 'HAS_CHARTEVENTS_DATA']
+PATIENTS_HEAD = ['ROW_ID', 'SUBJECT_ID', 'GENDER', 'DOB', 'DOD', 'DOD_HOSP', 'DOD_SSN', 'EXPIRE_FLAG']
+LABEVENTS_HEAD = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'ITEMID', 'CHARTTIME', 'VALUE', 'VALUENUM', 'VALUEUOM', 'FLAG']
+CHARTEVENTS_HEAD = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'ICUSTAY_ID', 'ITEMID', 'CHARTTIME', 'STORETIME', 'CGID',
+                    'VALUE', 'VALUENUM', 'VALUEUOM', 'WARNING', 'ERROR', 'RESULTSTATUS', 'STOPPED']
+PRESCRIPTIONS_HEAD = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'ICUSTAY_ID', 'STARTDATE', 'ENDDATE', 'DRUG_TYPE', 'DRUG',
+                      'DRUG_NAME_POE', 'DRUG_NAME_GENERIC', 'FORMULARY_DRUG_CD', 'GSN', 'NDC', 'PROD_STRENGTH',
+                      'DOSE_VAL_RX', 'DOSE_UNIT_RX', 'FORM_VAL_DISP', 'FORM_UNIT_DISP', 'ROUTE']
+DIAGNOSES_ICD_HEAD = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'SEQ_NUM', 'ICD9_CODE']
+PROCEDURES_ICD_HEAD = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'SEQ_NUM', 'ICD9_CODE']
+D_LABITEMS_HEAD = ['ROW_ID', 'ITEMID', 'LABEL', 'FLUID', 'CATEGORY', 'LOINC_CODE']
+TABLE_HEAD = {'ADMISSIONS': ADMISSIONS_HEAD, 'PATIENTS': PATIENTS_HEAD, 'LABEVENTS': LABEVENTS_HEAD,
+              'CHARTEVENTS': CHARTEVENTS_HEAD, 'PRESCRIPTIONS': PRESCRIPTIONS_HEAD,
+              'DIAGNOSES_ICD': DIAGNOSES_ICD_HEAD, 'PROCEDURES_ICD': PROCEDURES_ICD_HEAD}
+
+_DAY = 24 * 3600
+_YEAR = 365 * _DAY
+_START_TIME = np.datetime64('2100-01-01T00:00:00', 's')
+
+
+def read_mapping(mapping_root):
+    """:return: 诊断ICD编码前缀, 手术ICD编码, 药物名称, 检验项目[(item id, label, fluid)]"""
+    def read(name, skip_line=1):
+        with open(os.path.join(mapping_root, name), 'r', encoding='utf-8-sig', newline='') as file:
+            return [line for line in islice(csv.reader(file), skip_line, None)]
+    diagnosis = sorted(set(line[4] for line in read('DIAGNOSIS.csv')))
+    operation = sorted(set(line[1] for line in read('OPERATION_MAP.csv')))
+    # MEDICINE_NAME_MAP没有表头
+    medicine = sorted(set(line[2] for line in read('MEDICINE_NAME_MAP.csv', 0)))
+    lab_item = dict((item[0], item) for item in FEATURE_LAB_ITEM)
+    for line in read('LABTEST_LIST.csv'):
+        if line[2] not in lab_item:
+            # 514xx为尿检项目
+            lab_item[line[2]] = (line[2], line[0], 'Urine' if line[2].startswith('514') else 'Blood')
+    return diagnosis, operation, medicine, sorted(lab_item.values())
+
+
+def format_time(second):
+    """:param second: 相对于_START_TIME的秒数数组"""
+    time = _START_TIME + np.asarray(second, dtype=np.int64).astype('timedelta64[s]')
+    return np.char.replace(np.datetime_as_string(time, unit='s'), 'T', ' ')
+
+
+def _choice(rng, candidate, size):
+    return np.asarray(candidate, dtype=object)[rng.randint(len(candidate), size=size)]
+
+
+def _mix(rng, mapped, noise, mapped_rate):
+    """按mapped_rate用映射表中的取值替换noise"""
+    mask = rng.rand(len(noise)) < mapped_rate
+    noise[mask] = mapped[mask]
+    return noise
+
+
+class SyntheticMIMIC(object):
+    def __init__(self, mapping_root, visit_per_patient=2.0, lab_per_visit=100, chart_per_visit=300,
+                 prescription_per_visit=40, diagnosis_per_visit=10, procedure_per_visit=3, mapped_rate=0.3, seed=0):
+        self.diagnosis, self.operation, self.medicine, self.lab_item = read_mapping(mapping_root)
+        self.visit_per_patient = visit_per_patient
+        self.lab_per_visit = lab_per_visit
+        self.chart_per_visit = chart_per_visit
+        self.prescription_per_visit = prescription_per_visit
+        self.diagnosis_per_visit = diagnosis_per_visit
+        self.procedure_per_visit = procedure_per_visit
+        self.mapped_rate = mapped_rate
+        self.rng = np.random.RandomState(seed)
+        # 每个检验项目的典型取值
+        self.lab_scale = np.exp(self.rng.uniform(-1, 6, len(self.lab_item)))
+        self.row_id = dict((name, 0) for name in TABLE_HEAD)
+        self.num_patient = 0
+        self.num_visit = 0
+
+    def _row_id(self, table, num):
+        start = self.row_id[table]
+        self.row_id[table] += num
+        return np.arange(start + 1, start + num + 1)
+
+    def _events(self, visit, mean):
+        """每次入院按泊松分布生成若干事件，返回事件所属的入院下标与入院期间的随机时刻"""
+        index = np.repeat(np.arange(len(visit['hadm_id'])), self.rng.poisson(mean, len(visit['hadm_id'])))
+        time = visit['admit'][index] + (self.rng.rand(len(index)) * visit['stay'][index]).astype(np.int64)
+        return index, time
+
+    def chunk(self, num_patient):
+        """生成num_patient个患者，返回{表名: 行的列表}"""
+        rng = self.rng
+        subject_id = np.arange(self.num_patient + 1, self.num_patient + num_patient + 1)
+        self.num_patient += num_patient
+        # 至少一次入院；入院次数少于2的患者在reconstruct中会被丢弃
+        num_visit = 1 + rng.poisson(max(self.visit_per_patient - 1, 0), num_patient)
+        visit_subject = np.repeat(subject_id, num_visit)
+        admit = rng.randint(0, 100 * _YEAR, len(visit_subject)).astype(np.int64)
+        order = np.lexsort((admit, visit_subject))
+        visit = {'subject_id': visit_subject, 'admit': admit[order],
+                 'hadm_id': np.arange(self.num_visit, self.num_visit + len(visit_subject)) + 100001,
+                 'stay': rng.randint(_DAY, 15 * _DAY, len(visit_subject)).astype(np.int64)}
+        self.num_visit += len(visit_subject)
+        return {'ADMISSIONS': self._admissions(visit), 'PATIENTS': self._patients(subject_id, num_visit, visit),
+                'LABEVENTS': self._labevents(visit), 'CHARTEVENTS': self._chartevents(visit),
+                'PRESCRIPTIONS': self._prescriptions(visit), 'DIAGNOSES_ICD': self._diagnoses(visit),
+                'PROCEDURES_ICD': self._procedures(visit)}
+
+    def _admissions(self, visit):
+        num = len(visit['hadm_id'])
+        death = np.where(self.rng.rand(num) < 0.1, format_time(visit['admit'] + visit['stay']), '')
+        ethnicity = _choice(self.rng, ETHNICITY, num)
+        return [[row_id, subject_id, hadm_id, admit, discharge, death_time, 'EMERGENCY', 'EMERGENCY ROOM ADMIT',
+                 'HOME', 'Medicare', 'ENGL', 'CATHOLIC', 'MARRIED', ethnicity_, '', '', 'SYNTHETIC',
+                 int(len(death_time) > 0), 1]
+                for row_id, subject_id, hadm_id, admit, discharge, death_time, ethnicity_ in
+                zip(self._row_id('ADMISSIONS', num), visit['subject_id'], visit['hadm_id'],
+                    format_time(visit['admit']), format_time(visit['admit'] + visit['stay']), death, ethnicity)]
+
+    def _patients(self, subject_id, num_visit, visit):
+        num = len(subject_id)
+        first_admit = visit['admit'][np.cumsum(num_visit) - num_visit]
+        # 首次入院时18-90岁
+        dob = first_admit - self.rng.randint(18 * _YEAR, 90 * _YEAR, num)
+        gender = _choice(self.rng, ['F', 'M'], num)
+        return [[row_id, subject_id_, gender_, dob_, '', '', '', 0] for row_id, subject_id_, gender_, dob_ in
+                zip(self._row_id('PATIENTS', num), subject_id, gender, format_time(dob))]
+
+    def _labevents(self, visit):
+        index, time = self._events(visit, self.lab_per_visit)
+        item = self.rng.randint(len(self.lab_item), size=len(index))
+        value = self.lab_scale[item] * self.rng.lognormal(0, 0.3, len(index))
+        value_str = np.char.mod('%.2f', value).astype(object)
+        # 少量带千位分隔符或无法解析的取值，与真实数据一致
+        large = value > 1000
+        value_str[large] = np.char.mod('%.0f', value[large])
+        value_str[large] = [item_[:-3] + ',' + item_[-3:] for item_ in value_str[large]]
+        value_str[self.rng.rand(len(index)) < 0.01] = 'UNABLE TO REPORT'
+        item_id = np.array([lab[0] for lab in self.lab_item], dtype=object)[item]
+        # 门诊检验没有HADM_ID
+        hadm_id = np.where(self.rng.rand(len(index)) < 0.05, '', visit['hadm_id'][index].astype(str))
+        return [[row_id, subject_id, hadm_id_, item_id_, chart_time, value_, value_, '', '']
+                for row_id, subject_id, hadm_id_, item_id_, chart_time, value_ in
+                zip(self._row_id('LABEVENTS', len(index)), visit['subject_id'][index], hadm_id, item_id,
+                    format_time(time), value_str)]
+
+    def _chartevents(self, visit):
+        rng = self.rng
+        index, time = self._events(visit, self.chart_per_visit)
+        num = len(index)
+        item_id, unit = np.empty(num, dtype=object), np.empty(num, dtype=object)
+        value = np.empty(num)
+        # 其余体征
+        other = rng.randint(len(OTHER_CHART_ITEM), size=num)
+        for i, (item_id_, unit_, (low, high)) in enumerate(OTHER_CHART_ITEM):
+            mask = other == i
+            item_id[mask], unit[mask], value[mask] = item_id_, unit_, rng.uniform(low, high, mask.sum())
+        # 按mapped_rate替换为血压、身高、体重
+        group = np.where(rng.rand(num) < self.mapped_rate, rng.randint(len(VITAL_SIGN_ITEM), size=num), -1)
+        for i, (item_list, unit_list, (low, high), factor) in enumerate(VITAL_SIGN_ITEM):
+            mask = group == i
+            unit_index = rng.randint(len(unit_list), size=mask.sum())
+            item_id[mask] = _choice(rng, item_list, mask.sum())
+            unit[mask] = np.array(unit_list, dtype=object)[unit_index]
+            value[mask] = rng.uniform(low, high, mask.sum()) * np.array(factor)[unit_index]
+        value_str = np.char.mod('%.1f', value)
+        return [[row_id, subject_id, hadm_id, '', item_id_, chart_time, chart_time, '', value_, value_, unit_,
+                 0, 0, '', '']
+                for row_id, subject_id, hadm_id, item_id_, chart_time, value_, unit_ in
+                zip(self._row_id('CHARTEVENTS', num), visit['subject_id'][index], visit['hadm_id'][index], item_id,
+                    format_time(time), value_str, unit)]
+
+    def _prescriptions(self, visit):
+        index, start = self._events(visit, self.prescription_per_visit)
+        num = len(index)
+        # 结束时间不晚于出院
+        end = start + (self.rng.rand(num) * (visit['admit'][index] + visit['stay'][index] - start)).astype(np.int64)
+        drug = _mix(self.rng, _choice(self.rng, [item.capitalize() for item in self.medicine], num),
+                    _choice(self.rng, OTHER_DRUG, num), self.mapped_rate)
+        return [[row_id, subject_id, hadm_id, '', start_time, end_time, 'MAIN', drug_, drug_, drug_, '', '', '', '',
+                 '1', 'mg', '1', 'TAB', 'PO']
+                for row_id, subject_id, hadm_id, start_time, end_time, drug_ in
+                zip(self._row_id('PRESCRIPTIONS', num), visit['subject_id'][index], visit['hadm_id'][index],
+                    format_time(start), format_time(end), drug)]
+
+    def _icd(self, visit, table, mean, mapped, num_digit):
+        index = np.repeat(np.arange(len(visit['hadm_id'])), 1 + self.rng.poisson(mean - 1, len(visit['hadm_id'])))
+        num = len(index)
+        noise = np.char.zfill(self.rng.randint(10 ** num_digit, size=num).astype(str), num_digit).astype(object)
+        code = _mix(self.rng, mapped(num), noise, self.mapped_rate)
+        # 同一次入院内的序号
+        first = np.searchsorted(index, index)
+        return [[row_id, subject_id, hadm_id, seq_num, code_] for row_id, subject_id, hadm_id, seq_num, code_ in
+                zip(self._row_id(table, num), visit['subject_id'][index], visit['hadm_id'][index],
+                    np.arange(num) - first + 1, code)]
+
+    def _diagnoses(self, visit):
+        # 映射表中的编码为前缀，随机补足到4-5位
+        def mapped(num):
+            prefix = _choice(self.rng, self.diagnosis, num)
+            suffix = np.char.zfill(self.rng.randint(100, size=num).astype(str), 2).astype(object)
+            return np.array([(p + s)[:max(len(p), 5)] for p, s in zip(prefix, suffix)], dtype=object)
+        return self._icd(visit, 'DIAGNOSES_ICD', self.diagnosis_per_visit, mapped, 5)
+
+    def _procedures(self, visit):
+        return self._icd(visit, 'PROCEDURES_ICD', self.procedure_per_visit,
+                         lambda num: _choice(self.rng, self.operation, num), 4)
+
+    def d_labitems(self):
+        return [[i + 1, item_id, label, fluid, 'Chemistry' if fluid == 'Blood' else 'Hematology', '']
+                for i, (item_id, label, fluid) in enumerate(self.lab_item)]
+
+
+def generate(save_root, mapping_root, num_patient, chunk_size=5000, **kwargs):
+    """:return: {表名: 行数}"""
+    if not os.path.exists(save_root):
+        os.makedirs(save_root)
+    generator = SyntheticMIMIC(mapping_root, **kwargs)
+    file_dict, writer_dict = dict(), dict()
+    try:
+        for table, head in TABLE_HEAD.items():
+            file_dict[table] = open(os.path.join(save_root, table + '.csv'), 'w', encoding='utf-8-sig', newline='')
+            writer_dict[table] = csv.writer(file_dict[table])
+            writer_dict[table].writerow(head)
+        for start in range(0, num_patient, chunk_size):
+            for table, rows in generator.chunk(min(chunk_size, num_patient - start)).items():
+                writer_dict[table].writerows(rows)
+            print('{} / {} patients generated'.format(min(start + chunk_size, num_patient), num_patient))
+    finally:
+        for file in file_dict.values():
+            file.close()
+    with open(os.path.join(save_root, 'D_LABITEMS.csv'), 'w', encoding='utf-8-sig', newline='') as file:
+        csv.writer(file).writerows([D_LABITEMS_HEAD] + generator.d_labitems())
+    row_count = dict(generator.row_id)
+    row_count['D_LABITEMS'] = len(generator.lab_item)
+    return row_count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--save_root', type=str, default=os.path.abspath('../../resource/raw_data/mimic_synthetic'))
+    parser.add_argument('--mapping_root', type=str, default=os.path.abspath('../../resource/mapping_file/mimic'))
+    parser.add_argument('--num_patient', type=int, default=1000)
+    parser.add_argument('--visit_per_patient', type=float, default=2.0, help='mean admissions per patient.')
+    parser.add_argument('--lab_per_visit', type=float, default=100)
+    parser.add_argument('--chart_per_visit', type=float, default=300)
+    parser.add_argument('--prescription_per_visit', type=float, default=40)
+    parser.add_argument('--diagnosis_per_visit', type=float, default=10)
+    parser.add_argument('--procedure_per_visit', type=float, default=3)
+    parser.add_argument('--mapped_rate', type=float, default=0.3,
+                        help='fraction of rows that hit the mapping files, the others are unrelated codes / items.')
+    parser.add_argument('--chunk_size', type=int, default=5000, help='patients generated per chunk.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    row_count = generate(args.save_root, args.mapping_root, args.num_patient, args.chunk_size,
+                         visit_per_patient=args.visit_per_patient, lab_per_visit=args.lab_per_visit,
+                         chart_per_visit=args.chart_per_visit, prescription_per_visit=args.prescription_per_visit,
+                         diagnosis_per_visit=args.diagnosis_per_visit, procedure_per_visit=args.procedure_per_visit,
+                         mapped_rate=args.mapped_rate, seed=args.seed)
+    for table in sorted(row_count):
+        print('{:<16}{:>12} rows'.format(table, row_count[table]))
+    print('saved to {}'.format(args.save_root))
+
+
+if __name__ == '__main__':
+    main()
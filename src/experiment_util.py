@@ -1,13 +1,14 @@
 import numpy as np
 import os
-from sklearn.metrics import roc_auc_score, f1_score, average_precision_score, coverage_error, label_ranking_loss, \
-    hamming_loss
 import sys
 import csv
 import logging
 import logging.handlers
 from itertools import islice
 import random
+import multiprocessing
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 """20200715复核"""
 
 RELATION = 'relation'
@@ -46,11 +47,22 @@ relation_embed = {
     SELF_LOOP: np.array([0, 0, 0, 0]),
 }
 
-reward_dict = {}
-with open(os.path.abspath('../../resource/reward_set.csv'), 'r', encoding='utf-8-sig') as file:
-    csv_reader = csv.reader(file)
-    for idx, line in enumerate(islice(csv_reader, 1, None)):
-        reward_dict[idx] = {'reverse': float(line[2]), '0.5': float(line[3]), '0.75': float(line[4])}
+# 以本文件为基准定位resource目录，与工作目录无关
+RESOURCE_FOLDER = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'resource'))
+_reward_cache = dict()
+
+
+def get_reward_dict(path=None):
+    """reward_set.csv在第一次调用时读取并缓存，import本模块不读取任何文件"""
+    path = os.path.join(RESOURCE_FOLDER, 'reward_set.csv') if path is None else path
+    if path not in _reward_cache:
+        reward_dict = {}
+        with open(path, 'r', encoding='utf-8-sig') as file:
+            csv_reader = csv.reader(file)
+            for idx, line in enumerate(islice(csv_reader, 1, None)):
+                reward_dict[idx] = {'reverse': float(line[2]), '0.5': float(line[3]), '0.75': float(line[4])}
+        _reward_cache[path] = reward_dict
+    return _reward_cache[path]
 
 
 def get_logger(logname):
@@ -166,47 +178,256 @@ class FiveFoldValidationDataPrepare(object):
         return train_f, train_l, test_f, test_l
 
 
+TOP_K_LIST = [1, 3, 5, 10, 20, 30, 40, 50]
+
+
 def metric(pred_prob, label, inclusion_index_set, threshold=0.5):
     # label, pred_prob structure: [n_classes, n_samples]
-    included_pred_prob = list()
-    included_label = list()
-    for index in inclusion_index_set:
-        included_pred_prob.append(pred_prob[index])
-        included_label.append(label[index])
-    prob = np.array(included_pred_prob).transpose()
-    pred = np.array(included_pred_prob).transpose() > threshold
-    true = np.array(included_label).transpose()
-
-    micro_auc = roc_auc_score(true, prob, average='micro')
-    macro_auc = roc_auc_score(true, prob, average='macro')
-    micro_f1 = f1_score(true, pred, average='micro')
-    macro_f1 = f1_score(true, pred, average='macro')
-    micro_avg_precision = average_precision_score(true, prob, average='micro')
-    macro_avg_precision = average_precision_score(true, prob, average='macro')
-    coverage = coverage_error(true, prob)
-    ranking_loss = label_ranking_loss(true, prob)
-    hamming = hamming_loss(true, pred)
-    fuse = np.concatenate([prob[:, :, np.newaxis], true[:, :, np.newaxis]], axis=2).transpose([1, 0, 2])
-    top_1_num = top_k_num(fuse, 1)
-    top_3_num = top_k_num(fuse, 3)
-    top_5_num = top_k_num(fuse, 5)
-    top_10_num = top_k_num(fuse, 10)
-    top_20_num = top_k_num(fuse, 20)
-    top_30_num = top_k_num(fuse, 30)
-    top_40_num = top_k_num(fuse, 40)
-    top_50_num = top_k_num(fuse, 50)
-
-    return macro_auc, micro_auc, micro_f1, macro_f1, micro_avg_precision, macro_avg_precision, coverage, ranking_loss, \
-        hamming, top_1_num, top_3_num, top_5_num, top_10_num, top_20_num, top_30_num, top_40_num, top_50_num
+    return group_metric(pred_prob, label, {'group': inclusion_index_set}, threshold)['group']
+
+
+def group_metric(pred_prob, label, group_dict, threshold=0.5):
+    """
+    一次性计算所有标签组的指标，结果与sklearn的实现一致（并列分数按相同的方式处理）
+    :param group_dict: {key: inclusion_index_set}
+    :return: {key: (macro_auc, micro_auc, micro_f1, macro_f1, micro_avg_precision, macro_avg_precision, coverage,
+        ranking_loss, hamming, top_1_num, ..., top_50_num)}
+    """
+    result = GroupMetric(pred_prob, label, group_dict, threshold)()
+    for key in result:
+        if np.isnan(result[key][0, 0]):
+            raise ValueError('Only one class present in y_true. ROC AUC score is not defined in that case.')
+        result[key] = tuple(result[key][0].tolist())
+    return result
+
+
+class GroupMetric(object):
+    """
+    预先完成所有排序，之后可以按任意样本权重重复计算指标
+    每个标签在样本维度上的排序只做一次，由所有组共享，用于macro AUC与macro AP；每组的micro排序也只做一次
+    每组在标签维度上的排序只做一次，得到逐样本的coverage, ranking loss与top k命中数
+    bootstrap重采样等价于以各样本被抽中的次数作为权重，因此重采样时无需重新排序
+    """
+    def __init__(self, pred_prob, label, group_dict, threshold=0.5):
+        pred_prob, label = np.asarray(pred_prob, dtype=np.float64), np.asarray(label)
+        union = sorted(set(int(index) for key in group_dict for index in group_dict[key]))
+        position = {index: i for i, index in enumerate(union)}
+        # [n_samples, n_union]
+        prob = pred_prob[union].transpose()
+        true = label[union].transpose() > 0
+        pred = prob > threshold
+        self.num_sample = len(prob)
+        self.group_column = {key: [position[int(index)] for index in group_dict[key]] for key in group_dict}
+
+        self.class_ranking = _column_ranking(prob, true, np.arange(self.num_sample))
+        self.tp, self.fp, self.fn = (pred & true).astype(float), (pred & ~true).astype(float), (~pred & true).astype(float)
+        self.micro_ranking = dict()
+        # 逐样本的统计量 [n_samples, 3 + len(TOP_K_LIST)]: hamming, coverage, ranking loss, top k命中数
+        self.sample_stat = dict()
+        for key, column in self.group_column.items():
+            g_prob, g_true, g_pred = prob[:, column], true[:, column], pred[:, column]
+            self.micro_ranking[key] = _column_ranking(g_prob.reshape(-1, 1), g_true.reshape(-1, 1),
+                                                      np.repeat(np.arange(self.num_sample), len(column)))
+            # coverage: 覆盖全部真实标签所需的最少预测数，即分数不低于最小真实标签分数的标签个数
+            min_true = np.min(np.where(g_true, g_prob, np.inf), axis=1, keepdims=True)
+            coverage = np.sum(g_prob >= min_true, axis=1)
+            ranking_loss, top_k = _sample_ranking(g_prob, g_true)
+            self.sample_stat[key] = np.column_stack([np.mean(g_pred != g_true, axis=1), coverage, ranking_loss, top_k])
+
+    def __call__(self, weight=None):
+        """
+        :param weight: [n_resample, n_samples]，各样本的权重（被抽中的次数），None表示原样本
+        :return: {key: [n_resample, 17]}，列顺序与metric的返回值相同；某次重采样中只有一类样本的标签，其AUC为nan
+        """
+        weight = np.ones([1, self.num_sample]) if weight is None else np.asarray(weight, dtype=np.float64)
+        class_auc, class_ap = _weighted_curve(self.class_ranking, weight)
+        tp, fp, fn = weight @ self.tp, weight @ self.fp, weight @ self.fn
+        total = np.sum(weight, axis=1, keepdims=True)
+
+        result = dict()
+        for key, column in self.group_column.items():
+            micro_auc, micro_ap = _weighted_curve(self.micro_ranking[key], weight)
+            g_tp, g_fp, g_fn = tp[:, column], fp[:, column], fn[:, column]
+            f1 = 2 * g_tp / np.maximum(2 * g_tp + g_fp + g_fn, 1e-12)
+            micro_tp = np.sum(g_tp, axis=1)
+            micro_f1 = 2 * micro_tp / np.maximum(2 * micro_tp + np.sum(g_fp + g_fn, axis=1), 1e-12)
+            hamming, coverage, ranking_loss, top_k = np.split(weight @ self.sample_stat[key] / total, [1, 2, 3], axis=1)
+            result[key] = np.column_stack([np.mean(class_auc[:, column], axis=1), micro_auc[:, 0], micro_f1,
+                                           np.mean(f1, axis=1), micro_ap[:, 0], np.mean(class_ap[:, column], axis=1),
+                                           coverage, ranking_loss, hamming, top_k])
+        return result
+
+
+def _tie_block(sorted_score):
+    """sorted_score沿axis 0有序，返回每个位置所在的并列分数块的起止下标（闭区间）"""
+    n = len(sorted_score)
+    idx = np.broadcast_to(np.arange(n).reshape([-1] + [1] * (sorted_score.ndim - 1)), sorted_score.shape)
+    is_start = np.ones(sorted_score.shape, dtype=bool)
+    is_start[1:] = sorted_score[1:] != sorted_score[:-1]
+    is_end = np.ones(sorted_score.shape, dtype=bool)
+    is_end[:-1] = is_start[1:]
+    start = np.maximum.accumulate(np.where(is_start, idx, 0), axis=0)
+    end = np.minimum.accumulate(np.where(is_end, idx, n - 1)[::-1], axis=0)[::-1]
+    return start, end
+
+
+def _column_ranking(score, true, sample_index):
+    """
+    沿axis 0对每一列降序排序，分数相同的相邻元素构成一个块（阈值）
+    AUC与AP只需要在含有正例的块上求和，这些块的位置与样本权重无关，在此预先确定
+    :param sample_index: [n_rows]，每一行所属的样本
+    :return: sample: [n_columns, n_rows] 排序后每个位置所属的样本;
+        pos_elem: 正例元素按(列, 排序位置)展开后的下标; pos_group: 将pos_elem按块分组的起点，没有并列分数时为None;
+        block_begin, block_end: 各正例块在带前导0的逐列累加 [n_columns, n_rows + 1] 中的起止下标;
+        pos_bound: 各列的正例块的起止
+    """
+    n_row, n_col = score.shape
+    order = np.argsort(-score, axis=0, kind='stable')
+    score = np.take_along_axis(score, order, axis=0).transpose()
+    positive = np.take_along_axis(true, order, axis=0).transpose()
+    sample = sample_index[order].transpose()
+    is_start = np.ones(score.shape, dtype=bool)
+    is_start[:, 1:] = score[:, 1:] != score[:, :-1]
+    is_end = np.ones(score.shape, dtype=bool)
+    is_end[:, :-1] = is_start[:, 1:]
+    position = np.arange(n_row)
+    block_begin = np.maximum.accumulate(np.where(is_start, position, 0), axis=1)
+    block_end = np.minimum.accumulate(np.where(is_end, position, n_row - 1)[:, ::-1], axis=1)[:, ::-1]
+
+    column, row = np.nonzero(positive)
+    pos_elem = column * n_row + row
+    # 同一块内的多个正例合并为一组
+    new_block = np.ones(len(pos_elem), dtype=bool)
+    new_block[1:] = (column[1:] != column[:-1]) | (block_begin[column[1:], row[1:]] != block_begin[column[:-1], row[:-1]])
+    pos_group = None if np.all(new_block) else np.nonzero(new_block)[0]
+    column, row = column[new_block], row[new_block]
+    pos_bound = np.searchsorted(column, np.arange(n_col + 1))
+    return (sample, pos_elem, pos_group, column * (n_row + 1) + block_begin[column, row],
+            column * (n_row + 1) + block_end[column, row] + 1, pos_bound)
+
+
+def _column_cumsum(value, bound):
+    """value: [n_resample, n]，按bound划分的各段沿axis 1分段累加，返回(分段累加, 各段之和)"""
+    cum = np.zeros([len(value), value.shape[1] + 1])
+    np.cumsum(value, axis=1, out=cum[:, 1:])
+    base = cum[:, bound[:-1]]
+    return cum[:, 1:] - np.repeat(base, np.diff(bound), axis=1), cum[:, bound[1:]] - base
+
+
+def _weighted_curve(ranking, weight):
+    """
+    由排序结果计算加权的ROC AUC与average precision，[n_resample, n_columns]
+    AUC = 1 - 排在正例之前(并列计0.5)的负例权重 / (正例总权重 * 负例总权重)，等价于ROC曲线的梯形面积
+    AP为各阈值（块末尾）处precision按正例权重的平均
+    全部元素上只需一次权重累加，其余计算都只在正例块上进行
+    没有正例或负例的列AUC为nan，没有正例的列AP为0
+    """
+    sample, pos_elem, pos_group, block_begin, block_end, pos_bound = ranking
+    n_col, n_row = sample.shape
+    w_cum = np.zeros([len(weight), n_col, n_row + 1])
+    np.cumsum(weight[:, sample], axis=2, out=w_cum[:, :, 1:])
+    w_total = w_cum[:, :, -1]
+    w_cum = w_cum.reshape(len(weight), -1)
+    pos_at = weight[:, sample.reshape(-1)[pos_elem]]
+    if pos_group is not None:
+        pos_at = np.add.reduceat(pos_at, pos_group, axis=1)
+    pos_cum, w_pos = _column_cumsum(pos_at, pos_bound)
+    w_neg = w_total - w_pos
+    w_end = w_cum[:, block_end]
+    # 截止到本块末尾的负例权重，并列（同一块内）的负例只计一半
+    neg_before = w_end - pos_cum
+    neg_before -= 0.5 * (w_end - w_cum[:, block_begin] - pos_at)
+    _, mis_order = _column_cumsum(pos_at * neg_before, pos_bound)
+    _, precision = _column_cumsum(pos_at * pos_cum / np.maximum(w_end, 1e-12), pos_bound)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        auc = 1 - mis_order / (w_pos * w_neg)
+        ap = precision / w_pos
+    auc[(w_pos == 0) | (w_neg == 0)] = np.nan
+    ap[w_pos == 0] = 0
+    return auc, ap
+
+
+def _sample_ranking(score, true):
+    """
+    每个样本内对标签升序排序一次（与原top_k_num相同的argsort），得到逐样本的label ranking loss与各个top k命中数
+    :return: ranking_loss [n_samples], top_k [n_samples, len(TOP_K_LIST)]
+    """
+    n_label = score.shape[1]
+    order = np.argsort(score, axis=1)
+    score = np.take_along_axis(score, order, axis=1).transpose()
+    true = np.take_along_axis(true, order, axis=1).transpose()
+    # 排序错误的(真, 假)标签对：假标签的分数不低于真标签，即假标签所在并列块末尾之前的真标签数
+    _, end = _tie_block(score)
+    true_le = np.take_along_axis(np.cumsum(true, axis=0), end, axis=0)
+    n_pos = np.sum(true, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        loss = np.sum(true_le * ~true, axis=0) / (n_pos * (n_label - n_pos))
+    loss[(n_pos == 0) | (n_pos == n_label)] = 0
+
+    hit = np.cumsum(true[::-1], axis=0)
+    top_k = np.stack([hit[min(top_num, n_label) - 1] for top_num in TOP_K_LIST], axis=1)
+    return loss, top_k
+
+
+_bootstrap_engine = None
+
+
+def _init_bootstrap(engine):
+    global _bootstrap_engine
+    _bootstrap_engine = engine
+
+
+def _bootstrap_chunk(task):
+    seed, size = task
+    n = _bootstrap_engine.num_sample
+    sample_idx = np.random.default_rng(seed).integers(0, n, size=[size, n])
+    # 重采样的下标矩阵转为每个样本被抽中的次数
+    weight = np.bincount((sample_idx + np.arange(size)[:, np.newaxis] * n).reshape(-1), minlength=size * n)
+    return _bootstrap_engine(weight.reshape(size, n))
+
+
+def bootstrap_metric(pred_prob, label, group_dict, num_bootstrap=1000, alpha=0.05, threshold=0.5, seed=0,
+                     workers=None, chunk_size=None):
+    """
+    对样本做bootstrap重采样，给出所有组、所有指标的百分位置信区间
+    重采样按chunk分发到进程池，每个chunk的随机种子由seed派生，结果与workers数量无关
+    :return: {key: (point [17], lower [17], upper [17])}
+    """
+    engine = GroupMetric(pred_prob, label, group_dict, threshold)
+    point = engine()
+    if chunk_size is None:
+        # 每个chunk的中间数组约为 chunk_size * n_samples * n_labels，控制在百万级别
+        chunk_size = max(1, min(num_bootstrap, 2 ** 22 // max(1, engine.num_sample * engine.tp.shape[1])))
+    sizes = [min(chunk_size, num_bootstrap - i) for i in range(0, num_bootstrap, chunk_size)]
+    tasks = list(zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes))
+    workers = workers if workers is not None else min(len(tasks), os.cpu_count())
+
+    if workers <= 1:
+        _init_bootstrap(engine)
+        chunk_list = [_bootstrap_chunk(task) for task in tasks]
+    else:
+        start_methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in start_methods else 'spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_bootstrap,
+                                 initargs=(engine,)) as executor:
+            chunk_list = list(executor.map(_bootstrap_chunk, tasks))
+
+    result = dict()
+    for key in point:
+        sample = np.concatenate([chunk[key] for chunk in chunk_list], axis=0)
+        with warnings.catch_warnings():
+            # 某个指标在所有重采样中均为nan时，区间为nan
+            warnings.simplefilter('ignore', RuntimeWarning)
+            lower, upper = np.nanpercentile(sample, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+        result[key] = (point[key][0], lower, upper)
+    return result
 
 
 def top_k_num(fuse_result, top_num):
-    hit_sum = 0
-    for i in range(len(fuse_result[0])):
-        result = fuse_result[:, i, :]
-        result = result[result[:, 0].argsort()]
-        hit_sum += np.sum(result[-1*top_num:, 1])
-    return hit_sum/len(fuse_result[0])
+    # fuse_result: [n_classes, n_samples, 2(prob, label)]
+    order = np.argsort(fuse_result[:, :, 0], axis=0)
+    hit = np.take_along_axis(fuse_result[:, :, 1], order, axis=0)[-1 * top_num:]
+    return np.sum(hit) / len(fuse_result[0])
 
 
 def index_divide(label, threshold=5):
@@ -259,8 +480,9 @@ def main():
         pred_test = np.random.random(label.shape)
         pred_test = (pred_test-np.min(pred_test, axis=0))/(np.max(pred_test, axis=0)-np.min(pred_test, axis=0))
 
+        result = group_metric(pred_test, label, group)
         for key in group:
-            print(metric(pred_test, label, group[key]))
+            print(result[key])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,236 @@
+import os
+import sys
+src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(src)
+sys.path.append(os.path.join(src, 'model'))
+
+import argparse
+import json
+import platform
+import shutil
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+import torch
+import experiment_util as util
+from model import kg_env, performance_eval, train_agent
+from knowledge_graph import KnowledgeGraph
+"""
+训练与评估热路径的基准测试
+患者表示、interaction与label为合成数据，形状与read_patient_representation_and_label的输出一致，KG使用与训练、评估相同的kg.kgs
+计时项目: env reset/step、state构建、policy前向、rollout、update、每个batch的beam search、评估指标
+结果写出为JSON，--compare给出之前的结果时按(项目, 参数)对比中位数，超过容差的项目视为性能回退，
+要求两次运行的KG、模型与路径长度等设置相同
+"""
+
+
+def synthetic_data(kg, num_pat, embed_size, density=0.1, seed=0):
+    """
+    :return: pat_embed [num_pat, embed_size], interact [num_pat, #nodes], label [num_pat, #nodes],
+        concept_embed [#nodes, embed_size]，label只在疾病节点上非零
+    """
+    rng = np.random.RandomState(seed)
+    is_disease = np.array([kg.get_index_type(i) == util.DISEASE for i in range(kg.num_nodes)])
+    pat_embed = rng.rand(num_pat, embed_size)
+    interact = (rng.rand(num_pat, kg.num_nodes) < density).astype(float)
+    # 每个患者至少有一个疾病，保证第一跳存在可选动作
+    interact[np.arange(num_pat), rng.choice(np.nonzero(is_disease)[0], num_pat)] = 1
+    label = ((rng.rand(num_pat, kg.num_nodes) < density) & is_disease).astype(float)
+    concept_embed = rng.rand(kg.num_nodes, embed_size)
+    return pat_embed, interact, label, concept_embed
+
+
+def label_group(num_label):
+    """与read_group相同的划分方式，按列号三等分"""
+    group = {'all': list(range(num_label)), 'group_0': [], 'group_1': [], 'group_2': []}
+    for i in range(num_label):
+        group['group_{}'.format(min(3 * i // num_label, 2))].append(i)
+    return group
+
+
+def measure(fn, repeat, setup=None, warmup=1):
+    """setup在每次计时之前执行且不计入耗时，返回每次的耗时(ms)"""
+    times = []
+    for i in range(warmup + repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        fn(arg)
+        if i >= warmup:
+            times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def _record(name, times, num_item, **params):
+    times = np.array(times)
+    return {'name': name, 'params': params, 'repeat': len(times), 'num_item': num_item,
+            'median_ms': float(np.median(times)), 'mean_ms': float(np.mean(times)), 'min_ms': float(np.min(times)),
+            'std_ms': float(np.std(times)), 'per_item_us': float(np.median(times) * 1000 / num_item)}
+
+
+def _random_actions(env):
+    return [actions[np.random.randint(len(actions))][1] for actions in env.get_batch_actions()]
+
+
+def bench_agent(args, kg, pat_embed, interact, label, embed_path):
+    results = []
+    env = kg_env.BatchKGEnvironment(args.kg_path, embed_path, None, args.max_path_len, pat_embed.shape[1],
+                                    args.history_len, sparse_action=args.sparse_action)
+    model = train_agent.ActorCritic(env.state_dim, env.max_acts, args.hidden, 0.1,
+                                    concept_embeds=env.embeds if args.sparse_action else None)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    collector = train_agent.RolloutCollector(env, model, 'cpu')
+
+    for batch_size in args.batch_sizes:
+        batch_id = list(range(batch_size))
+        embed, inter, lab = pat_embed[:batch_size], interact[:batch_size], label[:batch_size]
+        print('batch size {}'.format(batch_size))
+
+        times = measure(lambda _: env.reset(batch_id, embed, inter), args.repeat)
+        results.append(_record('env_reset', times, batch_size, batch_size=batch_size))
+
+        def reset_and_pick(_=None):
+            env.reset(batch_id, embed, inter)
+            return _random_actions(env)
+        times = measure(lambda acts: env.batch_step(acts, embed, lab), args.repeat, setup=reset_and_pick)
+        results.append(_record('env_step', times, batch_size, batch_size=batch_size))
+
+        # 走完一条完整路径后的path pool，用于state构建
+        reset_and_pick()
+        for _ in range(args.max_path_len - 1):
+            env.batch_step(_random_actions(env), embed, lab)
+        path_pool = [list(path) for path in env.get_batch_path()]
+        times = measure(lambda _: env.batch_get_state(path_pool, embed), args.repeat, setup=lambda: env.clear_cache())
+        results.append(_record('state_build_cold', times, batch_size, batch_size=batch_size))
+        times = measure(lambda _: env.batch_get_state(path_pool, embed), args.repeat)
+        results.append(_record('state_build', times, batch_size, batch_size=batch_size))
+
+        state = torch.from_numpy(env.reset(batch_id, embed, inter)).float()
+        act_mask, cand_ids = env.batch_action_tensor()
+        times = measure(lambda _: model((state, act_mask, cand_ids)), args.repeat)
+        results.append(_record('policy_forward', times, batch_size, batch_size=batch_size))
+
+        batch = [(embed, inter, lab, batch_id)]
+        times = measure(lambda _: collector.collect(batch), args.repeat)
+        results.append(_record('rollout', times, batch_size, batch_size=batch_size))
+        times = measure(lambda _: model.update(optimizer, 'cpu', 0.13), args.repeat,
+                        setup=lambda: collector.collect(batch))
+        results.append(_record('update', times, batch_size, batch_size=batch_size))
+
+        for beam in args.beam_widths:
+            topk = [int(item) for item in beam.split(',')]
+            times = measure(lambda _: performance_eval.batch_beam_search(
+                env, model, embed, inter, batch_id, args.max_path_len, 'cpu', topk), args.repeat)
+            results.append(_record('beam_search', times, batch_size, batch_size=batch_size, beam=beam))
+        model.train()
+    return results
+
+
+def bench_metric(args, kg):
+    results = []
+    num_label = sum(kg.get_index_type(i) == util.DISEASE for i in range(kg.num_nodes))
+    group = label_group(num_label)
+    rng = np.random.RandomState(0)
+    for num_pat in args.metric_sizes:
+        print('metric size {}'.format(num_pat))
+        pred = rng.rand(num_label, num_pat)
+        label = (rng.rand(num_label, num_pat) < 0.1).astype(float)
+        label[:, 0], label[:, 1] = 1, 0  # 保证每个标签同时有正负例
+        times = measure(lambda _: util.group_metric(pred, label, group), args.repeat)
+        results.append(_record('group_metric', times, num_pat, num_patients=num_pat))
+    return results
+
+
+def run(args):
+    np.random.seed(0)
+    torch.manual_seed(0)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    kg = kg_env.load_kg(args.kg_path)
+    pat_embed, interact, label, concept_embed = synthetic_data(kg, max(args.batch_sizes), args.embed_size)
+    tmp_folder = tempfile.mkdtemp()
+    try:
+        embed_path = os.path.join(tmp_folder, 'concept_embedding.npy')
+        np.save(embed_path, concept_embed)
+        results = bench_agent(args, kg, pat_embed, interact, label, embed_path) + bench_metric(args, kg)
+    finally:
+        shutil.rmtree(tmp_folder)
+    meta = {'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'numpy': np.__version__, 'torch': torch.__version__,
+            'torch_threads': torch.get_num_threads(), 'cpu_count': os.cpu_count(),
+            'args': {key: value for key, value in vars(args).items() if key not in {'output', 'compare'}}}
+    return {'meta': meta, 'results': results}
+
+
+# 影响计时对象本身的设置，与baseline不同时两次结果不可比（batch size、beam宽度等已包含在各项目的参数中）
+_SETUP_ARGS = ['kg_path', 'embed_size', 'max_path_len', 'history_len', 'hidden', 'sparse_action', 'threads']
+
+
+def setup_mismatch(baseline, current):
+    """:return: [(设置名, baseline中的值, 当前值)]，只对比_SETUP_ARGS"""
+    base_args, args = baseline['meta']['args'], current['meta']['args']
+    return [(name, base_args.get(name), args.get(name)) for name in _SETUP_ARGS
+            if base_args.get(name) != args.get(name)]
+
+
+def _key(record):
+    return record['name'], json.dumps(record['params'], sort_keys=True)
+
+
+def compare(baseline, current, tolerance):
+    """按中位数对比，返回慢于baseline * (1 + tolerance)的项目，两次运行的设置不同时抛出ValueError"""
+    mismatch = setup_mismatch(baseline, current)
+    if mismatch:
+        raise ValueError('baseline was run with different settings: {}'.format(
+            ', '.join('{}={} (now {})'.format(name, old, now) for name, old, now in mismatch)))
+    base = {_key(record): record for record in baseline['results']}
+    regression = []
+    print('{:<18}{:<40}{:>12}{:>12}{:>8}'.format('name', 'params', 'base(ms)', 'now(ms)', 'ratio'))
+    for record in current['results']:
+        if _key(record) not in base:
+            continue
+        old = base[_key(record)]['median_ms']
+        ratio = record['median_ms'] / old if old > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            regression.append(record)
+            flag = '  REGRESSION'
+        print('{:<18}{:<40}{:>12.3f}{:>12.3f}{:>8.2f}{}'.format(record['name'], _key(record)[1], old,
+                                                               record['median_ms'], ratio, flag))
+    return regression
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--kg_path', type=str, default=os.path.abspath('../../resource/knowledge_graph/kg.kgs'))
+    parser.add_argument('--embed_size', type=int, default=5, help='patient / concept embedding size.')
+    parser.add_argument('--batch_sizes', type=int, nargs='*', default=[32, 128, 512])
+    parser.add_argument('--beam_widths', type=str, nargs='*', default=['10,5,5', '23,23,23'], help='topk per hop.')
+    parser.add_argument('--metric_sizes', type=int, nargs='*', default=[1000, 10000])
+    parser.add_argument('--max_path_len', type=int, default=2)
+    parser.add_argument('--history_len', type=int, default=1)
+    parser.add_argument('--hidden', type=int, nargs='*', default=[64, 32])
+    parser.add_argument('--sparse_action', action='store_true')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None, help='torch threads, default: torch default.')
+    parser.add_argument('--output', type=str, default=os.path.abspath(
+        '../../resource/benchmark_{}.json'.format(datetime.now().strftime('%Y%m%d%H%M%S'))))
+    parser.add_argument('--compare', type=str, default=None, help='baseline json to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown ratio before flagging.')
+    args = parser.parse_args()
+
+    current = run(args)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(current, f, indent=1)
+    print('results saved to {}'.format(args.output))
+    for record in current['results']:
+        print('{:<18}{:<40}{:>10.3f} ms'.format(record['name'], json.dumps(record['params']), record['median_ms']))
+    if args.compare is not None:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regression = compare(json.load(f), current, args.tolerance)
+        if regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
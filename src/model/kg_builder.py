@@ -0,0 +1,166 @@
+import os
+import sys
+src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(src)
+sys.path.append(os.path.join(src, 'model'))
+
+import argparse
+import csv
+import time
+import numpy as np
+from experiment_util import DISEASE, DISEASE_CATEGORY, RISK_FACTOR, SUB_CONCEPT, GENERAL_CONCEPT, CAUSE, \
+    relation_list, entity_type_list, kg_relation
+from knowledge_graph import CompiledKnowledgeGraph
+from kg_store import KGStore, FILE_SUFFIX
+"""
+KG的批量构建与增量更新
+节点与边一次性读入为数组，id校验、去重均以向量化的集合运算完成，结果为CompiledKnowledgeGraph
+对已编译的KG，可以只读取增删边的delta文件并重新生成CSR，无需重新解析整个CSV
+delta文件格式: op,_start,_end,_type，op为+或-
+编译结果保存为KGStore的.kgs文件，训练与评估时以memmap方式加载
+"""
+
+NODE_LABEL = {':DISEASE_CATEGORY': DISEASE_CATEGORY, ':DISEASE': DISEASE, ':RISK_FACTOR': RISK_FACTOR}
+RELATION_TYPE = {'GENERAL_CONCEPT': GENERAL_CONCEPT, 'SUB_CONCEPT': SUB_CONCEPT, 'CAUSE': CAUSE}
+# [entity_type, relation]，某类实体是否允许发出某种relation，与KnowledgeGraph中的kg_relation一致
+ALLOWED_RELATION = np.array([[relation in kg_relation[entity_type] for relation in relation_list]
+                             for entity_type in entity_type_list])
+
+
+def read_csv_columns(path, columns):
+    """按列名读取CSV，返回str矩阵 [num_rows, len(columns)]，列名重复时取第一次出现的列"""
+    with open(path, 'r', encoding='utf-8-sig', newline='') as file:
+        csv_reader = csv.reader(file)
+        head = next(csv_reader)
+        index = [head.index(column) for column in columns]
+        rows = [[line[i] for i in index] for line in csv_reader]
+    return np.array(rows, dtype=str).reshape(-1, len(columns))
+
+
+def _encode(values, mapping, vocabulary, error):
+    """将字符串数组映射为vocabulary中的下标，每个不同的取值只查一次表"""
+    unique, inverse = np.unique(values, return_inverse=True)
+    code = []
+    for item in unique.tolist():
+        if item not in mapping:
+            raise ValueError('{}: {}'.format(error, item))
+        code.append(vocabulary.index(mapping[item]))
+    return np.array(code, dtype=np.int8)[inverse].reshape(-1)
+
+
+def read_nodes(path):
+    """
+    节点文件至少包含_id,_labels,chineseName,englishName四列
+    Neo4j的合并导出文件（knowledge_graph_output.csv）中，边所在行的_labels为空，会被跳过
+    """
+    data = read_csv_columns(path, ['_id', '_labels', 'chineseName', 'englishName'])
+    data = data[data[:, 1] != '']
+    node_type = _encode(data[:, 1], NODE_LABEL, entity_type_list, 'Error Label Name')
+    return data[:, 0].astype(np.int64), node_type, data[:, 2], data[:, 3]
+
+
+def read_edges(path):
+    """边文件至少包含_start,_end,_type三列，_type为空的行（合并导出文件中的节点行）会被跳过"""
+    data = read_csv_columns(path, ['_start', '_end', '_type'])
+    data = data[data[:, 2] != '']
+    relation = _encode(data[:, 2], RELATION_TYPE, relation_list, 'Error relation type')
+    return data[:, 0].astype(np.int64), relation, data[:, 1].astype(np.int64)
+
+
+def read_delta(path):
+    data = read_csv_columns(path, ['op', '_start', '_end', '_type'])
+    if not np.all(np.isin(data[:, 0], ['+', '-'])):
+        raise ValueError('delta op should be + or -')
+    relation = _encode(data[:, 3], RELATION_TYPE, relation_list, 'Error relation type')
+    return data[:, 0] == '+', data[:, 1].astype(np.int64), relation, data[:, 2].astype(np.int64)
+
+
+def _edge_key(num_nodes, edge_start, edge_relation, edge_end):
+    # 编码顺序与CSR中的排序(start, relation, end)一致，对key排序即完成边表排序
+    return (edge_start.astype(np.int64) * len(relation_list) + edge_relation) * num_nodes + edge_end
+
+
+def _compile_edges(node_type, chinese_name, english_name, edge_start, edge_relation, edge_end):
+    num_nodes = len(node_type)
+    in_range = (edge_start >= 0) & (edge_start < num_nodes) & (edge_end >= 0) & (edge_end < num_nodes)
+    if not np.all(in_range) or np.any(node_type[edge_start] < 0) or np.any(node_type[edge_end] < 0):
+        raise ValueError('Error item index')
+    if not np.all(ALLOWED_RELATION[node_type[edge_start], edge_relation]):
+        raise ValueError('Error relation for entity type')
+
+    # 注意，此处不建模自环；重复边以sort-unique的方式一次性去除
+    keep = edge_start != edge_end
+    key = np.unique(_edge_key(num_nodes, edge_start[keep], edge_relation[keep], edge_end[keep]))
+    edge_end = (key % num_nodes).astype(np.int32)
+    key //= num_nodes
+    edge_relation = (key % len(relation_list)).astype(np.int8)
+    edge_start = (key // len(relation_list)).astype(np.int32)
+    print('remove duplicate relation count: {}'.format(int(np.sum(keep)) - len(key)))
+    return CompiledKnowledgeGraph(node_type, chinese_name, english_name, edge_start, edge_relation, edge_end)
+
+
+def compile_kg(node_id, node_type, chinese_name, english_name, edge_start, edge_relation, edge_end):
+    # 我们要求所有的entity拥有全局唯一的非负id
+    if len(node_id) == 0 or np.any(node_id < 0):
+        raise ValueError('Error item index')
+    if len(np.unique(node_id)) != len(node_id):
+        raise ValueError('Duplicate item index')
+    num_nodes = int(node_id.max()) + 1
+    type_table = np.full(num_nodes, -1, dtype=np.int8)
+    type_table[node_id] = node_type
+    chinese_table = np.zeros(num_nodes, dtype=chinese_name.dtype)
+    chinese_table[node_id] = chinese_name
+    english_table = np.zeros(num_nodes, dtype=english_name.dtype)
+    english_table[node_id] = english_name
+    print('Total {:d} nodes.'.format(len(node_id)))
+    return _compile_edges(type_table, chinese_table, english_table, edge_start, edge_relation, edge_end)
+
+
+def build_kg(node_path, edge_path=None):
+    """edge_path为None时，node_path为同时包含节点与边的合并导出文件"""
+    edge_path = node_path if edge_path is None else edge_path
+    return compile_kg(*(read_nodes(node_path) + read_edges(edge_path)))
+
+
+def apply_delta(kg, delta_path):
+    """在已编译的KG（CompiledKnowledgeGraph或KGStore）上增删边，返回新的CompiledKnowledgeGraph"""
+    is_add, start, relation, end = read_delta(delta_path)
+    edge_start = np.repeat(np.arange(kg.num_nodes, dtype=np.int64), kg.degree())
+    key = _edge_key(kg.num_nodes, edge_start, kg.edge_relation, kg.indices)
+    keep = ~np.isin(key, _edge_key(kg.num_nodes, start[~is_add], relation[~is_add], end[~is_add]))
+    print('delta: +{} -{}'.format(int(np.sum(is_add)), int(np.sum(~keep))))
+    empty = np.zeros(kg.num_nodes, dtype=str)
+    chinese_name = empty if kg.chinese_name is None else np.array(kg.chinese_name)
+    english_name = empty if kg.english_name is None else np.array(kg.english_name)
+    return _compile_edges(np.array(kg.node_type), chinese_name, english_name,
+                          np.concatenate([edge_start[keep], start[is_add]]),
+                          np.concatenate([kg.edge_relation[keep], relation[is_add]]),
+                          np.concatenate([kg.indices[keep], end[is_add]]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--node_path', type=str,
+                        default=os.path.abspath('../../resource/knowledge_graph/knowledge_graph_output.csv'))
+    parser.add_argument('--edge_path', type=str, default=None, help='default: edges are in node_path')
+    parser.add_argument('--base', type=str, default=None, help='.kgs file to apply deltas on, skip csv parsing')
+    parser.add_argument('--delta', type=str, nargs='*', default=[])
+    parser.add_argument('--save_path', type=str,
+                        default=os.path.abspath('../../resource/knowledge_graph/kg' + FILE_SUFFIX))
+    args = parser.parse_args()
+
+    start_time = time.time()
+    if args.base is not None:
+        kg = KGStore.open(args.base)
+    else:
+        kg = build_kg(args.node_path, args.edge_path)
+    for delta_path in args.delta:
+        kg = apply_delta(kg, delta_path)
+    print('max degree: {}'.format(kg.degree().max()))
+    print('relation sum: {}'.format(len(kg.indices)))
+    KGStore.from_kg(kg).save(args.save_path)
+    print('build knowledge graph in {:.3f}s'.format(time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,46 @@
-from experiment_util import load_embed, relation_embed, GENERAL_CONCEPT, PATIENT, SELF_LOOP, HAVE, DISEASE
+from experiment_util import load_embed, relation_embed, relation_list, GENERAL_CONCEPT, PATIENT, SELF_LOOP, HAVE, \
+    DISEASE
 import numpy as np
+import torch
 import pickle
 from knowledge_graph import KnowledgeGraph
+from kg_store import KGStore, SHM_PREFIX, FILE_SUFFIX
+from profiler import PROFILER
+
+
+# 进程内缓存，KG与concept embedding均为只读对象，同一进程（以及由其fork出的子进程）无需重复加载
+_kg_cache = dict()
+_embed_cache = dict()
+# 路径展开缓存的条目上限，超出后整体清空
+EXPANSION_CACHE_SIZE = 100000
 
 
 def load_kg(path):
-    with open(path, 'rb') as f:
-        kg = pickle.load(f)
-    return kg
+    # path也可以指向KGStore（共享内存或.kgs文件），此时以零拷贝的方式挂载
+    if path not in _kg_cache:
+        if path.startswith(SHM_PREFIX):
+            _kg_cache[path] = KGStore.attach(path)
+        elif path.endswith(FILE_SUFFIX):
+            _kg_cache[path] = KGStore.open(path)
+        else:
+            with open(path, 'rb') as f:
+                kg = pickle.load(f)
+            if not hasattr(kg, 'indptr'):
+                kg.build_csr()
+            _kg_cache[path] = kg
+    return _kg_cache[path]
+
+
+def load_concept_embed(path):
+    if path not in _embed_cache:
+        if path.startswith(SHM_PREFIX) or path.endswith(FILE_SUFFIX):
+            embedding = load_kg(path).embedding
+            if embedding is None:
+                raise ValueError('kg store has no concept embedding: {}'.format(path))
+            _embed_cache[path] = embedding
+        else:
+            _embed_cache[path] = load_embed(path)
+    return _embed_cache[path]
 
 
 class KGState(object):
@@ -38,21 +71,83 @@ class KGState(object):
             raise Exception('mode should be one of {full, current}')
 
 
+class ActionSpace(object):
+    """
+    动作空间，大小由KG的节点数决定
+    dense模式: 每一列对应一个全局节点id，宽度为KG节点数，policy对全部节点做softmax
+    sparse模式: 每一行只保留当前的候选动作，宽度为本batch中候选动作数的最大值，cand_ids给出每一列对应的全局节点id，
+    policy只需对候选节点打分，显存与单步耗时只与节点的度相关，与图谱规模无关
+    """
+    def __init__(self, num_nodes, sparse=False):
+        self.num_nodes = num_nodes
+        self.sparse = sparse
+
+    @PROFILER.timed('action_mask')
+    def to_tensor(self, batch_actions, device='cpu'):
+        """
+        :param batch_actions: list of list of (relation, node_id)
+        :return: act_mask LongTensor [bs, width]; cand_ids LongTensor [bs, width]，dense模式下为None
+        """
+        rows, cols, node_ids = [], [], []
+        for row, actions in enumerate(batch_actions):
+            rows.extend([row] * len(actions))
+            cols.extend(range(len(actions)))
+            node_ids.extend(item[1] for item in actions)
+        if not self.sparse:
+            act_mask = torch.zeros(len(batch_actions), self.num_nodes, dtype=torch.long, device=device)
+            act_mask[rows, node_ids] = 1
+            return act_mask, None
+        width = max(len(actions) for actions in batch_actions)
+        act_mask = torch.zeros(len(batch_actions), width, dtype=torch.long, device=device)
+        cand_ids = torch.zeros(len(batch_actions), width, dtype=torch.long, device=device)
+        act_mask[rows, cols] = 1
+        cand_ids[rows, cols] = torch.tensor(node_ids, dtype=torch.long, device=device)
+        return act_mask, cand_ids
+
+    def to_global(self, acts, cand_ids):
+        """将policy输出的列下标映射为全局节点id"""
+        if cand_ids is None:
+            return acts
+        return cand_ids.gather(-1, acts)
+
+
 class BatchKGEnvironment(object):
     """V5"""
-    def __init__(self, kg_path, embed_path, max_acts, max_path_len, pat_repre_size, history=2):
-        # 规定max acts即为知识图谱中的所有可达节点
-        assert max_acts == 65
-        self.max_acts = max_acts
+    def __init__(self, kg_path, embed_path, max_acts, max_path_len, pat_repre_size, history=2, sparse_action=False,
+                 max_candidates=None, prune_by='similarity'):
         self.max_len = max_path_len
         # 因为最初始的点也占了1，因此最大path长度应当是max_path_len+1
         self.max_num_nodes = max_path_len + 1
         self.kg = load_kg(kg_path)
-        self.embeds = load_embed(embed_path)
+        # 规定max acts即为知识图谱中的所有可达节点，max_acts为None时直接由KG决定
+        if max_acts is not None and max_acts != self.kg.num_nodes:
+            raise ValueError('max_acts ({}) does not match the knowledge graph ({} nodes)'
+                             .format(max_acts, self.kg.num_nodes))
+        self.max_acts = self.kg.num_nodes
+        self.action_space = ActionSpace(self.max_acts, sparse_action)
+        self.embeds = load_concept_embed(embed_path)
         self.embed_size = self.embeds.shape[1]
         self.state_gen = KGState(pat_repre_size, self.embed_size, relation_embed[GENERAL_CONCEPT].shape[0], history)
         self.state_dim = self.state_gen.dim
 
+        # Action剪枝，每个节点最多保留max_candidates个候选（不含自环），None表示不剪枝
+        # similarity: 按候选节点embedding与患者所在簇中心的内积排序；degree: 按候选节点的度排序
+        if prune_by not in {'similarity', 'degree'}:
+            raise ValueError('prune_by should be one of {similarity, degree}')
+        self.max_candidates = max_candidates
+        self.prune_by = prune_by
+        self.pat_centroids = None  # [num_cluster, pat_repre_size]
+        self._node_score = dict()  # cluster -> 全部节点的打分
+        self._prune_cache = dict()  # (node_id, cluster) -> 该节点出边按打分降序排列的下标
+        self._pat_cluster = dict()  # 编码后的patient id -> cluster
+
+        # 路径展开缓存，beam search中大量患者的路径在第一跳之后汇合到相同的(节点, 历史)上
+        # 第一跳之后的候选动作只与当前节点、已访问的KG节点、（剪枝时）患者所在簇有关
+        # state中除患者embedding之外的部分只与path[1:]有关，患者embedding所在的位置只与路径长度有关
+        self._action_cache = dict()  # (node_id, 已访问的KG节点, done, cluster) -> actions
+        self._state_cache = dict()  # tuple(path[1:]) -> 患者embedding位置为0的state
+        self._patient_slot = dict()  # len(path) -> 患者embedding在state中的位置（bool mask）
+
         # Following is current episode information.
         self._batch_path = None  # list of tuples of (relation, node_type, node_id)
         self._batch_curr_actions = None  # save current valid actions
@@ -61,10 +156,64 @@ class BatchKGEnvironment(object):
         # Here only use 1 'done' indicator, since all paths have same length and will finish at the same time.
         self._done = False
 
+    def fit_patient_cluster(self, pat_embeds, num_cluster, max_iter=20):
+        """用k-means对患者表示聚类，剪枝打分按簇缓存，同一簇的患者共享候选排序"""
+        pat_embeds = np.asarray(pat_embeds, dtype=float)
+        num_cluster = min(num_cluster, len(pat_embeds))
+        centroids = pat_embeds[np.random.choice(len(pat_embeds), num_cluster, replace=False)]
+        for _ in range(max_iter):
+            assign = self._nearest_centroid(pat_embeds, centroids)
+            new_centroids = np.array([pat_embeds[assign == i].mean(axis=0) if np.any(assign == i) else centroids[i]
+                                      for i in range(num_cluster)])
+            if np.allclose(new_centroids, centroids):
+                break
+            centroids = new_centroids
+        self.set_patient_cluster(centroids)
+        return centroids
+
+    def set_patient_cluster(self, centroids):
+        self.pat_centroids = np.asarray(centroids, dtype=float)
+        self._node_score = dict()
+        self._prune_cache = dict()
+        self.clear_cache()
+
+    def clear_cache(self):
+        self._action_cache = dict()
+        self._state_cache = dict()
+
+    @staticmethod
+    def _nearest_centroid(pat_embeds, centroids):
+        distance = (np.sum(pat_embeds ** 2, axis=1)[:, np.newaxis] - 2 * pat_embeds.dot(centroids.T) +
+                    np.sum(centroids ** 2, axis=1)[np.newaxis, :])
+        return np.argmin(distance, axis=1)
+
+    def _get_node_score(self, cluster):
+        if cluster not in self._node_score:
+            if self.prune_by == 'degree':
+                self._node_score[cluster] = self.kg.degree().astype(float)
+            else:
+                self._node_score[cluster] = np.asarray(self.embeds).dot(self.pat_centroids[cluster])
+        return self._node_score[cluster]
+
+    def _prune(self, next_ids, relations, visited_nodes, cluster, cache_key=None):
+        """按打分保留前max_candidates个未访问的候选，KG节点的排序结果按(node, cluster)缓存"""
+        order = self._prune_cache.get(cache_key) if cache_key is not None else None
+        if order is None:
+            order = np.argsort(-self._get_node_score(cluster)[next_ids], kind='stable')
+            if cache_key is not None:
+                self._prune_cache[cache_key] = order
+        candidate_acts = []
+        for idx in order.tolist():
+            if next_ids[idx] not in visited_nodes:
+                candidate_acts.append((relations[idx], int(next_ids[idx])))
+                if len(candidate_acts) == self.max_candidates:
+                    break
+        return candidate_acts
+
     def _get_actions(self, path, done, pat_init_interact=None):
         """
         Compute actions for current node.
-        由于我们的图谱非常的小，因此可以不进行Action的剪枝
+        max_candidates为None时不进行Action的剪枝（我们的图谱非常的小），否则只保留打分最高的max_candidates个候选
         为避免idx冲突，所有患者的id全部*-1再减一处理(确保一定是负数)
         """
         _, curr_node_type, curr_node_id = path[-1]
@@ -81,25 +230,22 @@ class BatchKGEnvironment(object):
 
         if curr_node_type == PATIENT:
             assert len(path) == 1
-            assert len(pat_init_interact) == 65
-            relations_nodes = {HAVE: []}
-            for idx_ in range(len(pat_init_interact)):
-                if pat_init_interact[idx_] == 1:
-                    relations_nodes[HAVE].append(idx_)
+            assert len(pat_init_interact) == self.max_acts
+            next_ids = np.nonzero(np.asarray(pat_init_interact) == 1)[0]
+            relations = [HAVE] * len(next_ids)
         else:
-            relations_nodes = self.kg(curr_node_type, curr_node_id)
+            # 直接读取CSR切片，开销只与节点的度有关
+            next_ids, relation_codes = self.kg.neighbors(curr_node_id)
+            relations = [relation_list[code] for code in relation_codes.tolist()]
 
         # (2) Get all possible edges from original knowledge graph. must remove visited nodes!
-        candidate_acts = []  # list of tuples of (relation, node_type, node_id)
         visited_nodes = set(v[2] for v in path)
-        for r in relations_nodes:
-            next_node_ids = relations_nodes[r]
-            ids = []
-            for n in next_node_ids:
-                if n not in visited_nodes:
-                    ids.append(n)
-            candidate_acts.extend(zip([r] * len(ids), ids))
-
+        if self.max_candidates is None or len(next_ids) <= self.max_candidates:
+            candidate_acts = [(r, n) for r, n in zip(relations, next_ids.tolist()) if n not in visited_nodes]
+        else:
+            cluster = self._pat_cluster.get(path[0][2], 0)
+            cache_key = None if curr_node_type == PATIENT else (curr_node_id, cluster)
+            candidate_acts = self._prune(next_ids, relations, visited_nodes, cluster, cache_key)
         candidate_acts = sorted(candidate_acts, key=lambda x: (x[0], x[1]))
         actions.extend(candidate_acts)
         return actions
@@ -110,11 +256,28 @@ class BatchKGEnvironment(object):
     def get_batch_path(self):
         return self._batch_path
 
+    def get_batch_actions(self):
+        return self._batch_curr_actions
+
+    @PROFILER.timed('action_build')
     def _batch_get_actions(self, batch_path, done, pat_interact=None):
         if len(batch_path[0]) == 1:
             return [self._get_actions(batch_path[idx_], done, pat_interact[idx_]) for idx_ in range(len(batch_path))]
         else:
-            return [self._get_actions(batch_path[idx_], done) for idx_ in range(len(batch_path))]
+            return [self._get_cached_actions(batch_path[idx_], done) for idx_ in range(len(batch_path))]
+
+    def _get_cached_actions(self, path, done):
+        """第一跳之后的动作按(节点, 已访问节点, done, cluster)缓存，返回的list被多条路径共享，不可修改"""
+        cluster = self._pat_cluster.get(path[0][2], 0) if self.max_candidates is not None else 0
+        key = (path[-1][2], frozenset(v[2] for v in path[1:]), done, cluster)
+        actions = self._action_cache.get(key)
+        PROFILER.count('action_cache_miss' if actions is None else 'action_cache_hit')
+        if actions is None:
+            if len(self._action_cache) >= EXPANSION_CACHE_SIZE:
+                self._action_cache = dict()
+            actions = self._get_actions(path, done)
+            self._action_cache[key] = actions
+        return actions
 
     def _get_state(self, path, pat_embed):
         node_zero = np.zeros(self.state_gen.concept_size)
@@ -158,19 +321,42 @@ class BatchKGEnvironment(object):
     def batch_get_state(self, batch_path, pat_embed_list, id_embed_dict=None):
         return self._batch_get_state(batch_path, pat_embed_list, id_embed_dict)
 
+    def _get_state_suffix(self, path):
+        """患者embedding置0时的state，按path[1:]缓存"""
+        key = tuple(path[1:])
+        state = self._state_cache.get(key)
+        if state is None:
+            if len(self._state_cache) >= EXPANSION_CACHE_SIZE:
+                self._state_cache = dict()
+            state = self._get_state(path, np.zeros(self.state_gen.patient_size))
+            self._state_cache[key] = state
+        return state
+
+    def _get_patient_slot(self, path):
+        if len(path) not in self._patient_slot:
+            ones = self._get_state(path, np.ones(self.state_gen.patient_size))
+            self._patient_slot[len(path)] = ones != self._get_state(path, np.zeros(self.state_gen.patient_size))
+        return self._patient_slot[len(path)]
+
+    @PROFILER.timed('state_build')
     def _batch_get_state(self, batch_path, pat_embed_list, id_embed_dict=None):
         if id_embed_dict is not None:
             # 仅用于测试，在测试集中，由于batch_path的长度会超过pat_embed_list，因此需要进行映射
             # 在训练时，这两个长度严格相等，因此无所谓
-            batch_state = []
-            for idx in range(len(batch_path)):
-                pat_idx = batch_path[idx][0][2]
-                embed_idx = id_embed_dict[pat_idx]
-                batch_state.append(self._get_state(batch_path[idx], pat_embed_list[embed_idx]))
+            embed_idx = [id_embed_dict[path[0][2]] for path in batch_path]
         else:
             # 用于训练和测试的reset部分
-            batch_state = [self._get_state(batch_path[idx], pat_embed_list[idx]) for idx in range(len(batch_path))]
-        return np.vstack(batch_state)
+            embed_idx = list(range(len(batch_path)))
+        pat_embed = np.asarray(pat_embed_list)[embed_idx]
+        # 缓存的后缀中患者embedding的位置为0，只需将本患者的embedding填入
+        batch_state = np.vstack([self._get_state_suffix(path) for path in batch_path])
+        path_len = np.array([len(path) for path in batch_path])
+        for length in np.unique(path_len).tolist():
+            rows = np.nonzero(path_len == length)[0]
+            slot = self._get_patient_slot(batch_path[rows[0]])
+            repeat = int(np.sum(slot)) // self.state_gen.patient_size
+            batch_state[np.ix_(rows, np.nonzero(slot)[0])] = np.tile(pat_embed[rows], (1, repeat))
+        return batch_state
 
     def _get_reward(self, path, label=None):
         # If it is initial state or 1-hop search, reward is 0.
@@ -202,6 +388,7 @@ class BatchKGEnvironment(object):
         """Episode ends only if max path length is reached."""
         return self._done or len(self._batch_path[0]) >= self.max_num_nodes
 
+    @PROFILER.timed('env_reset')
     def reset(self, pat_idx_list, pat_embedding_list, interact_list):
         # 此处，embedding_list的作用是在reset时重置pat_embedding
         # disease_list的作用是建立user和知识图谱之间的关联
@@ -209,12 +396,18 @@ class BatchKGEnvironment(object):
         # 为避免语义歧义，此处所有的pat_id的idx全部做取反再减10000处理，以保证区间和embed concept不同
         self._batch_path = [[(SELF_LOOP, PATIENT, pat_id * -1 - 10000)] for pat_id in pat_idx_list]
         self._done = False
+        if self.max_candidates is not None and self.prune_by == 'similarity':
+            if self.pat_centroids is None:
+                raise ValueError('fit_patient_cluster or set_patient_cluster should be called before pruning')
+            cluster = self._nearest_centroid(np.asarray(pat_embedding_list, dtype=float), self.pat_centroids)
+            self._pat_cluster = {path[0][2]: int(c) for path, c in zip(self._batch_path, cluster)}
         self._batch_curr_state = self._batch_get_state(self._batch_path, pat_embedding_list)
         self._batch_curr_actions = self._batch_get_actions(self._batch_path, self._done, interact_list)
         self._batch_curr_reward = self._batch_get_reward(self._batch_path)
 
         return self._batch_curr_state
 
+    @PROFILER.timed('env_step')
     def batch_step(self, batch_act_idx, embed, label):
         assert len(batch_act_idx) == len(self._batch_path)
 
@@ -222,7 +415,7 @@ class BatchKGEnvironment(object):
         for i in range(len(batch_act_idx)):
             global_act_idx = batch_act_idx[i]
             act_idx = -9999999
-            assert 0 <= global_act_idx < 65
+            assert 0 <= global_act_idx < self.max_acts
             for idx_ in range(len(self._batch_curr_actions[i])):
                 if global_act_idx == self._batch_curr_actions[i][idx_][1]:
                     # 按照设计这一过程只能命中一次，但是不可以不命中
@@ -245,15 +438,9 @@ class BatchKGEnvironment(object):
 
         return self._batch_curr_state, self._batch_curr_reward, self._done
 
-    def batch_action_mask(self):
-        # 返回全局语义的action mask
-        batch_mask = []
-        for actions in self._batch_curr_actions:
-            act_mask = np.zeros(self.max_acts)
-            for item in actions:
-                act_mask[item[1]] = 1
-            batch_mask.append(act_mask)
-        return np.vstack(batch_mask)
+    def batch_action_tensor(self, device='cpu'):
+        # 按照action_space的模式构建(act_mask, cand_ids)
+        return self.action_space.to_tensor(self._batch_curr_actions, device)
 
     def print_path(self):
         for path in self._batch_path:
@@ -0,0 +1,186 @@
+import os
+import sys
+src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(src)
+sys.path.append(os.path.join(src, 'model'))
+
+import argparse
+import json
+import pickle
+import struct
+import uuid
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from experiment_util import entity_type_list, relation_list
+from knowledge_graph import CSRAdjacency
+"""
+KG与concept embedding的紧凑存储
+将KnowledgeGraph的CSR邻接数组（indptr, indices, relation）与节点类型、名称表、embedding矩阵一起
+打包为一块连续内存。该内存块既可以发布到共享内存，也可以写为文件后以memmap方式打开，多个进程零拷贝地共享同一份数据
+布局: MAGIC | header长度(uint32) | JSON header | 按ALIGN对齐的各数组
+加载时只解析header并建立数组视图，不依赖pickle与KnowledgeGraph的类定义
+version 2: 名称表（chinese_name, english_name）与embedding均为可选数组，只含KG的.kgs文件可代替kg.pkl
+"""
+
+MAGIC = b'PBXKGS'
+FORMAT_VERSION = 2
+ALIGN = 64
+SHM_PREFIX = 'shm://'
+FILE_SUFFIX = '.kgs'
+
+
+def _align(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 在attach时也会登记到resource tracker，独立进程退出时会误删共享内存，因此跳过登记
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class KGStore(CSRAdjacency):
+    """
+    通过CSRAdjacency提供与KnowledgeGraph相同的get / __call__ / get_index_type接口，BatchKGEnvironment可直接使用
+    所有数组均为只读视图，可选数组缺失时对应属性为None
+    """
+    def __init__(self, arrays, buffer_owner=None):
+        # 数组含义见CSRAdjacency
+        self.node_type = arrays['node_type']
+        self.indptr = arrays['indptr']
+        self.indices = arrays['indices']
+        self.edge_relation = arrays['relation']
+        self.chinese_name = arrays.get('chinese_name')  # str [num_nodes]
+        self.english_name = arrays.get('english_name')
+        self.embedding = arrays.get('embedding')  # float [num_nodes, embed_size]
+        self._arrays = arrays
+        self._buffer_owner = buffer_owner
+        self.name = None
+
+    @classmethod
+    def from_kg(cls, kg, embeds=None):
+        if not hasattr(kg, 'indptr'):
+            kg.build_csr()
+        arrays = {'node_type': kg.node_type, 'indptr': kg.indptr, 'indices': kg.indices,
+                  'relation': kg.edge_relation}
+        for key in ['chinese_name', 'english_name']:
+            if getattr(kg, key, None) is not None:
+                arrays[key] = np.asarray(getattr(kg, key), dtype=str)
+        if embeds is None:
+            embeds = getattr(kg, 'embedding', None)
+        if embeds is not None:
+            embeds = np.ascontiguousarray(embeds)
+            if len(embeds) != kg.num_nodes:
+                raise ValueError('embedding size does not match the knowledge graph')
+            arrays['embedding'] = embeds
+        return cls(arrays)
+
+    def _layout(self):
+        layout = dict()
+        offset = 0
+        for key, value in self._arrays.items():
+            offset = _align(offset)
+            layout[key] = [offset, value.dtype.str, list(value.shape)]
+            offset += value.nbytes
+        header = json.dumps({'version': FORMAT_VERSION, 'entity_type': entity_type_list, 'relation': relation_list,
+                             'arrays': layout}).encode('utf-8')
+        data_start = _align(len(MAGIC) + 4 + len(header))
+        return header, data_start, data_start + offset
+
+    def _write(self, buffer):
+        header, data_start, _ = self._layout()
+        prefix = MAGIC + struct.pack('<I', len(header)) + header
+        np.ndarray((len(prefix),), dtype=np.uint8, buffer=buffer)[:] = np.frombuffer(prefix, dtype=np.uint8)
+        layout = json.loads(header.decode('utf-8'))['arrays']
+        for key, value in self._arrays.items():
+            offset, dtype, shape = layout[key]
+            target = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=data_start + offset)
+            target[...] = value
+
+    @staticmethod
+    def _read_arrays(buffer):
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError('not a kg store')
+        header_len = struct.unpack('<I', bytes(buffer[len(MAGIC): len(MAGIC) + 4]))[0]
+        header = json.loads(bytes(buffer[len(MAGIC) + 4: len(MAGIC) + 4 + header_len]).decode('utf-8'))
+        if not 1 <= header['version'] <= FORMAT_VERSION:
+            raise ValueError('unsupported kg store version: {}'.format(header['version']))
+        if header['entity_type'] != entity_type_list or header['relation'] != relation_list:
+            raise ValueError('kg store was built with a different entity/relation vocabulary')
+        data_start = _align(len(MAGIC) + 4 + header_len)
+        arrays = dict()
+        for key, (offset, dtype, shape) in header['arrays'].items():
+            array = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=data_start + offset)
+            array.flags.writeable = False
+            arrays[key] = array
+        return arrays
+
+    def publish(self, name=None):
+        """将数据写入一块新的共享内存，返回可供load_kg / load_concept_embed使用的路径"""
+        _, _, size = self._layout()
+        name = name if name is not None else 'pbxai_kg_{}'.format(uuid.uuid4().hex[:12])
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        try:
+            self._write(shm.buf)
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        self._buffer_owner = shm
+        self.name = name
+        return SHM_PREFIX + name
+
+    @classmethod
+    def attach(cls, name):
+        if name.startswith(SHM_PREFIX):
+            name = name[len(SHM_PREFIX):]
+        shm = _attach_shared_memory(name)
+        store = cls(cls._read_arrays(shm.buf), buffer_owner=shm)
+        store.name = name
+        return store
+
+    def save(self, path):
+        _, _, size = self._layout()
+        buffer = np.memmap(path, dtype=np.uint8, mode='w+', shape=(size,))
+        self._write(buffer)
+        buffer.flush()
+        del buffer
+
+    @classmethod
+    def open(cls, path):
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        return cls(cls._read_arrays(buffer), buffer_owner=buffer)
+
+    def unlink(self):
+        """仅由publish的进程在所有worker结束后调用"""
+        if isinstance(self._buffer_owner, shared_memory.SharedMemory):
+            self._arrays, self.node_type, self.indptr, self.indices, self.edge_relation = None, None, None, None, None
+            self.chinese_name, self.english_name, self.embedding = None, None, None
+            self._buffer_owner.close()
+            self._buffer_owner.unlink()
+            self._buffer_owner = None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--kg_path', type=str, default=os.path.abspath('../../resource/knowledge_graph/kg.pkl'))
+    parser.add_argument('--embed_path', type=str, default=None, help='optional, pack the concept embedding as well')
+    parser.add_argument('--save_path', type=str, default=os.path.abspath(
+        '../../resource/knowledge_graph/kg' + FILE_SUFFIX))
+    args = parser.parse_args()
+
+    with open(args.kg_path, 'rb') as f:
+        kg = pickle.load(f)
+    KGStore.from_kg(kg, None if args.embed_path is None else np.load(args.embed_path)).save(args.save_path)
+    print('save kg store to {}'.format(args.save_path))
+
+
+if __name__ == '__main__':
+    main()
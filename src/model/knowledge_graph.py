@@ -2,6 +2,7 @@ from itertools import islice
 import csv
 import os
 import pickle
+import numpy as np
 from experiment_util import DISEASE, DISEASE_CATEGORY, RISK_FACTOR, SUB_CONCEPT, GENERAL_CONCEPT, CAUSE, \
     relation_list, entity_type_list, kg_relation
 """
@@ -10,7 +11,124 @@ from experiment_util import DISEASE, DISEASE_CATEGORY, RISK_FACTOR, SUB_CONCEPT,
 """
 
 
-class KnowledgeGraph(object):
+class CSRAdjacency(object):
+    """
+    以CSR数组表示的邻接结构及其向量化查询接口，KnowledgeGraph, CompiledKnowledgeGraph与KGStore共用
+    子类需提供以下数组：
+    node_type: int8 [num_nodes], entity_type_list中的下标，-1表示该id不存在
+    indptr: int64 [num_nodes+1]，节点i的出边为indices[indptr[i]: indptr[i+1]]
+    indices: int32 [num_edges]，出边的终点
+    edge_relation: int8 [num_edges]，出边的relation，relation_list中的下标
+    同一节点的出边按(relation, 终点)排序
+    """
+    @property
+    def num_nodes(self):
+        return len(self.node_type)
+
+    def degree(self, node_ids=None):
+        degree = np.diff(self.indptr)
+        if node_ids is None:
+            return degree
+        return degree[np.asarray(node_ids, dtype=np.int64)]
+
+    def neighbors(self, node_id, relation=None):
+        """返回单个节点的(终点数组, relation编码数组)"""
+        start, end = self.indptr[node_id], self.indptr[node_id + 1]
+        next_ids, relations = self.indices[start: end], self.edge_relation[start: end]
+        if relation is not None:
+            keep = relations == relation_list.index(relation)
+            next_ids, relations = next_ids[keep], relations[keep]
+        return next_ids, relations
+
+    def batch_neighbors(self, node_ids):
+        """
+        一次性取出一组节点的全部出边
+        :return: (row, next_ids, relations)三个等长数组，row为该边的起点在node_ids中的下标
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        starts = self.indptr[node_ids]
+        counts = self.indptr[node_ids + 1] - starts
+        row = np.repeat(np.arange(len(node_ids)), counts)
+        edge = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - starts, counts)
+        return row, self.indices[edge], self.edge_relation[edge]
+
+    def k_hop_reachable(self, node_ids, k, include_self=False):
+        """
+        :return: bool矩阵 [len(node_ids), num_nodes]，表示在k跳之内可达的节点
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        reach = np.zeros([len(node_ids), self.num_nodes], dtype=bool)
+        frontier_row, frontier_node = np.arange(len(node_ids)), node_ids
+        if include_self:
+            reach[frontier_row, frontier_node] = True
+        for _ in range(k):
+            row, next_ids, _ = self.batch_neighbors(frontier_node)
+            row = frontier_row[row]
+            new = ~reach[row, next_ids]
+            row, next_ids = row[new], next_ids[new]
+            reach[row, next_ids] = True
+            # 同一行中重复到达的节点只需扩展一次
+            flat = np.unique(row * self.num_nodes + next_ids)
+            frontier_row, frontier_node = flat // self.num_nodes, flat % self.num_nodes
+            if len(frontier_node) == 0:
+                break
+        return reach
+
+    def node_relations(self, entity_type, eid):
+        """与KnowledgeGraph.G[entity_type][eid]结构相同的字典"""
+        relations_nodes = {r: [] for r in kg_relation[entity_type]}
+        next_ids, relations = self.neighbors(eid)
+        for relation, next_id in zip(relations.tolist(), next_ids.tolist()):
+            relations_nodes[relation_list[relation]].append(next_id)
+        return relations_nodes
+
+    def get_index_type(self, index):
+        code = self.node_type[int(index)]
+        if code < 0:
+            raise KeyError(index)
+        return entity_type_list[code]
+
+    def get(self, eh_type, eh_id=None, relation=None):
+        if eh_type is None:
+            return {entity_type: self.get(entity_type) for entity_type in entity_type_list}
+        if eh_id is None:
+            code = entity_type_list.index(eh_type)
+            return {eid: self.node_relations(eh_type, eid) for eid in np.nonzero(self.node_type == code)[0].tolist()}
+        if self.get_index_type(eh_id) != eh_type:
+            raise KeyError(eh_id)
+        data = self.node_relations(eh_type, int(eh_id))
+        if relation is not None:
+            data = data[relation]
+        return data
+
+    def __call__(self, eh_type, eh_id=None, relation=None):
+        return self.get(eh_type, eh_id, relation)
+
+
+class CompiledKnowledgeGraph(CSRAdjacency):
+    """
+    只由数组构成的KG，由kg_builder生成，不再保存嵌套字典G
+    除CSR数组外，还保留按(start, relation, end)排序去重后的边表，便于增量地增删边
+    """
+    def __init__(self, node_type, chinese_name, english_name, edge_start, edge_relation, edge_end):
+        self.node_type = node_type
+        # 名称表，下标即节点id，缺失节点为空字符串
+        self.chinese_name = chinese_name
+        self.english_name = english_name
+        self.edge_start = edge_start  # int32 [num_edges]
+        self.edge_end = edge_end  # int32 [num_edges]
+        # edge_start有序，因此CSR的indices与edge_relation可直接复用边表
+        self.indptr = np.zeros(len(node_type) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edge_start, minlength=len(node_type)), out=self.indptr[1:])
+        self.indices = edge_end
+        self.edge_relation = edge_relation
+
+    @property
+    def idx_entity_type_dict(self):
+        return {idx: entity_type_list[code] for idx, code in enumerate(self.node_type.tolist()) if code >= 0}
+
+
+class KnowledgeGraph(CSRAdjacency):
     def __init__(self, data_dir):
         self._data_dir = data_dir
         # create knowledge graph
@@ -29,6 +147,7 @@ class KnowledgeGraph(object):
         self.degrees = {}
         self.compute_degrees()
         self.index_valid_test()
+        self.build_csr()
 
     def index_valid_test(self):
         # 我们要求所有的entity拥有全局唯一的id
@@ -46,6 +165,35 @@ class KnowledgeGraph(object):
                         if not (index_set.__contains__(index_2) and index_set.__contains__(index)):
                             raise ValueError('Error item index')
 
+    def build_csr(self):
+        """由G生成CSR数组，旧版本pickle出的对象没有这些数组，加载后需调用一次"""
+        num_nodes = max(self.idx_entity_type_dict) + 1
+        self.node_type = np.full(num_nodes, -1, dtype=np.int8)
+        for idx, entity_type in self.idx_entity_type_dict.items():
+            self.node_type[idx] = entity_type_list.index(entity_type)
+
+        degree = np.zeros(num_nodes, dtype=np.int64)
+        edge_list = []
+        for eid in range(num_nodes):
+            if self.node_type[eid] < 0:
+                continue
+            neighbors = self.G[entity_type_list[self.node_type[eid]]][eid]
+            edges = sorted((relation_list.index(r), next_id) for r in neighbors for next_id in neighbors[r])
+            degree[eid] = len(edges)
+            edge_list.extend(edges)
+        edge_list = np.array(edge_list, dtype=np.int64).reshape(-1, 2)
+        self.indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(degree, out=self.indptr[1:])
+        self.indices = edge_list[:, 1].astype(np.int32)
+        self.edge_relation = edge_list[:, 0].astype(np.int8)
+
+        # 名称表，下标即节点id，与CompiledKnowledgeGraph一致
+        names = [''] * num_nodes, [''] * num_nodes
+        for entity_type in entity_type_list:
+            for idx, _, chinese_name, english_name in self._data[entity_type]:
+                names[0][idx], names[1][idx] = chinese_name, english_name
+        self.chinese_name, self.english_name = np.array(names[0], dtype=str), np.array(names[1], dtype=str)
+
     def get_index_type(self, index):
         return self.idx_entity_type_dict[int(index)]
 
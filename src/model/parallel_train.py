@@ -0,0 +1,144 @@
+import os
+import sys
+src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(src)
+sys.path.append(os.path.join(src, 'model'))
+sys.path.append(os.path.join(src, 'data_preprocess'))
+
+import copy
+import csv
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
+import torch
+from knowledge_graph import KnowledgeGraph
+from model import kg_env, performance_eval, train_agent
+from kg_store import KGStore
+"""
+并行的五折交叉验证与超参数网格搜索
+每个(超参数组合, fold)作为一个独立任务提交到进程池，每个worker独占一段CPU核并限制torch线程数
+只读的KG和concept embedding在父进程中打包为KGStore并发布到共享内存，worker以零拷贝的方式挂载，不再重复反序列化
+"""
+
+
+def _init_worker(slot_queue, num_threads):
+    cores = slot_queue.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+
+
+def _run_job(args):
+    if not os.path.exists(args.save_path):
+        os.makedirs(args.save_path)
+    train_agent.get_train_logger().info(args)
+    train_agent.train(args)
+    results = performance_eval.test(args, 'test')
+    return [[args.hidden, args.gamma, args.ent_weight] + row for row in results]
+
+
+def build_jobs(args):
+    hidden_grid = [[int(item) for item in hidden.split(',')] for hidden in args.hidden_grid] \
+        if args.hidden_grid else [args.hidden]
+    gamma_grid = args.gamma_grid if args.gamma_grid else [args.gamma]
+    ent_weight_grid = args.ent_weight_grid if args.ent_weight_grid else [args.ent_weight]
+
+    job_list = []
+    for hidden, gamma, ent_weight in itertools.product(hidden_grid, gamma_grid, ent_weight_grid):
+        job_name = 'h{}_g{}_e{}'.format('-'.join(str(item) for item in hidden), gamma, ent_weight)
+        for test_fold_idx in args.folds:
+            job_args = copy.copy(args)
+            job_args.hidden = hidden
+            job_args.gamma = gamma
+            job_args.ent_weight = ent_weight
+            job_args.test_fold_idx = test_fold_idx
+            job_args.save_path = os.path.join(args.save_path, job_name, 'fold_{}'.format(test_fold_idx))
+            job_args.result_folder = job_args.save_path
+            # worker已独占threads个核，bootstrap不能再按#cores启动子进程
+            job_args.bootstrap_workers = max(1, args.threads_per_worker)
+            if args.trace_path is not None:
+                # 每个任务写出各自的trace
+                job_args.trace_path = os.path.join(job_args.save_path, os.path.basename(args.trace_path))
+            job_list.append(job_args)
+    return job_list
+
+
+def summarize(result_list):
+    """对每个(超参数组合, group)，计算各项指标在所有fold上的均值与标准差"""
+    metric_start = 3 + performance_eval.RESULT_HEAD.index('macro_auc')
+    grouped = dict()
+    for row in result_list:
+        key = (str(row[0]), row[1], row[2], row[5])
+        if key not in grouped:
+            grouped[key] = list()
+        grouped[key].append(np.array(row[metric_start:], dtype=float))
+
+    summary = []
+    for key in grouped:
+        value = np.vstack(grouped[key])
+        summary.append(list(key) + ['mean', len(value)] + np.mean(value, axis=0).tolist())
+        summary.append(list(key) + ['std', len(value)] + np.std(value, axis=0).tolist())
+    return summary
+
+
+def run_cross_validation(args):
+    # 父进程只加载一次只读资源，并发布到共享内存，各个任务通过shm://路径挂载
+    store = KGStore.from_kg(kg_env.load_kg(args.kg_path), kg_env.load_concept_embed(args.embed_path))
+    result_list = []
+    # publish之后的任何异常都要释放共享内存
+    try:
+        store_path = store.publish()
+        job_list = build_jobs(args)
+        for job_args in job_list:
+            job_args.kg_path = store_path
+            job_args.embed_path = store_path
+        # 使用本进程实际允许的CPU id（cpuset/Slurm/docker下不一定从0开始）
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        threads = max(1, args.threads_per_worker)
+        workers = args.workers if args.workers else max(1, min(len(job_list), len(cpus) // threads))
+
+        start_methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in start_methods else 'spawn')
+        slot_queue = context.Queue()
+        for worker_idx in range(workers):
+            slot_queue.put({cpus[(worker_idx * threads + i) % len(cpus)] for i in range(threads)})
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(slot_queue, threads)) as executor:
+            for rows in executor.map(_run_job, job_list):
+                result_list.extend(rows)
+    finally:
+        store.unlink()
+
+    data_to_write = [['hidden', 'gamma', 'ent_weight'] + performance_eval.RESULT_HEAD]
+    data_to_write.extend(result_list)
+    data_to_write.append([])
+    data_to_write.append(['hidden', 'gamma', 'ent_weight', 'group', 'statistic', 'num_fold'] +
+                         performance_eval.RESULT_HEAD[4:])
+    summary = summarize(result_list)
+    data_to_write.extend(summary)
+    save_path = os.path.join(args.result_folder, 'cv_result_{}.csv'.format(datetime.now().strftime('%Y%m%d%H%M%S')))
+    with open(save_path, 'w', encoding='utf-8-sig', newline='') as file:
+        csv.writer(file).writerows(data_to_write)
+    return result_list, summary
+
+
+def main():
+    parser = train_agent.get_parser()
+    parser.add_argument('--folds', type=int, nargs='*', default=[0, 1, 2, 3, 4])
+    parser.add_argument('--hidden_grid', type=str, nargs='*', default=None, help='e.g. 64,32 128,64')
+    parser.add_argument('--gamma_grid', type=float, nargs='*', default=None)
+    parser.add_argument('--ent_weight_grid', type=float, nargs='*', default=None)
+    parser.add_argument('--workers', type=int, default=None, help='default: #cores // threads_per_worker')
+    parser.add_argument('--threads_per_worker', type=int, default=1)
+    args = parser.parse_args()
+    args.device = 'cpu'
+    train_agent.resolve_representation(args)
+    run_cross_validation(args)
+
+
+if __name__ == '__main__':
+    main()
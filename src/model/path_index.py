@@ -0,0 +1,177 @@
+import os
+import sys
+src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(src)
+sys.path.append(os.path.join(src, 'model'))
+
+import argparse
+import json
+import numpy as np
+from experiment_util import SELF_LOOP, PATIENT
+from path_store import PathReader
+"""
+预测路径的查询索引，与path store一同生成，保存为一个目录下的若干npy数组，加载时以memmap方式打开
+路径去掉起点（患者）之后的(relation, node_type, node)序列称为pattern，pattern的最后一个节点即预测的终点疾病
+支持的查询:
+1. 某个疾病的路径，按路径概率降序（终点疾病 -> 患者/路径）
+2. 某个患者的路径，按路径概率降序
+3. pattern的频数、累计概率与覆盖患者数，可按终点疾病、经过的节点过滤
+"""
+
+INDEX_SUFFIX = '.pidx'
+_ARRAY_NAME = ['path_patient', 'path_prob', 'path_pattern', 'by_terminal', 'terminal_id', 'terminal_ptr',
+               'by_patient', 'patient_id', 'patient_ptr', 'pattern_relation', 'pattern_type', 'pattern_node',
+               'pattern_terminal', 'pattern_count', 'pattern_prob', 'pattern_patient']
+
+
+def _csr_group(key, prob):
+    """按(key升序, prob降序)排序，返回排序下标、各组的key与组边界"""
+    order = np.lexsort((-prob, key))
+    group_id, count = np.unique(key[order], return_counts=True)
+    ptr = np.zeros(len(group_id) + 1, dtype=np.int64)
+    np.cumsum(count, out=ptr[1:])
+    return order, group_id, ptr
+
+
+class PathIndex(object):
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.relation_vocab = self.meta['relation']
+        self.entity_vocab = self.meta['entity_type']
+        for name in _ARRAY_NAME:
+            setattr(self, name, np.load(os.path.join(folder, name + '.npy'), mmap_mode='r'))
+
+    @classmethod
+    def build(cls, path_file, folder=None):
+        """由PathWriter写出的文件建立索引，folder默认为path_file + INDEX_SUFFIX"""
+        folder = path_file + INDEX_SUFFIX if folder is None else folder
+        with PathReader(path_file) as reader:
+            chunks = list(reader.iter_chunks())
+            meta = {'source': os.path.basename(path_file), 'relation': reader.relation_vocab,
+                    'entity_type': reader.entity_vocab}
+        if len(set(chunk[0].shape[1] for chunk in chunks)) > 1:
+            raise ValueError('paths in one file should have the same length')
+        if len(chunks) == 0:
+            # 没有写入任何batch（如空的fold），建立空索引
+            chunks = [[np.zeros((0, 1), dtype=np.int32), np.zeros((0, 1), dtype=np.int8),
+                       np.zeros((0, 1), dtype=np.int8), np.zeros((0, 0), dtype=np.float32)]]
+        node, relation, node_type, prob = [np.concatenate([chunk[i] for chunk in chunks]) for i in range(4)]
+        path_patient = -1 * (node[:, 0].astype(np.int64) + 10000)
+        num_patient = int(path_patient.max()) + 1 if len(path_patient) > 0 else 1
+        path_prob = np.prod(prob.astype(np.float64), axis=1)
+
+        # pattern去重，终点疾病是pattern的一部分
+        key = np.concatenate([relation[:, 1:], node_type[:, 1:], node[:, 1:]], axis=1).astype(np.int64)
+        pattern_key, first, path_pattern = np.unique(key, axis=0, return_index=True, return_inverse=True)
+        path_pattern = path_pattern.reshape(-1)
+        hop = node.shape[1] - 1
+        num_pattern = len(pattern_key)
+        pattern_terminal = node[first, -1]
+        # 覆盖患者数: 不同的(pattern, patient)对的个数
+        pair = np.unique(path_pattern * num_patient + path_patient)
+        arrays = {
+            'path_patient': path_patient,
+            'path_prob': path_prob,
+            'path_pattern': path_pattern.astype(np.int32),
+            'pattern_relation': pattern_key[:, :hop].astype(np.int8),
+            'pattern_type': pattern_key[:, hop: 2 * hop].astype(np.int8),
+            'pattern_node': pattern_key[:, 2 * hop:].astype(np.int32),
+            'pattern_terminal': pattern_terminal,
+            'pattern_count': np.bincount(path_pattern, minlength=num_pattern),
+            'pattern_prob': np.bincount(path_pattern, weights=path_prob, minlength=num_pattern),
+            'pattern_patient': np.bincount(pair // num_patient, minlength=num_pattern),
+        }
+        arrays['by_terminal'], arrays['terminal_id'], arrays['terminal_ptr'] = _csr_group(node[:, -1], path_prob)
+        arrays['by_patient'], arrays['patient_id'], arrays['patient_ptr'] = _csr_group(path_patient, path_prob)
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        for name in _ARRAY_NAME:
+            np.save(os.path.join(folder, name + '.npy'), arrays[name])
+        meta['num_path'] = len(path_prob)
+        meta['num_pattern'] = num_pattern
+        with open(os.path.join(folder, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        return cls(folder)
+
+    def pattern(self, pattern_id):
+        """pattern对应的(relation, node_type, node)序列"""
+        return [(self.relation_vocab[r], self.entity_vocab[t], n) for r, t, n in
+                zip(self.pattern_relation[pattern_id].tolist(), self.pattern_type[pattern_id].tolist(),
+                    self.pattern_node[pattern_id].tolist())]
+
+    def path(self, path_id):
+        pat_idx = int(self.path_patient[path_id])
+        return [(SELF_LOOP, PATIENT, pat_idx * -1 - 10000)] + self.pattern(int(self.path_pattern[path_id]))
+
+    def _group_top(self, group_id, ptr, order, key, top):
+        pos = np.searchsorted(group_id, key)
+        if pos >= len(group_id) or group_id[pos] != key:
+            return []
+        path_ids = order[ptr[pos]: min(ptr[pos + 1], ptr[pos] + top)].tolist()
+        return [(int(self.path_patient[i]), float(self.path_prob[i]), self.path(i)) for i in path_ids]
+
+    def disease_paths(self, disease_id, top=10):
+        """:return: 以disease_id为终点、概率最高的top条路径 [(pat_idx, prob, path)]"""
+        return self._group_top(self.terminal_id, self.terminal_ptr, self.by_terminal, disease_id, top)
+
+    def patient_paths(self, pat_idx, top=5):
+        return self._group_top(self.patient_id, self.patient_ptr, self.by_patient, pat_idx, top)
+
+    def top_patterns(self, disease_id=None, node_id=None, relation=None, top=10, by='count'):
+        """
+        :param disease_id: 只保留以该疾病为终点的pattern
+        :param node_id, relation: 只保留经过该节点（且以relation到达该节点）的pattern
+        :param by: count（路径数）, prob（累计路径概率）或patient（覆盖患者数）
+        :return: [(pattern_id, count, prob_sum, num_patient, pattern)]
+        """
+        score = {'count': self.pattern_count, 'prob': self.pattern_prob, 'patient': self.pattern_patient}[by]
+        keep = np.ones(len(score), dtype=bool)
+        if disease_id is not None:
+            keep &= self.pattern_terminal == disease_id
+        if node_id is not None:
+            hit = self.pattern_node == node_id
+            if relation is not None:
+                hit &= self.pattern_relation == self.relation_vocab.index(relation)
+            keep &= np.any(hit, axis=1)
+        candidate = np.nonzero(keep)[0]
+        if len(candidate) > top:
+            candidate = candidate[np.argpartition(-score[candidate], top - 1)[:top]]
+        candidate = candidate[np.argsort(-score[candidate], kind='stable')]
+        return [(int(i), int(self.pattern_count[i]), float(self.pattern_prob[i]), int(self.pattern_patient[i]),
+                 self.pattern(i)) for i in candidate]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help='.paths file, or its index folder')
+    parser.add_argument('--disease', type=int, default=None)
+    parser.add_argument('--patient', type=int, default=None)
+    parser.add_argument('--node', type=int, default=None)
+    parser.add_argument('--by', type=str, default='count', help='count, prob or patient')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.path.endswith(INDEX_SUFFIX):
+        index = PathIndex(args.path)
+    elif os.path.exists(args.path + INDEX_SUFFIX):
+        index = PathIndex(args.path + INDEX_SUFFIX)
+    else:
+        index = PathIndex.build(args.path)
+    print('{} paths, {} patterns'.format(index.meta['num_path'], index.meta['num_pattern']))
+    if args.patient is not None:
+        for pat_idx, prob, path in index.patient_paths(args.patient, args.top):
+            print('{:.6f}'.format(prob), path)
+        return
+    if args.disease is not None and args.node is None:
+        for pat_idx, prob, path in index.disease_paths(args.disease, args.top):
+            print(pat_idx, '{:.6f}'.format(prob), path)
+    for pattern_id, count, prob, num_patient, pattern in index.top_patterns(args.disease, args.node, top=args.top,
+                                                                            by=args.by):
+        print(count, '{:.4f}'.format(prob), num_patient, pattern)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+import os
+import sys
+src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(src)
+sys.path.append(os.path.join(src, 'model'))
+
+import argparse
+import json
+import struct
+import zlib
+import numpy as np
+from experiment_util import relation_list, entity_type_list, SELF_LOOP, HAVE, PATIENT
+"""
+beam search预测路径的二进制存储，代替原先逐行写出tuple字符串的CSV
+每个batch的路径作为一个chunk追加写入（可选zlib压缩），关闭时写出按患者排序的索引，读取单个患者时只解压其所在的chunk
+布局: MAGIC | header长度(uint32) | JSON header | chunk ... | 索引数组 | JSON footer | footer长度(uint32) | MAGIC
+chunk内依次为 node int32 [n_path, path_len], relation int8 [n_path, path_len], node_type int8 [n_path, path_len],
+prob float32 [n_path, path_len - 1]，同一chunk内的路径长度相同，同一患者的路径连续
+"""
+
+MAGIC = b'PBXPTH'
+FORMAT_VERSION = 1
+FILE_SUFFIX = '.paths'
+RELATION_VOCAB = relation_list + [SELF_LOOP, HAVE]
+ENTITY_VOCAB = entity_type_list + [PATIENT]
+_CHUNK_DTYPE = [('node', np.int32), ('relation', np.int8), ('node_type', np.int8), ('prob', np.float32)]
+_INDEX_DTYPE = [('patient', np.int64), ('chunk', np.int32), ('start', np.int32), ('end', np.int32)]
+
+
+def _pat_idx(node_id):
+    # 与BatchKGEnvironment.reset中的编码相反
+    return -1 * (node_id + 10000)
+
+
+class PathWriter(object):
+    """
+    with PathWriter(path) as writer:
+        writer.write_batch(paths, probs)
+    paths, probs与batch_beam_search的返回值相同
+    """
+    def __init__(self, path, compress=True, level=6):
+        self.path = path
+        self.level = level if compress else 0
+        self._file = open(path, 'wb')
+        header = json.dumps({'version': FORMAT_VERSION, 'relation': RELATION_VOCAB, 'entity_type': ENTITY_VOCAB,
+                             'compress': bool(compress)}).encode('utf-8')
+        self._file.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self._chunk = []  # (offset, nbytes, n_path, path_len)
+        self._index = []
+
+    def write_batch(self, paths, probs):
+        if len(paths) == 0:
+            return
+        path_len = len(paths[0])
+        if any(len(path) != path_len for path in paths):
+            raise ValueError('paths in one batch should have the same length')
+        flat = [item for path in paths for item in path]
+        node = np.array([item[2] for item in flat], dtype=np.int32).reshape(-1, path_len)
+        relation = np.array([RELATION_VOCAB.index(item[0]) for item in flat], dtype=np.int8).reshape(-1, path_len)
+        node_type = np.array([ENTITY_VOCAB.index(item[1]) for item in flat], dtype=np.int8).reshape(-1, path_len)
+        # 零跳时每条路径只有患者节点，probs均为空list
+        prob = np.array(probs, dtype=np.float32).reshape(len(paths), path_len - 1)
+        self.write_arrays(node, relation, node_type, prob)
+
+    def write_arrays(self, node, relation, node_type, prob):
+        """以数组的形式写入一个chunk，同一患者的路径必须相邻"""
+        patient = _pat_idx(node[:, 0].astype(np.int64))
+        boundary = np.nonzero(np.diff(patient))[0] + 1
+        start = np.concatenate([[0], boundary])
+        end = np.concatenate([boundary, [len(patient)]])
+        chunk_idx = len(self._chunk)
+        for s, e in zip(start.tolist(), end.tolist()):
+            self._index.append((int(patient[s]), chunk_idx, s, e))
+
+        data = b''.join(np.ascontiguousarray(array, dtype=dtype).tobytes()
+                        for array, (_, dtype) in zip([node, relation, node_type, prob], _CHUNK_DTYPE))
+        if self.level > 0:
+            data = zlib.compress(data, self.level)
+        self._chunk.append((self._file.tell(), len(data), len(node), node.shape[1]))
+        self._file.write(data)
+
+    def close(self):
+        if self._file is None:
+            return
+        try:
+            index = np.array(self._index, dtype=_INDEX_DTYPE)
+            index = index[np.argsort(index['patient'], kind='stable')]
+            if len(np.unique(index['patient'])) != len(index):
+                raise ValueError('paths of one patient should be written in one batch')
+            chunk = np.array(self._chunk, dtype=np.int64).reshape(-1, 4)
+            footer = {'index': [self._file.tell(), len(index)]}
+            self._file.write(index.tobytes())
+            footer['chunk'] = [self._file.tell(), len(chunk)]
+            self._file.write(chunk.tobytes())
+            footer = json.dumps(footer).encode('utf-8')
+            self._file.write(footer + struct.pack('<I', len(footer)) + MAGIC)
+        finally:
+            self._file.close()
+            self._file = None
+
+    def abort(self):
+        """不写索引和footer直接关闭，PathReader会以未正常关闭为由拒绝该文件"""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # with块内抛出异常时路径不完整，不能写出看似完整的文件
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class PathReader(object):
+    """只读取索引，按患者随机访问，get返回与batch_beam_search相同结构的(paths, probs)"""
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a path store: {}'.format(path))
+        header_len = struct.unpack('<I', self._file.read(4))[0]
+        self.header = json.loads(self._file.read(header_len).decode('utf-8'))
+        if self.header['version'] != FORMAT_VERSION:
+            raise ValueError('unsupported path store version: {}'.format(self.header['version']))
+
+        self._file.seek(-4 - len(MAGIC), os.SEEK_END)
+        footer_len = struct.unpack('<I', self._file.read(4))[0]
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('path store was not closed properly: {}'.format(path))
+        self._file.seek(-4 - len(MAGIC) - footer_len, os.SEEK_END)
+        footer = json.loads(self._file.read(footer_len).decode('utf-8'))
+        self._file.seek(footer['index'][0])
+        self.index = np.fromfile(self._file, dtype=_INDEX_DTYPE, count=footer['index'][1])
+        self._file.seek(footer['chunk'][0])
+        self.chunk = np.fromfile(self._file, dtype=np.int64, count=footer['chunk'][1] * 4).reshape(-1, 4)
+        self.relation_vocab = self.header['relation']
+        self.entity_vocab = self.header['entity_type']
+        self._cache = (None, None)
+
+    @property
+    def patient_ids(self):
+        return self.index['patient']
+
+    def __len__(self):
+        return len(self.index)
+
+    def read_chunk(self, chunk_idx):
+        """:return: node, relation, node_type, prob 四个数组"""
+        if self._cache[0] == chunk_idx:
+            return self._cache[1]
+        offset, nbytes, n_path, path_len = self.chunk[chunk_idx].tolist()
+        self._file.seek(offset)
+        data = self._file.read(nbytes)
+        if self.header['compress']:
+            data = zlib.decompress(data)
+        arrays, start = [], 0
+        for (_, dtype), width in zip(_CHUNK_DTYPE, [path_len, path_len, path_len, path_len - 1]):
+            size = n_path * width * np.dtype(dtype).itemsize
+            arrays.append(np.frombuffer(data, dtype=dtype, count=n_path * width, offset=start).reshape(n_path, width))
+            start += size
+        self._cache = (chunk_idx, arrays)
+        return arrays
+
+    def get_arrays(self, pat_idx):
+        pos = np.searchsorted(self.index['patient'], pat_idx)
+        if pos >= len(self.index) or self.index['patient'][pos] != pat_idx:
+            return None
+        _, chunk_idx, start, end = self.index[pos].tolist()
+        return [array[start: end] for array in self.read_chunk(chunk_idx)]
+
+    def get(self, pat_idx):
+        arrays = self.get_arrays(pat_idx)
+        if arrays is None:
+            return [], []
+        node, relation, node_type, prob = [array.tolist() for array in arrays]
+        paths = [[(self.relation_vocab[r], self.entity_vocab[t], n) for r, t, n in zip(*item)]
+                 for item in zip(relation, node_type, node)]
+        return paths, prob
+
+    def iter_chunks(self):
+        for chunk_idx in range(len(self.chunk)):
+            yield self.read_chunk(chunk_idx)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str)
+    parser.add_argument('--patient', type=int, nargs='*', default=None, help='default: print summary only')
+    args = parser.parse_args()
+
+    with PathReader(args.path) as reader:
+        print('{} patients, {} chunks'.format(len(reader), len(reader.chunk)))
+        for pat_idx in args.patient or []:
+            paths, probs = reader.get(pat_idx)
+            for path, prob in zip(paths, probs):
+                print(path, prob)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,69 @@
 from __future__ import absolute_import, division, print_function
 import csv
+import sys
 from model.kg_env import BatchKGEnvironment
+from model.path_store import PathWriter, FILE_SUFFIX as PATH_FILE_SUFFIX
+from model.path_index import PathIndex
 from model.train_agent import *
+import profiler
+from profiler import PROFILER
 import numpy as np
 import torch
 import experiment_util as util
 
-
-def acts_pool_to_mask(act_pool):
-    act_mask_list = []
-    for candidates in act_pool:
-        mask = np.zeros([65])
-        for act in candidates:
-            idx = act[1]
-            assert 0 <= idx < 65
-            mask[idx] = 1
-        act_mask_list.append(mask)
-    mask = np.vstack(act_mask_list)
-    return mask
-
-
-def batch_beam_search(env, model, test_pat_embed, test_interact, batch_pat_ids, max_len, device, topk):
+RESULT_HEAD = ['model_name', 'fold', 'group', 'train/test', 'macro_auc', 'micro_auc', 'micro_f1', 'macro_f1',
+               'micro_avg_precision', 'macro_avg_precision', 'coverage', 'ranking_loss', 'hamming', 'top_1_num',
+               'top_3_num', 'top_5_num', 'top_10_num', 'top_20_num', 'top_30_num', 'top_40_num', 'top_50_num']
+CI_HEAD = RESULT_HEAD[:4] + ['statistic'] + RESULT_HEAD[4:]
+# 每条路径的固定开销: path与probs两个list对象、新增的(relation, type, id) tuple与概率标量（其余tuple在路径间共享）
+_PATH_OVERHEAD = 2 * sys.getsizeof([]) + sys.getsizeof((0, 0, 0)) + sys.getsizeof(np.float32(0))
+
+
+class FrontierBudgetError(MemoryError):
+    """beam search下一跳的frontier估算内存超过预算，抛出时新的frontier尚未分配"""
+    def __init__(self, hop, num_paths, num_bytes, budget):
+        super(FrontierBudgetError, self).__init__(
+            'hop {}: {} paths need ~{:.3f} MB, budget {:.3f} MB'.format(hop, num_paths, num_bytes / 1024 ** 2,
+                                                                      budget / 1024 ** 2))
+        self.hop = hop
+        self.num_paths = num_paths
+        self.num_bytes = num_bytes
+        self.budget = budget
+
+
+def action_width(env):
+    """act_mask列数的上界，dense模式为KG节点数，sparse模式为最大出度加自环，剪枝时不超过max_candidates + 1"""
+    if not env.action_space.sparse:
+        return env.max_acts
+    width = int(np.max(np.diff(env.kg.indptr))) + 1
+    if env.max_candidates is not None:
+        width = min(width, env.max_candidates + 1)
+    return min(width, env.max_acts)
+
+
+def frontier_bytes(env, num_paths, path_len, last_hop):
+    """
+    估算num_paths条长度为path_len的路径占用的内存: path与probs（list中每个元素8字节）、state（float64）及其float32的Tensor，
+    不是最后一跳时还包括下一跳policy前向的act_mask（int64）、logits与概率（float32）
+    """
+    per_path = _PATH_OVERHEAD + 8 * (2 * path_len - 1) + env.state_dim * (8 + 4)
+    if not last_hop:
+        per_path += action_width(env) * (8 + 4 + 4)
+    return num_paths * per_path
+
+
+@PROFILER.timed('beam_search')
+def batch_beam_search(env, model, test_pat_embed, test_interact, batch_pat_ids, max_len, device, topk,
+                      beam_mass=None, beam_min_prob=None, max_beams=None, memory_budget=None, frontier_stats=None):
+    """
+    beam_mass, beam_min_prob, max_beams均为None时为固定宽度的beam，每条路径扩展topk[hop]个子节点
+    否则为自适应beam，在top-k子节点中进一步剪枝（每条路径至少保留概率最高的子节点）:
+    beam_mass: 按单步概率降序保留子节点，直到累计概率达到beam_mass
+    beam_min_prob: 丢弃单步概率低于beam_min_prob的子节点
+    max_beams: 每一跳之后，每个患者最多保留路径概率最高的max_beams条路径
+    memory_budget: 每一跳扩展之前，按保留的子节点数估算新旧frontier的内存（bytes），超出时抛出FrontierBudgetError
+    frontier_stats: 可选的list，每一跳追加(扩展后的路径数, 估算的峰值内存)
+    """
     # id embedding mapping, 由于可选path会增长，因此需要构建合适的映射，在必要的时候映射回其idx
     id_pat_dict = dict()
     for idx in range(len(batch_pat_ids)):
@@ -35,78 +78,185 @@ def batch_beam_search(env, model, test_pat_embed, test_interact, batch_pat_ids,
         # 此处获得的是每个batch对应的node的可选action列表（可选Action数量已经被限制在max_act范围内）
         acts_pool = env.batch_get_actions(path_pool, False, test_interact)
         # 测试阶段不做mask，此处仅仅是点出存在的act
-        act_mask_pool = acts_pool_to_mask(acts_pool)
-        act_mask_tensor = torch.from_numpy(act_mask_pool).clone().long().to(device)
+        act_mask_tensor, cand_ids = env.action_space.to_tensor(acts_pool, device)
         # 此处获得的是单步每个动作的prob，然后找出顺位最高的几个
-        probs, _ = model((state_tensor, act_mask_tensor))  # Tensor of [bs, act_dim]
-        topk_probs, topk_idxs = torch.topk(probs, topk[hop], dim=1)  # LongTensor of [bs, k]
-        topk_idxs = topk_idxs.detach().clone().cpu().numpy()
+        probs, _ = model((state_tensor, act_mask_tensor, cand_ids))  # Tensor of [bs, act_dim]
+        # sparse模式下列数可能少于topk
+        topk_probs, topk_cols = torch.topk(probs, min(topk[hop], probs.shape[1]), dim=1)  # LongTensor of [bs, k]
+        topk_valid = act_mask_tensor.gather(1, topk_cols).cpu().numpy()
+        topk_idxs = env.action_space.to_global(topk_cols, cand_ids).detach().clone().cpu().numpy()
         topk_probs = topk_probs.detach().clone().cpu().numpy()
-
-        new_path_pool, new_probs_pool = [], []
-        reverse_dict = dict()
-        new_pool_idx = 0
-        for row in range(len(topk_idxs)):
-            path = path_pool[row]
-            probs = probs_pool[row]
-            for global_idx, p in zip(topk_idxs[row], topk_probs[row]):
-                if act_mask_pool[row][global_idx] == 0:
-                    # 当遇到非法路径时跳过
-                    continue
-                act_idx = -9999999
-                reverse_dict[new_pool_idx] = row
-                new_pool_idx += 1
-
-                assert 0 <= global_idx < 65
-                for idx in range(len(acts_pool[row])):
-                    if global_idx == acts_pool[row][idx][1]:
-                        assert act_idx == -9999999
-                        act_idx = idx
-                assert act_idx != -9999999
-
-                relation, next_node_id = acts_pool[row][act_idx]  # (relation, next_node_id)
-                if relation == util.SELF_LOOP:
-                    next_node_type = path[-1][1]
-                else:
-                    next_node_type = env.kg.get_index_type(next_node_id)
-                new_path = path + [(relation, next_node_type, next_node_id)]
-                new_path_pool.append(new_path)
-                new_probs_pool.append(probs + [p])
-        path_pool = new_path_pool
-        probs_pool = new_probs_pool
+        topk_keep = topk_valid != 0
+        if beam_min_prob is not None:
+            topk_keep[:, 1:] &= topk_probs[:, 1:] >= beam_min_prob
+        if beam_mass is not None:
+            # 加入该子节点之前累计概率已达到beam_mass的子节点被剪掉
+            topk_keep &= np.cumsum(topk_probs, axis=1) - topk_probs < beam_mass
+
+        # 扩展期间旧frontier（含本跳的act_mask与概率）与新frontier同时存在
+        num_paths = int(topk_keep.sum())
+        num_bytes = frontier_bytes(env, len(path_pool), hop + 1, False) + \
+            frontier_bytes(env, num_paths, hop + 2, hop == max_len - 1)
+        if memory_budget is not None and num_bytes > memory_budget:
+            raise FrontierBudgetError(hop, num_paths, num_bytes, memory_budget)
+        if frontier_stats is not None:
+            frontier_stats.append((num_paths, num_bytes))
+        path_pool, probs_pool = _expand_beams(env, path_pool, probs_pool, acts_pool, topk_idxs, topk_probs,
+                                              topk_keep)
+        if max_beams is not None:
+            path_pool, probs_pool = _cap_beams(path_pool, probs_pool, max_beams)
 
         state_pool = env.batch_get_state(path_pool, test_pat_embed, id_pat_dict)
     return path_pool, probs_pool
 
 
-def predict_paths(policy_file, test_pat_embed, test_interact, args):
+@PROFILER.timed('beam_expand')
+def _expand_beams(env, path_pool, probs_pool, acts_pool, topk_idxs, topk_probs, topk_keep):
+    """按每行保留的top-k子节点扩展路径，返回新的path_pool与probs_pool"""
+    new_path_pool, new_probs_pool = [], []
+    for row in range(len(topk_idxs)):
+        path = path_pool[row]
+        probs = probs_pool[row]
+        # 节点id -> 动作下标，每行只建一次，按照设计同一节点只能对应一个动作
+        act_position = {item[1]: idx for idx, item in enumerate(acts_pool[row])}
+        assert len(act_position) == len(acts_pool[row])
+        for global_idx, p, keep in zip(topk_idxs[row].tolist(), topk_probs[row], topk_keep[row]):
+            if not keep:
+                # 当遇到非法路径（或被自适应beam剪掉的路径）时跳过
+                continue
+            assert 0 <= global_idx < env.max_acts
+            relation, next_node_id = acts_pool[row][act_position[global_idx]]  # (relation, next_node_id)
+            if relation == util.SELF_LOOP:
+                next_node_type = path[-1][1]
+            else:
+                next_node_type = env.kg.get_index_type(next_node_id)
+            new_path = path + [(relation, next_node_type, next_node_id)]
+            new_path_pool.append(new_path)
+            new_probs_pool.append(probs + [p])
+    PROFILER.count('beam_paths', len(new_path_pool))
+    return new_path_pool, new_probs_pool
+
+
+def _cap_beams(path_pool, probs_pool, max_beams):
+    """每个患者保留路径概率最高的max_beams条路径，同一患者的路径保持相邻且顺序不变"""
+    path_prob = np.array([np.prod(probs) for probs in probs_pool])
+    patient = np.array([path[0][2] for path in path_pool])
+    order = np.lexsort((-path_prob, patient))
+    group_start = np.searchsorted(patient[order], patient[order])
+    keep = np.sort(order[np.arange(len(order)) - group_start < max_beams])
+    return [path_pool[i] for i in keep.tolist()], [probs_pool[i] for i in keep.tolist()]
+
+
+def retained_mass(paths, probs, num_pat):
+    """每个患者保留下来的路径概率之和，即beam覆盖的概率质量，完整展开时为1"""
+    pat_idx = [(path[0][2] + 10000) * -1 for path in paths]
+    path_prob = [np.prod(prob_list) for prob_list in probs]
+    return np.bincount(pat_idx, weights=path_prob, minlength=num_pat)
+
+
+def disease_index(kg):
+    """KG中疾病节点的id（升序），即打分与标签中参与评估的列"""
+    return np.nonzero(kg.node_type == util.entity_type_list.index(util.DISEASE))[0]
+
+
+def add_path_score(score, paths, probs, is_disease):
+    """将一个batch的路径概率累加到终点疾病上，score: [#patient, #KG node]，is_disease: [#KG node] bool"""
+    for path, prob_list in zip(paths, probs):
+        pat_idx = (path[0][2]+10000)*-1
+        assert pat_idx >= 0
+        if path[-1][1] != util.DISEASE:
+            continue
+        disease_idx = path[-1][2]
+        assert is_disease[disease_idx]
+        prob = 1
+        for item in prob_list:
+            prob *= item
+        assert 0 <= prob <= 1
+        score[pat_idx, disease_idx] += prob
+
+
+def predict_paths(policy_file, test_pat_embed, test_interact, args, writer=None):
+    """
+    writer: 可选的PathWriter，每个batch的路径在beam search之后立即写出
+    每个batch的路径写出后即累加到打分矩阵与保留的概率质量中，随后释放，路径只保留在writer中
+    args.memory_budget（MB）不为None时，frontier超出预算的batch减半重试，
+    之后按上一个batch中每个患者的峰值占用调整batch大小（不超过args.batch_size）
+    :return: dict, score: [#patient, #KG node]的路径概率之和, disease_idx: 疾病节点id, retained_mass, num_paths,
+        以及每一跳的峰值frontier
+    """
     print('Predicting paths...')
     env = BatchKGEnvironment(args.kg_path, args.embed_path, args.max_acts, args.max_path_len, len(test_pat_embed[0]),
-                             args.history_len)
+                             args.history_len, sparse_action=args.sparse_action,
+                             max_candidates=args.max_candidates, prune_by=args.prune_by)
+    if args.max_candidates is not None and args.prune_by == 'similarity':
+        # 必须使用训练时的聚类，不能在测试患者上重新拟合
+        cluster_file = os.path.join(os.path.dirname(policy_file), 'patient_cluster.npy')
+        if not os.path.exists(cluster_file):
+            raise ValueError('patient clusters of the policy not found: {}'.format(cluster_file))
+        env.set_patient_cluster(np.load(cluster_file))
     pre_train_model = torch.load(policy_file)
 
-    model = ActorCritic(env.state_dim, env.max_acts, gamma=args.gamma, hidden_sizes=args.hidden).to(args.device)
+    model = ActorCritic(env.state_dim, env.max_acts, gamma=args.gamma, hidden_sizes=args.hidden,
+                        concept_embeds=env.embeds if args.sparse_action else None).to(args.device)
     model_sd = model.state_dict()
     model_sd.update(pre_train_model)
     model.load_state_dict(model_sd)
     model.eval()
 
     test_pat_ids = [i for i in range(len(test_interact))]
+    budget = None if args.memory_budget is None else args.memory_budget * 1024 ** 2
 
     start_idx = 0
-    all_paths, all_probs = [], []
+    batch_size = args.batch_size
+    score = np.zeros((len(test_pat_ids), env.kg.num_nodes))
+    disease_idx = disease_index(env.kg)
+    is_disease = np.zeros(env.kg.num_nodes, dtype=bool)
+    is_disease[disease_idx] = True
+    mass = np.zeros(len(test_pat_ids))
+    num_paths = 0
+    frontier = np.zeros((args.max_path_len, 2))  # 每一跳的最大路径数与估算的峰值内存
     while start_idx < len(test_pat_ids):
-        print('current index: {}'.format(start_idx))
-        end_idx = min(start_idx + args.batch_size, len(test_pat_ids))
+        print('current index: {}, batch size: {}'.format(start_idx, batch_size))
+        end_idx = min(start_idx + batch_size, len(test_pat_ids))
         batch_id = test_pat_ids[start_idx:end_idx]
         batch_interact = test_interact[batch_id]
         batch_embed = test_pat_embed[batch_id]
-        paths, probs = batch_beam_search(env, model, batch_embed, batch_interact, batch_id, args.max_path_len,
-                                         args.device, topk=args.topk)
-        all_paths.extend(paths)
-        all_probs.extend(probs)
+        frontier_stats = []
+        try:
+            paths, probs = batch_beam_search(env, model, batch_embed, batch_interact, batch_id, args.max_path_len,
+                                             args.device, topk=args.topk, beam_mass=args.beam_mass,
+                                             beam_min_prob=args.beam_min_prob, max_beams=args.max_beams,
+                                             memory_budget=budget, frontier_stats=frontier_stats)
+        except FrontierBudgetError as e:
+            if len(batch_id) == 1:
+                raise MemoryError('{} for a single patient, reduce --topk or use --beam_mass / --beam_min_prob'
+                                  .format(e))
+            batch_size = len(batch_id) // 2
+            print('{}, retry with batch size {}'.format(e, batch_size))
+            continue
+        # max_path_len为0时没有扩展，frontier_stats为空
+        frontier = np.maximum(frontier, np.array(frontier_stats).reshape(-1, 2))
+        if budget is not None and frontier_stats:
+            # 留出10%的余量
+            per_patient = max(item[1] for item in frontier_stats) / len(batch_id)
+            batch_size = int(min(args.batch_size, max(1, 0.9 * budget / per_patient)))
+        if writer is not None:
+            with PROFILER.section('path_write'):
+                writer.write_batch(paths, probs)
+        with PROFILER.section('path_score'):
+            add_path_score(score, paths, probs, is_disease)
+            mass += retained_mass(paths, probs, len(test_pat_ids))
+        num_paths += len(paths)
+        del paths, probs
         start_idx = end_idx
-    predicts = {'paths': all_paths, 'probs': all_probs}
+    predicts = {'score': score, 'disease_idx': disease_idx, 'retained_mass': mass, 'num_paths': num_paths}
+    predicts['frontier_paths'] = frontier[:, 0].astype(int)
+    predicts['frontier_bytes'] = frontier[:, 1].astype(int)
+    print('paths: {}, retained probability mass: mean {:.4f}, min {:.4f}'.format(
+        num_paths, np.mean(predicts['retained_mass']), np.min(predicts['retained_mass'])))
+    for hop in range(args.max_path_len):
+        print('hop {}: peak frontier {} paths, ~{:.2f} MB'.format(hop, predicts['frontier_paths'][hop],
+                                                                   predicts['frontier_bytes'][hop] / 1024 ** 2))
     return predicts
 
 
@@ -160,8 +310,9 @@ def read_group(data_path, omit):
 
 
 def test(args, mode):
-    policy_file = os.path.abspath('../../resource/agent/policy_model_epoch_{}.ckpt'.format(args.epochs))
-    path = os.path.abspath('../../resource/path_predicts_{}.csv'.format(datetime.now().strftime('%Y%m%d%H%M%S')))
+    policy_file = os.path.join(args.save_path, 'policy_model_epoch_{}.ckpt'.format(args.epochs))
+    path = os.path.join(args.result_folder, 'path_predicts_{}{}'.format(datetime.now().strftime('%Y%m%d%H%M%S'),
+                                                                      PATH_FILE_SUFFIX))
 
     train_pat_embed, train_interact, train_label, train_id, test_pat_embed, test_interact, test_label, test_id = \
         read_patient_representation_and_label(info_folder=args.data_path,
@@ -169,89 +320,119 @@ def test(args, mode):
                                               test_idx=args.test_fold_idx, data_source=args.data_source,
                                               omit_duplicate_disease=args.omit_duplicate)
     group = read_group(args.data_path, omit=args.omit_duplicate)
+    results = None
+    # 训练结束后的统计不计入评估
+    PROFILER.reset()
     if args.run_path:
         if mode == 'test':
-            predicts = predict_paths(policy_file, test_pat_embed, test_interact, args)
-            performance_evaluation(predicts, test_label, args.test_fold_idx, group, args, mode)
-            save_paths(predicts, path)
+            with PathWriter(path) as writer:
+                predicts = predict_paths(policy_file, test_pat_embed, test_interact, args, writer)
+            with PROFILER.section('path_index'):
+                PathIndex.build(path)
+            results = performance_evaluation(predicts, test_label, args.test_fold_idx, group, args, mode)
         elif mode == 'train':
-            predicts = predict_paths(policy_file, train_pat_embed, train_interact, args)
-            performance_evaluation(predicts, train_label, args.test_fold_idx, group, args, mode)
-            save_paths(predicts, path)
+            with PathWriter(path) as writer:
+                predicts = predict_paths(policy_file, train_pat_embed, train_interact, args, writer)
+            with PROFILER.section('path_index'):
+                PathIndex.build(path)
+            results = performance_evaluation(predicts, train_label, args.test_fold_idx, group, args, mode)
         else:
             raise ValueError('')
+    if PROFILER.enabled:
+        print(PROFILER.report('eval'))
+    if args.trace_path is not None:
+        # 不覆盖训练阶段写出的trace，评估的trace包含同一次运行中训练阶段的事件
+        trace_path = profiler.trace_file(args.trace_path, mode)
+        print('{} trace events saved to {}'.format(PROFILER.save_trace(trace_path), trace_path))
+    return results
+
+
+def path_score(score, disease_idx):
+    """以终点疾病上的路径概率之和（predict_paths累加的score）作为打分，只取disease_idx列，按患者归一化"""
+    score = score[:, disease_idx]
+    score_sum = np.sum(score, axis=1) + 0.000000000001
+    return (score.transpose() / score_sum).transpose()
 
 
-def save_paths(predicts, save_path):
-    data_to_write = []
-    for idx in range(len(predicts['paths'])):
-        paths = predicts['paths'][idx]
-        probs = predicts['probs'][idx]
-        line_1 = []
-        line_2 = ['']
-        line_3 = []
-        for item in paths:
-            line_1.append(item)
-        for item in probs:
-            line_2.append(item)
-        data_to_write.append(line_1)
-        data_to_write.append(line_2)
-        data_to_write.append(line_3)
-    with open(save_path, 'w', encoding='utf-8-sig', newline='') as file:
-        csv.writer(file).writerows(data_to_write)
-
-
-def performance_evaluation(predicts_list, label, data_type, group, args, mode, cut_idx=(7, 60)):
-    score = np.zeros(label.shape)
-    for idx in range(len(predicts_list['paths'])):
-        path = predicts_list['paths'][idx]
-        prob_list = predicts_list['probs'][idx]
-        pat_idx = (path[0][2]+10000)*-1
-        assert pat_idx >= 0
-        if path[-1][1] != util.DISEASE:
-            continue
-        disease_idx = path[-1][2]
-        assert 7 <= disease_idx < 60
-        prob = 1
-        for item in prob_list:
-            prob *= item
-        assert 0 <= prob <= 1
-        score[pat_idx, disease_idx] += prob
-    score = score[:, cut_idx[0]: cut_idx[1]]
-    score_sum = np.sum(score, axis=1) + 0.000000000001
-    pred = (score.transpose() / score_sum).transpose()
+def performance_evaluation(predicts_list, label, data_type, group, args, mode):
+    disease_idx = predicts_list['disease_idx']
+    pred = path_score(predicts_list['score'], disease_idx)
     print(np.sum(pred, axis=1))
-    label = label[:, cut_idx[0]: cut_idx[1]]
+    label = label[:, disease_idx]
     print(np.sum(label))
 
     data_to_write = []
     for arg in vars(args):
         data_to_write.append([arg, getattr(args, arg)])
+    if 'retained_mass' in predicts_list:
+        data_to_write.append(['retained_mass', float(np.mean(predicts_list['retained_mass']))])
+    if 'frontier_paths' in predicts_list:
+        data_to_write.append(['peak_frontier_paths'] + predicts_list['frontier_paths'].tolist())
+        data_to_write.append(['peak_frontier_mb'] + (predicts_list['frontier_bytes'] / 1024 ** 2).tolist())
 
-    head = ['model_name', 'fold', 'group', 'train/test', 'macro_auc', 'micro_auc', 'micro_f1', 'macro_f1',
-            'micro_avg_precision', 'macro_avg_precision', 'coverage', 'ranking_loss', 'hamming', 'top_1_num',
-            'top_3_num', 'top_5_num', 'top_10_num', 'top_20_num', 'top_30_num', 'top_40_num', 'top_50_num']
-    data_to_write.append(head)
+    data_to_write.append(RESULT_HEAD)
 
     if mode == 'test':
         test_fold_idx = args.test_fold_idx
     else:
         test_fold_idx = '/'
+    results = []
+    with PROFILER.section('metric'):
+        group_result = util.group_metric(pred.transpose(), label.transpose(), group)
     for key in group:
-        macro_auc, micro_auc, micro_f1, macro_f1, micro_avg_precision, macro_avg_precision, coverage, \
-            ranking_loss, hamming, top_1_num, top_3_num, top_5_num, top_10_num, top_20_num, top_30_num, top_40_num,\
-            top_50_num = util.metric(pred.transpose(), label.transpose(), group[key])
-        data_to_write.append(['PBXAI', test_fold_idx, key, data_type, macro_auc, micro_auc, micro_f1, macro_f1,
-                              micro_avg_precision, macro_avg_precision, coverage, ranking_loss, hamming, top_1_num,
-                              top_3_num, top_5_num, top_10_num, top_20_num, top_30_num, top_40_num, top_50_num])
-    with open(os.path.abspath('../../resource/pbxai_result_{}.csv'.format(datetime.now().strftime('%Y%m%d%H%M%S'))),
+        results.append(['PBXAI', test_fold_idx, key, data_type] + list(group_result[key]))
+    data_to_write.extend(results)
+    if args.bootstrap > 0:
+        # bootstrap百分位置信区间，区间水平为95%
+        with PROFILER.section('bootstrap'):
+            ci = util.bootstrap_metric(pred.transpose(), label.transpose(), group, args.bootstrap,
+                                       workers=args.bootstrap_workers)
+        data_to_write.append([])
+        data_to_write.append(CI_HEAD)
+        for key in group:
+            data_to_write.append(['PBXAI', test_fold_idx, key, data_type, 'ci_lower'] + ci[key][1].tolist())
+            data_to_write.append(['PBXAI', test_fold_idx, key, data_type, 'ci_upper'] + ci[key][2].tolist())
+    with open(os.path.join(args.result_folder, 'pbxai_result_{}.csv'.format(datetime.now().strftime('%Y%m%d%H%M%S'))),
               'w', encoding='utf-8-sig', newline='') as file:
         csv.writer(file).writerows(data_to_write)
+    return results
+
+
+def benchmark_beam(args, mode):
+    """分别以固定top-k的beam与args指定的自适应beam预测路径，比较耗时、保留的概率质量与AUC"""
+    policy_file = os.path.join(args.save_path, 'policy_model_epoch_{}.ckpt'.format(args.epochs))
+    data = read_patient_representation_and_label(info_folder=args.data_path,
+                                                 embed_folder=args.pat_representation_folder,
+                                                 test_idx=args.test_fold_idx, data_source=args.data_source,
+                                                 omit_duplicate_disease=args.omit_duplicate)
+    pat_embed, interact, label = data[4: 7] if mode == 'test' else data[:3]
+    group = read_group(args.data_path, omit=args.omit_duplicate)
+    exact_args = copy.copy(args)
+    exact_args.beam_mass, exact_args.beam_min_prob, exact_args.max_beams = None, None, None
+
+    results, exact_pred = [], None
+    for name, beam_args in [('exact', exact_args), ('adaptive', args)]:
+        start_time = time.time()
+        predicts = predict_paths(policy_file, pat_embed, interact, beam_args)
+        elapsed = time.time() - start_time
+        pred = path_score(predicts['score'], predicts['disease_idx'])
+        exact_pred = pred if exact_pred is None else exact_pred
+        group_result = util.group_metric(pred.transpose(), label[:, predicts['disease_idx']].transpose(), group)
+        results.append([name, elapsed, predicts['num_paths'], np.mean(predicts['retained_mass']),
+                        np.max(np.abs(pred - exact_pred)), group_result['all'][0], group_result['all'][1]])
+    print('beam: mass={}, min_prob={}, max_beams={}, topk={}'.format(args.beam_mass, args.beam_min_prob,
+                                                                     args.max_beams, args.topk))
+    print('{:<10}{:>10}{:>10}{:>10}{:>12}{:>12}{:>12}'.format('', 'time(s)', 'paths', 'mass', 'max |diff|',
+                                                              'macro_auc', 'micro_auc'))
+    for name, elapsed, num_path, mass, diff, macro_auc, micro_auc in results:
+        print('{:<10}{:>10.3f}{:>10d}{:>10.4f}{:>12.6f}{:>12.4f}{:>12.4f}'.format(
+            name, elapsed, num_path, mass, diff, macro_auc, micro_auc))
+    return results
 
 
 def main():
     """V5"""
-    max_acts = 65
+    max_acts = None
     max_len = 0
     gamma = 0
     hidden = [32, 16]
@@ -269,7 +450,11 @@ def main():
         parser.add_argument('--gpu', type=str, default='0', help='gpu device.')
         parser.add_argument('--batch_size', type=int, default=batch_size, help='Max number of actions.')
         parser.add_argument('--epochs', type=int, default=epoch, help='Max number of actions.')
-        parser.add_argument('--max_acts', type=int, default=max_acts, help='Max number of actions.')
+        parser.add_argument('--max_acts', type=int, default=max_acts, help='Max number of actions, default: #KG nodes.')
+        parser.add_argument('--sparse_action', action='store_true', help='score only candidate nodes.')
+        parser.add_argument('--max_candidates', type=int, default=None, help='keep at most N actions per node.')
+        parser.add_argument('--prune_by', type=str, default='similarity', help='similarity or degree.')
+        parser.add_argument('--num_pat_cluster', type=int, default=8, help='patient clusters for pruning cache.')
         parser.add_argument('--max_path_len', type=int, default=max_len, help='Max path length.')
         parser.add_argument('--gamma', type=float, default=gamma, help='reward discount factor.')
         parser.add_argument('--hidden_state_size', type=int, default=hidden_state_size, help='state history length')
@@ -277,19 +462,38 @@ def main():
         parser.add_argument('--run_path', default=True, help='Generate predicted path? (takes long time)')
         parser.add_argument('--run_eval', default=True, help='Run evaluation?')
         parser.add_argument('--topk', type=int, nargs='*', default=top_k, help='number of samples')
+        parser.add_argument('--beam_mass', type=float, default=None, help='adaptive beam: cumulative prob per node.')
+        parser.add_argument('--beam_min_prob', type=float, default=None, help='adaptive beam: min step prob.')
+        parser.add_argument('--max_beams', type=int, default=None, help='adaptive beam: max paths per patient.')
+        parser.add_argument('--beam_benchmark', action='store_true', help='compare adaptive beam with exact beam.')
+        parser.add_argument('--memory_budget', type=float, default=None,
+                            help='MB for the beam frontier, patient batches shrink to fit.')
         parser.add_argument('--pat_representation_folder', type=str,
                             default=os.path.abspath('../../resource/representation/'))
         parser.add_argument('--data_path', type=str, default=os.path.abspath(
             '../../resource/preprocessed_data/plagh_five_part_five_fold'))
-        parser.add_argument('--kg_path', type=str, default=os.path.abspath('../../resource/knowledge_graph/kg.pkl'))
+        parser.add_argument('--kg_path', type=str, default=os.path.abspath('../../resource/knowledge_graph/kg.kgs'))
         parser.add_argument('--embed_path', type=str,
                             default=os.path.abspath('../../resource/representation/medical_concept_embedding.npy'))
+        parser.add_argument('--save_path', type=str, default=os.path.abspath('../../resource/agent/'))
+        parser.add_argument('--result_folder', type=str, default=os.path.abspath('../../resource/'))
+        parser.add_argument('--registry', type=str, default=None, help='artifact registry folder.')
+        parser.add_argument('--bootstrap', type=int, default=0, help='bootstrap resamples for CI, 0 to disable.')
+        parser.add_argument('--bootstrap_workers', type=int, default=None, help='default: #cores')
+        parser.add_argument('--profile', action='store_true', help='print a per-stage timing breakdown.')
+        parser.add_argument('--trace_path', type=str, default=None,
+                            help='chrome trace file, suffixed with _test, implies --profile.')
         args = parser.parse_args()
 
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
         args.device = torch.device('cuda:0') if torch.cuda.is_available() else 'cpu'
+        resolve_representation(args)
+        profiler.setup(args)
 
-        test(args, mode=mode)
+        if args.beam_benchmark:
+            benchmark_beam(args, mode=mode)
+        else:
+            test(args, mode=mode)
 
 
 if __name__ == '__main__':
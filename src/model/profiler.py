@@ -0,0 +1,169 @@
+import json
+import os
+import threading
+import time
+from functools import wraps
+"""
+热路径的可选计时与计数，默认关闭
+PROFILER为进程内的全局实例，各模块在热路径上以PROFILER.timed装饰函数、以PROFILER.section包裹代码段，
+关闭时装饰器只多一次属性判断，section返回共享的空context，开销可以忽略
+开启后按名称累计调用次数、总耗时与自身耗时（扣除嵌套在其中的其它计时段），report给出分项占比
+trace开启时同时记录每一次调用，save_trace写出Chrome trace格式（chrome://tracing或Perfetto可直接打开）
+"""
+
+# trace事件数上限，超出后不再记录新的事件（累计统计不受影响）
+MAX_TRACE_EVENTS = 1000000
+
+
+class _NullSection(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_SECTION = _NullSection()
+
+
+class _Section(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._push(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.profiler._pop()
+        return False
+
+
+class Profiler(object):
+    def __init__(self):
+        self.enabled = False
+        self.trace = False
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._events = []
+        self.reset()
+
+    def enable(self, trace=False):
+        """开启并清空之前的统计与trace事件"""
+        self.enabled = True
+        self.trace = trace
+        with self._lock:
+            self._events = []
+        self.reset()
+
+    def disable(self):
+        self.enabled = False
+        self.trace = False
+
+    def reset(self):
+        """清空累计的计时与计数（trace事件保留），用于按epoch统计"""
+        with self._lock:
+            self._stats = dict()
+            self._counters = dict()
+            self._start = time.perf_counter()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _push(self, name):
+        # [name, 开始时间, 嵌套计时段的总耗时]
+        self._stack().append([name, time.perf_counter(), 0.0])
+
+    def _pop(self):
+        end = time.perf_counter()
+        stack = self._stack()
+        name, start, child = stack.pop()
+        elapsed = end - start
+        if stack:
+            stack[-1][2] += elapsed
+        with self._lock:
+            item = self._stats.get(name)
+            if item is None:
+                item = self._stats[name] = [0, 0.0, 0.0]
+            item[0] += 1
+            item[1] += elapsed
+            item[2] += elapsed - child
+            if self.trace and len(self._events) < MAX_TRACE_EVENTS:
+                self._events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                     'ts': (start - self._origin) * 1e6, 'dur': elapsed * 1e6})
+
+    def section(self, name):
+        """with PROFILER.section(name): ..."""
+        if not self.enabled:
+            return _NULL_SECTION
+        return _Section(self, name)
+
+    def timed(self, name):
+        """函数装饰器，调用时由enabled决定是否计时"""
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                self._push(name)
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self._pop()
+            return wrapper
+        return decorator
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def stats(self):
+        """:return: {name: (calls, total_s, self_s)}, {counter: value}, wall_s"""
+        with self._lock:
+            return ({name: tuple(item) for name, item in self._stats.items()}, dict(self._counters),
+                    time.perf_counter() - self._start)
+
+    def report(self, title=''):
+        stats, counters, wall = self.stats()
+        lines = ['{} wall {:.3f}s'.format(title, wall).strip()]
+        lines.append('{:<20}{:>10}{:>12}{:>12}{:>8}{:>12}'.format('section', 'calls', 'total(s)', 'self(s)', 'self%',
+                                                                  'mean(ms)'))
+        for name, (calls, total, self_time) in sorted(stats.items(), key=lambda x: x[1][2], reverse=True):
+            lines.append('{:<20}{:>10d}{:>12.3f}{:>12.3f}{:>8.1f}{:>12.3f}'.format(
+                name, calls, total, self_time, 100 * self_time / wall if wall > 0 else 0, 1000 * total / calls))
+        untracked = wall - sum(item[2] for item in stats.values())
+        lines.append('{:<20}{:>10}{:>12}{:>12.3f}{:>8.1f}'.format('(untracked)', '', '', untracked,
+                                                                   100 * untracked / wall if wall > 0 else 0))
+        for name in sorted(counters):
+            lines.append('{:<20}{:>10}'.format(name, counters[name]))
+        return '\n'.join(lines)
+
+    def save_trace(self, path):
+        with self._lock:
+            events = list(self._events)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return len(events)
+
+
+PROFILER = Profiler()
+
+
+def trace_file(path, suffix):
+    """在扩展名之前插入suffix，如trace.json -> trace_fold0.json，用于同一进程内多次写出trace"""
+    root, ext = os.path.splitext(path)
+    return '{}_{}{}'.format(root, suffix, ext)
+
+
+def setup(args):
+    """按--profile / --trace_path开启PROFILER"""
+    if args.profile or args.trace_path is not None:
+        PROFILER.enable(trace=args.trace_path is not None)
+    return PROFILER
@@ -1,6 +1,6 @@
 import os
 import sys
-src = os.path.abspath('../')
+src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(src)
 sys.path.append(os.path.join(src, 'model'))
 sys.path.append(os.path.join(src, 'data_preprocess'))
@@ -9,28 +9,42 @@ import torch.nn as nn
 from torch.distributions import Categorical
 import torch.nn.functional as func
 import torch.optim as opt
-from collections import namedtuple
 from datetime import datetime
+import copy
+import time
 import torch
 import argparse
 import numpy as np
 from knowledge_graph import KnowledgeGraph
 import experiment_util as util
+from artifact_registry import ArtifactRegistry, CONCEPT_EMBEDDING, PATIENT_REPRESENTATION
 from model import kg_env, performance_eval
+import profiler
+from profiler import PROFILER
 import random
 
 
 #
 # Model V5 针对由于参数化问题产生的模型错误，首先取消LSTM的state分立设计
 #
-SavedAction = namedtuple('SavedAction', ['log_prob', 'value'])
-logger = util.get_logger(os.path.abspath('../../resource/agent/train_log_{}.txt').
-                         format(datetime.now().strftime('%Y%m%d%H%M%S')))
+_logger = None
+
+
+def get_train_logger():
+    """训练日志文件在第一次使用时创建，import本模块不产生任何文件"""
+    global _logger
+    if _logger is None:
+        _logger = util.get_logger(os.path.join(util.RESOURCE_FOLDER, 'agent', 'train_log_{}.txt'
+                                               .format(datetime.now().strftime('%Y%m%d%H%M%S'))))
+    return _logger
 
 
 class ActorCritic(nn.Module):
-    def __init__(self, state_dim, act_dim, hidden_sizes, gamma):
-        assert act_dim == 65
+    def __init__(self, state_dim, act_dim, hidden_sizes, gamma, concept_embeds=None):
+        """
+        :param concept_embeds: 为None时actor输出全部act_dim个节点的logits（dense）
+        否则actor输出一个query向量，仅与候选节点的concept embedding做内积打分（sparse），act_dim不再使用
+        """
         super(ActorCritic, self).__init__()
         self.state_dim = state_dim
         self.act_dim = act_dim
@@ -40,19 +54,36 @@ class ActorCritic(nn.Module):
         self.l2 = nn.Linear(hidden_sizes[0], hidden_sizes[1])
         self.l3 = nn.Linear(state_dim, hidden_sizes[0])
         self.l4 = nn.Linear(hidden_sizes[0], hidden_sizes[1])
-        self.actor = nn.Linear(hidden_sizes[1], act_dim)
+        if concept_embeds is None:
+            self.concept_embeds = None
+            self.actor = nn.Linear(hidden_sizes[1], act_dim)
+        else:
+            self.register_buffer('concept_embeds', torch.as_tensor(np.array(concept_embeds), dtype=torch.float),
+                                 persistent=False)
+            self.actor = nn.Linear(hidden_sizes[1], self.concept_embeds.shape[1])
         self.critic = nn.Linear(hidden_sizes[1], 1)
 
-        self.saved_actions = []
-        self.rewards = []
-        self.entropy = []
+        # 轨迹缓存，均为[#steps, bs]的Tensor，由reset_buffer预先分配
+        self.log_probs = None
+        self.values = None
+        self.entropy = None
+        self.rewards = None
+        self._step = 0
 
+    @PROFILER.timed('policy_forward')
     def forward(self, inputs):
-        state, act_mask = inputs  # state: [bs, state_dim], act_mask: [bs, act_dim]
-        assert act_mask.shape[1] == 65
+        # state: [bs, state_dim], act_mask: [bs, act_dim]
+        # sparse模式下还需要cand_ids: [bs, width]，此时act_mask: [bs, width]，输出的概率也是对应各列的
+        state, act_mask = inputs[0], inputs[1]
         x = func.relu(self.l1(state))
         x = func.relu(self.l2(x))
-        actor_logits = self.actor(x)
+        if self.concept_embeds is None:
+            assert act_mask.shape[1] == self.act_dim
+            actor_logits = self.actor(x)
+        else:
+            cand_ids = inputs[2]
+            query = self.actor(x)  # Tensor of [bs, embed_size]
+            actor_logits = torch.bmm(self.concept_embeds[cand_ids], query.unsqueeze(2)).squeeze(2)
 
         zero_idx = act_mask.clone() == 0
         actor_logits[zero_idx] = -99
@@ -63,50 +94,89 @@ class ActorCritic(nn.Module):
         state_values = self.critic(x)  # Tensor of [bs, 1]
         return act_probs, state_values
 
-    def select_action(self, batch_state, batch_act_mask, device):
-        batch_hidden_state = torch.FloatTensor(batch_state).to(device)  # Tensor [bs, state_dim]
-        act_mask = torch.LongTensor(batch_act_mask).to(device)  # Tensor of [bs, act_dim]
-
-        probs, value = self((batch_hidden_state, act_mask))  # act_probs: [bs, act_dim], state_value: [bs, 1]
+    def reset_buffer(self, num_steps, batch_size, device):
+        """每条轨迹开始前调用，预先分配[#steps, bs]的轨迹缓存"""
+        self.log_probs = torch.zeros(num_steps, batch_size, device=device)
+        self.values = torch.zeros(num_steps, batch_size, device=device)
+        self.entropy = torch.zeros(num_steps, batch_size, device=device)
+        self.rewards = torch.zeros(num_steps, batch_size, device=device)
+        self._step = 0
+
+    def act(self, batch_state, act_mask, cand_ids=None):
+        """
+        按策略采样一步动作，并记录到reset_buffer分配的轨迹缓存中，输入输出全部为Tensor，供RolloutCollector使用
+        :param batch_state: FloatTensor of [bs, state_dim]
+        :param act_mask: LongTensor of [bs, act_dim]
+        :param cand_ids: sparse模式下每一列对应的全局节点id
+        :return: LongTensor of [bs, ]，act_mask中的列下标
+        """
+        probs, value = self((batch_state, act_mask, cand_ids))  # act_probs: [bs, act_dim], state_value: [bs, 1]
         m = Categorical(probs)
         acts = m.sample()  # Tensor of [bs, ], requires_grad=False
         # [CAVEAT] If sampled action is out of action_space, choose the first action in action_space.
-        valid_idx = act_mask.gather(1, acts.view(-1, 1)).view(-1)
-        # 按照我们的设计，不应该出现采样到非法点的情况，如果出现了，就不满足下面的断言，就报错
+        # 按照我们的设计，不应该出现采样到非法点的情况
+        # valid_idx = act_mask.gather(1, acts.view(-1, 1)).view(-1)
         # assert valid_idx.sum() == acts.shape[0]
 
-        self.saved_actions.append(SavedAction(m.log_prob(acts), value))
-        self.entropy.append(m.entropy())
-        return acts.cpu().numpy().tolist()
-
-    def update(self, optimizer, device, ent_weight):
-        batch_rewards = np.vstack(self.rewards).T  # numpy array of [bs, #steps]
-        batch_rewards = torch.FloatTensor(batch_rewards).to(device)
-        num_steps = batch_rewards.shape[1]
-        for i in range(1, num_steps):
-            batch_rewards[:, num_steps - i - 1] += self.gamma * batch_rewards[:, num_steps - i]
-
-        actor_loss = 0
-        critic_loss = 0
-        entropy_loss = 0
-        for i in range(0, num_steps):
-            log_prob, value = self.saved_actions[i]  # log_prob: Tensor of [bs, ], value: Tensor of [bs, 1]
-            advantage = batch_rewards[:, i] - value.squeeze(1)  # Tensor of [bs, ]
-            actor_loss += -log_prob * advantage.detach()  # Tensor of [bs, ]
-            critic_loss += advantage.pow(2)  # Tensor of [bs, ]
-            entropy_loss += -self.entropy[i]  # Tensor of [bs, ]
-        actor_loss = actor_loss.mean()
-        critic_loss = critic_loss.mean()
-        entropy_loss = entropy_loss.mean()
+        self.log_probs[self._step] = m.log_prob(acts)
+        self.values[self._step] = value.squeeze(1)
+        self.entropy[self._step] = m.entropy()
+        return acts
+
+    def save_reward(self, batch_reward):
+        """记录当前步的reward，并推进到下一步"""
+        self.rewards[self._step] = torch.as_tensor(batch_reward, dtype=torch.float)
+        self._step += 1
+
+    def discount(self, rewards, factor):
+        """
+        向量化的折扣累加，out[t] = sum_{k>=t} factor^(k-t) * rewards[k]
+        :param rewards: Tensor of [#steps, bs]
+        """
+        num_steps = rewards.shape[0]
+        exponent = torch.arange(num_steps, device=rewards.device, dtype=rewards.dtype)
+        exponent = exponent.view(1, -1) - exponent.view(-1, 1)  # [t, k] = k - t
+        weight = torch.where(exponent >= 0, torch.pow(torch.tensor(factor, dtype=rewards.dtype), exponent.clamp(min=0)),
+                             torch.zeros_like(exponent))
+        return weight.matmul(rewards)
+
+    def update(self, optimizer, device, ent_weight, gae_lambda=None, normalize_reward=False):
+        """
+        :param gae_lambda: 为None时使用蒙特卡洛回报作为advantage，否则使用GAE(lambda)
+        :param normalize_reward: 是否做标准化，MC回报时标准化折扣回报，GAE时标准化actor使用的advantage
+        """
+        assert self._step == self.rewards.shape[0]
+        rewards = self.rewards.to(device)
+        values = self.values
+
+        if gae_lambda is None:
+            returns = self.discount(rewards, self.gamma)  # Tensor of [#steps, bs]
+            if normalize_reward:
+                returns = (returns - returns.mean()) / (returns.std() + 1e-8)
+            advantage = returns - values
+            critic_error = advantage
+        else:
+            # 终止状态的value视为0
+            next_values = torch.cat([values[1:], torch.zeros_like(values[:1])]).detach()
+            delta = rewards + self.gamma * next_values - values.detach()
+            advantage = self.discount(delta, self.gamma * gae_lambda)
+            # critic仍拟合未标准化的lambda回报
+            critic_error = (advantage + values.detach()) - values
+            if normalize_reward:
+                advantage = (advantage - advantage.mean()) / (advantage.std() + 1e-8)
+
+        # 先沿step求和，再在batch上取均值
+        actor_loss = (-self.log_probs * advantage.detach()).sum(0).mean()
+        critic_loss = critic_error.pow(2).sum(0).mean()
+        entropy_loss = -self.entropy.sum(0).mean()
         loss = actor_loss + critic_loss + ent_weight * entropy_loss
-        # loss = critic_loss
-        # loss = actor_loss
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        del self.rewards[:]
-        del self.saved_actions[:]
-        del self.entropy[:]
+        with PROFILER.section('policy_backward'):
+            optimizer.zero_grad()
+            loss.backward()
+        with PROFILER.section('optimizer_step'):
+            optimizer.step()
+        self.log_probs, self.values, self.entropy, self.rewards = None, None, None, None
+        self._step = 0
 
         return loss.item(), actor_loss.item(), critic_loss.item(), entropy_loss.item()
 
@@ -137,6 +207,52 @@ class ACDataLoader(object):
         return batch_idx.tolist()
 
 
+class RolloutCollector(object):
+    """
+    将若干个batch的环境以lockstep的方式同时推进，每一步只做一次policy前向
+    state, mask, action全程保持为Tensor，仅在与环境交互的边界处做一次转换
+    所有环境的轨迹在batch维度上拼接，因此ActorCritic.update看到的是一条融合后的轨迹
+    """
+    def __init__(self, env, model, device, num_envs=1):
+        if num_envs < 1:
+            raise ValueError('num_envs should be positive')
+        self.model = model
+        self.device = device
+        # 各个环境共享只读的KG与embedding，只有episode信息是独立的
+        self.envs = [env] + [copy.copy(env) for _ in range(num_envs - 1)]
+
+    @PROFILER.timed('rollout')
+    def collect(self, batch_list):
+        """
+        :param batch_list: list of (batch_embed, batch_interact, batch_label, batch_id)，长度不超过num_envs
+        :return: 本次融合轨迹中的episode数量
+        """
+        assert 0 < len(batch_list) <= len(self.envs)
+        envs = self.envs[:len(batch_list)]
+        sizes = [len(item[0]) for item in batch_list]
+
+        state = torch.cat([torch.from_numpy(env.reset(batch_id, batch_embed, batch_interact))
+                           for env, (batch_embed, batch_interact, _, batch_id) in zip(envs, batch_list)])
+        state = state.float().to(self.device)
+        self.model.reset_buffer(envs[0].max_len, sum(sizes), self.device)
+        done = False
+        while not done:
+            # 所有环境的候选动作一起转换，sparse模式下宽度取全部环境中的最大候选数
+            act_mask, cand_ids = envs[0].action_space.to_tensor(
+                [actions for env in envs for actions in env.get_batch_actions()], self.device)
+            acts = self.model.act(state, act_mask, cand_ids)
+            acts = envs[0].action_space.to_global(acts.view(-1, 1), cand_ids).view(-1).cpu()
+            next_state, reward = [], []
+            for env, env_acts, (batch_embed, _, batch_label, _) in zip(envs, torch.split(acts, sizes), batch_list):
+                env_state, env_reward, done = env.batch_step(env_acts.tolist(), batch_embed, batch_label)
+                next_state.append(torch.from_numpy(env_state))
+                reward.append(torch.from_numpy(env_reward))
+            state = torch.cat(next_state).float().to(self.device)
+            self.model.save_reward(torch.cat(reward))
+        PROFILER.count('episodes', sum(sizes))
+        return sum(sizes)
+
+
 def read_patient_representation_and_label(data_source, info_folder, embed_folder, test_idx, data_fraction=1,
                                           raw_data=False, omit_duplicate_disease=False):
     if test_idx not in {1, 2, 3, 4, 0}:
@@ -207,6 +323,24 @@ def read_patient_representation_and_label(data_source, info_folder, embed_folder
     return train_pat_embed, train_interact, train_label, train_id, test_pat_embed, test_interact, test_label, test_id
 
 
+def resolve_representation(args):
+    """
+    指定--registry时，按当前的数据与KG在注册表中查找最新的有效表示，覆盖embed_path与pat_representation_folder
+    找不到时直接报错，不再读取可能已经过期的固定路径文件
+    """
+    if args.registry is None:
+        return args
+    registry = ArtifactRegistry(args.registry)
+    concept = registry.find(CONCEPT_EMBEDDING, {'data': args.data_path, 'kg': args.kg_path})
+    patient = registry.find(PATIENT_REPRESENTATION, {'data': args.data_path})
+    for kind, artifact in [(CONCEPT_EMBEDDING, concept), (PATIENT_REPRESENTATION, patient)]:
+        if artifact is None:
+            raise ValueError('no valid {} in registry {} for data {}'.format(kind, registry.folder, args.data_path))
+    args.embed_path = concept.path(sorted(concept.manifest['files'])[0])
+    args.pat_representation_folder = patient.folder
+    return args
+
+
 def train(args):
     pat_embed, interact, label, pat_id, _, _, _, _ = read_patient_representation_and_label(
         args.data_source, info_folder=args.data_path, embed_folder=args.pat_representation_folder,
@@ -214,46 +348,53 @@ def train(args):
     pat_idx_list = [i for i in range(len(pat_embed))]
 
     env = kg_env.BatchKGEnvironment(args.kg_path, args.embed_path, args.max_acts, args.max_path_len, len(pat_embed[0]),
-                                    args.history_len)
+                                    args.history_len, sparse_action=args.sparse_action,
+                                    max_candidates=args.max_candidates, prune_by=args.prune_by)
+    if args.max_candidates is not None and args.prune_by == 'similarity':
+        # 聚类中心与policy一起保存，测试时复用同一组簇
+        centroids = env.fit_patient_cluster(pat_embed, args.num_pat_cluster)
+        np.save(os.path.join(args.save_path, 'patient_cluster.npy'), centroids)
 
     data_loader = ACDataLoader(pat_idx_list, args.batch_size)
-    model = ActorCritic(env.state_dim, env.max_acts, args.hidden, args.gamma).to(args.device)
+    model = ActorCritic(env.state_dim, env.max_acts, args.hidden, args.gamma,
+                        concept_embeds=env.embeds if args.sparse_action else None).to(args.device)
     optimizer = opt.Adam(model.parameters(), lr=args.lr)
+    collector = RolloutCollector(env, model, args.device, args.num_envs)
 
     policy_file = '{}/policy_model_epoch_{}.ckpt'.format(args.save_path, 0)
     torch.save(model.state_dict(), policy_file)
 
     step = 0
+    total_step = args.epochs * len(pat_idx_list) / (args.batch_size * args.num_envs)
+    profiler.setup(args)
     model.train()
     for epoch in range(1, args.epochs + 1):
         total_losses, total_p_losses, total_v_losses, total_entropy, total_rewards = [], [], [], [], []
+        total_episodes = 0
+        epoch_start = time.time()
+        PROFILER.reset()
         # Start epoch
         data_loader.reset()
         while data_loader.has_next():
-            batch_id = data_loader.get_batch()
-            batch_embed = pat_embed[batch_id]
-            batch_interact = interact[batch_id]
-            batch_label = label[batch_id]
-            batch_pat_id = pat_id[batch_id]
+            # 一次取出num_envs个batch，在同一条融合轨迹中并行推进
+            batch_list = []
+            while data_loader.has_next() and len(batch_list) < args.num_envs:
+                batch_id = data_loader.get_batch()
+                batch_list.append((pat_embed[batch_id], interact[batch_id], label[batch_id], batch_id))
             # Start batch episodes
-            batch_state = env.reset(batch_id, batch_embed, batch_interact)
-            done = False
-            while not done:
-                batch_act_mask = env.batch_action_mask()
-                batch_act = model.select_action(batch_state, batch_act_mask, args.device)  # int
-                batch_state, batch_reward, done = env.batch_step(batch_act, batch_embed, batch_label)
-                # 每次update函数执行后，都会重置rewards, entropy和saved actions函数，因此此处不用担心累积
-                model.rewards.append(batch_reward)
+            total_episodes += collector.collect(batch_list)
             # End of episodes
 
             # 用于统计，由于reward会在update后重置，因此要在此处append
-            total_rewards.append(np.sum(model.rewards))
+            total_rewards.append(model.rewards.sum().item())
 
             # Update policy
-            lr = args.lr * max(1e-4, 1.0 - float(step) / (args.epochs * len(pat_idx_list) / args.batch_size))
+            lr = args.lr * max(1e-4, 1.0 - float(step) / total_step)
             for pg in optimizer.param_groups:
                 pg['lr'] = lr
-            loss, p_loss, v_loss, e_loss = model.update(optimizer, args.device, args.ent_weight)
+            loss, p_loss, v_loss, e_loss = model.update(optimizer, args.device, args.ent_weight,
+                                                      gae_lambda=args.gae_lambda,
+                                                      normalize_reward=args.normalize_reward)
 
             total_losses.append(loss)
             total_p_losses.append(p_loss)
@@ -261,25 +402,31 @@ def train(args):
             total_entropy.append(e_loss)
             step += 1
 
-        avg_reward = np.mean(total_rewards) / args.batch_size
+        avg_reward = np.sum(total_rewards) / total_episodes
         avg_loss = np.mean(total_losses)
         avg_p_loss = np.mean(total_p_losses)
         avg_v_loss = np.mean(total_v_losses)
         avg_entropy = np.mean(total_entropy)
-        logger.info(
+        get_train_logger().info(
                 'epoch={:d}'.format(epoch) +
                 ' | loss={:.5f}'.format(avg_loss) +
                 ' | p loss={:.5f}'.format(avg_p_loss) +
                 ' | v loss={:.5f}'.format(avg_v_loss) +
                 ' | entropy={:.5f}'.format(avg_entropy) +
-                ' | reward={:.5f}'.format(avg_reward))
+                ' | reward={:.5f}'.format(avg_reward) +
+                ' | episodes/s={:.1f}'.format(total_episodes / (time.time() - epoch_start)))
+        if PROFILER.enabled:
+            get_train_logger().info(PROFILER.report('epoch {:d}'.format(epoch)))
         # END of epoch
         policy_file = '{}/policy_model_epoch_{}.ckpt'.format(args.save_path, epoch)
         torch.save(model.state_dict(), policy_file)
+    if args.trace_path is not None:
+        get_train_logger().info('{} trace events saved to {}'.format(PROFILER.save_trace(args.trace_path),
+                                                                     args.trace_path))
 
 
-def main():
-    max_act = 65
+def get_parser(test_fold_idx=0):
+    max_act = None
     max_path_len = 2
     hidden = [64, 32]
     epoch = 10
@@ -288,43 +435,72 @@ def main():
     learning_rate = 0.001
     top_k = [10, 5, 5, 2, 2]
     batch_size = 64
+    num_envs = 1
+    gae_lambda = None
     history_len = 1
     data_source = 'mimic'  # mimic plagh
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--name', type=str, default='train_agent', help='directory name.')
+    parser.add_argument('--gpu', type=str, default='cpu', help='gpu device.')
+    parser.add_argument('--test_fold_idx', type=int, default=test_fold_idx)
+    parser.add_argument('--omit_duplicate', type=bool, default=False)
+    parser.add_argument('--epochs', type=int, default=epoch)
+    parser.add_argument('--batch_size', type=int, default=batch_size)
+    parser.add_argument('--num_envs', type=int, default=num_envs, help='batches rolled out in lockstep.')
+    parser.add_argument('--history_len', type=int, default=history_len)
+    parser.add_argument('--data_source', type=str, default=data_source)
+    parser.add_argument('--lr', type=float, default=learning_rate)
+    parser.add_argument('--max_acts', type=int, default=max_act, help='Max number of actions, default: #KG nodes.')
+    parser.add_argument('--sparse_action', action='store_true', help='score only candidate nodes.')
+    parser.add_argument('--max_candidates', type=int, default=None, help='keep at most N actions per node.')
+    parser.add_argument('--prune_by', type=str, default='similarity', help='similarity or degree.')
+    parser.add_argument('--num_pat_cluster', type=int, default=8, help='patient clusters for pruning cache.')
+    parser.add_argument('--max_path_len', type=int, default=max_path_len, help='Max path length.')
+    parser.add_argument('--gamma', type=float, default=gamma, help='reward discount factor.')
+    parser.add_argument('--ent_weight', type=float, default=ent_weight, help='weight factor for entropy loss')
+    parser.add_argument('--gae_lambda', type=float, default=gae_lambda, help='GAE lambda, None for MC return.')
+    parser.add_argument('--normalize_reward', action='store_true', help='standardize discounted returns, or the GAE advantage with --gae_lambda.')
+    parser.add_argument('--hidden', type=int, nargs='*', default=hidden, help='number of samples')
+    parser.add_argument('--kg_path', type=str, default=os.path.abspath('../../resource/knowledge_graph/kg.kgs'))
+    parser.add_argument('--embed_path', type=str,
+                        default=os.path.abspath('../../resource/representation/{}_medical_concept_embedding.npy'
+                                                .format(data_source)))
+    parser.add_argument('--pat_representation_folder', type=str,
+                        default=os.path.abspath('../../resource/representation/'))
+    parser.add_argument('--data_path', type=str, default=os.path.abspath(
+        '../../resource/preprocessed_data/{}_five_part_five_fold'.format(data_source)))
+    parser.add_argument('--save_path', type=str, default=os.path.abspath('../../resource/agent/'))
+    parser.add_argument('--result_folder', type=str, default=os.path.abspath('../../resource/'))
+    parser.add_argument('--registry', type=str, default=None, help='artifact registry folder.')
+    parser.add_argument('--run_path', default=True)
+    parser.add_argument('--run_eval', default=True, help='Run evaluation?')
+    parser.add_argument('--topk', type=int, nargs='*', default=top_k, help='number of samples')
+    parser.add_argument('--beam_mass', type=float, default=None, help='adaptive beam: cumulative prob per node.')
+    parser.add_argument('--beam_min_prob', type=float, default=None, help='adaptive beam: min step prob.')
+    parser.add_argument('--max_beams', type=int, default=None, help='adaptive beam: max paths per patient.')
+    parser.add_argument('--memory_budget', type=float, default=None,
+                        help='MB for the beam frontier, patient batches shrink to fit.')
+    parser.add_argument('--bootstrap', type=int, default=0, help='bootstrap resamples for CI, 0 to disable.')
+    parser.add_argument('--bootstrap_workers', type=int, default=None, help='default: #cores')
+    parser.add_argument('--profile', action='store_true', help='log a per-stage timing breakdown per epoch.')
+    parser.add_argument('--trace_path', type=str, default=None,
+                        help='chrome trace file, suffixed per fold and for eval, implies --profile.')
+    return parser
+
+
+def main():
     for test_fold_idx in [0, 1, 2, 3, 4]:
-        parser = argparse.ArgumentParser()
-        parser.add_argument('--name', type=str, default='train_agent', help='directory name.')
-        parser.add_argument('--gpu', type=str, default='cpu', help='gpu device.')
-        parser.add_argument('--test_fold_idx', type=int, default=test_fold_idx)
-        parser.add_argument('--omit_duplicate', type=bool, default=False)
-        parser.add_argument('--epochs', type=int, default=epoch)
-        parser.add_argument('--batch_size', type=int, default=batch_size)
-        parser.add_argument('--history_len', type=int, default=history_len)
-        parser.add_argument('--data_source', type=str, default=data_source)
-        parser.add_argument('--lr', type=float, default=learning_rate)
-        parser.add_argument('--max_acts', type=int, default=max_act, help='Max number of actions.')
-        parser.add_argument('--max_path_len', type=int, default=max_path_len, help='Max path length.')
-        parser.add_argument('--gamma', type=float, default=gamma, help='reward discount factor.')
-        parser.add_argument('--ent_weight', type=float, default=ent_weight, help='weight factor for entropy loss')
-        parser.add_argument('--hidden', type=int, nargs='*', default=hidden, help='number of samples')
-        parser.add_argument('--kg_path', type=str, default=os.path.abspath('../../resource/knowledge_graph/kg.pkl'))
-        parser.add_argument('--embed_path', type=str,
-                            default=os.path.abspath('../../resource/representation/{}_medical_concept_embedding.npy'
-                                                    .format(data_source)))
-        parser.add_argument('--pat_representation_folder', type=str,
-                            default=os.path.abspath('../../resource/representation/'))
-        parser.add_argument('--data_path', type=str, default=os.path.abspath(
-            '../../resource/preprocessed_data/{}_five_part_five_fold'.format(data_source)))
-        parser.add_argument('--save_path', type=str, default=os.path.abspath('../../resource/agent/'))
-        parser.add_argument('--run_path', default=True)
-        parser.add_argument('--run_eval', default=True, help='Run evaluation?')
-        parser.add_argument('--topk', type=int, nargs='*', default=top_k, help='number of samples')
-        args = parser.parse_args()
+        args = get_parser(test_fold_idx).parse_args()
+        if args.trace_path is not None:
+            # 每个fold写出各自的trace
+            args.trace_path = profiler.trace_file(args.trace_path, 'fold{}'.format(test_fold_idx))
 
         # os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
         # args.device = torch.device('cuda:0') if torch.cuda.is_available() else 'cpu'
         args.device = 'cpu'
-        logger.info(args)
+        resolve_representation(args)
+        get_train_logger().info(args)
         train(args)
         performance_eval.test(args, 'test')
         # performance_eval.test(args, 'train')
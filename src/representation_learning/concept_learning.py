@@ -1,42 +1,82 @@
+import os
+import sys
+src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(src)
+
 import torch
 import numpy as np
-import os
+import argparse
+from artifact_registry import ArtifactRegistry, CONCEPT_EMBEDDING
 
 
 def main():
     """
     使用RBM参数矩阵作为知识图谱中各个节点的Concept Embedding Representation
+    可见层大小由数据（KG节点数）决定
     :return:
     """
-    num_visible = 65
-    num_hidden = 5
-    batch_size = 32
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_hidden', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=32, help='0 for full-batch updates.')
+    parser.add_argument('--cd_k', type=int, default=2)
+    parser.add_argument('--epoch', type=int, default=30)
+    parser.add_argument('--pcd', action='store_true', help='persistent contrastive divergence.')
+    parser.add_argument('--num_chains', type=int, default=256, help='fantasy chains for PCD.')
+    parser.add_argument('--in_place', action='store_true', help='allocation-free in-place updates.')
+    parser.add_argument('--data_source', type=str, default='mimic')
+    parser.add_argument('--kg_path', type=str, default=os.path.abspath('../../resource/knowledge_graph/kg.kgs'))
+    parser.add_argument('--registry', type=str, default=None, help='artifact registry folder, reuse and store the embedding there.')
+    parser.add_argument('--force', action='store_true',
+                        help='with --registry, retrain even if a cached embedding is valid.')
+    args = parser.parse_args()
+    data_source = args.data_source
+
+    file_folder = os.path.abspath('../../resource/preprocessed_data/{}_five_part_five_fold'.format(data_source))
+    save_folder = os.path.abspath('../../resource/representation/')
+    file_name = '{}_medical_concept_embedding.npy'.format(data_source)
+    if args.registry is None:
+        # 未指定--registry时直接写出到固定路径，不在注册表中保留副本
+        if not os.path.exists(save_folder):
+            os.makedirs(save_folder)
+        np.save(os.path.join(save_folder, file_name), train_embedding(args, file_folder))
+        return
+    # embedding的行与KG节点一一对应，KG变化时同样需要重新训练
+    registry = ArtifactRegistry(args.registry)
+    inputs = {'data': file_folder, 'kg': args.kg_path}
+    params = {'num_hidden': args.num_hidden, 'batch_size': args.batch_size, 'cd_k': args.cd_k, 'epoch': args.epoch,
+              'pcd': args.pcd, 'num_chains': args.num_chains if args.pcd else None}
+    artifact = None if args.force else registry.lookup(CONCEPT_EMBEDDING, inputs, params)
+    if artifact is not None:
+        print('reuse concept embedding: {}'.format(artifact.folder))
+    else:
+        stage_folder = registry.stage(CONCEPT_EMBEDDING)
+        np.save(os.path.join(stage_folder, file_name), train_embedding(args, file_folder))
+        artifact = registry.commit(stage_folder, CONCEPT_EMBEDDING, inputs, params)
+    artifact.export(save_folder, registry)
+
+
+def train_embedding(args, file_folder):
     cuda = torch.cuda.is_available()
-    cd_k = 2
-    epoch = 30
-    data_source = 'mimic'
     if cuda:
         torch.cuda.set_device(0)
+    data_loader = DataLoader(file_folder, args.batch_size if args.batch_size > 0 else None)
 
-    file_folder = os.path.abspath('../../resource/preprocessed_data/{}_five_part_five_fold'.format(data_source))
-    data_loader = DataLoader(file_folder, batch_size)
-
-    rbm = RestrictedBoltzmannMachine(num_visible, num_hidden, cd_k, use_cuda=cuda)
-    for epoch in range(epoch):
+    rbm = RestrictedBoltzmannMachine(data_loader.num_visible, args.num_hidden, args.cd_k, use_cuda=cuda,
+                                     num_chains=args.num_chains if args.pcd else None, in_place=args.in_place)
+    for epoch in range(args.epoch):
         epoch_error = 0.0
-        data_list_in_batch = data_loader.get_batch_list()
-
-        for batch in data_list_in_batch:
-            batch = torch.from_numpy(batch).float()
+        for batch in data_loader:
+            batch = torch.from_numpy(batch)
             if cuda:
                 batch = batch.cuda()
-            batch_error = rbm.contrastive_divergence(batch)
+            if args.pcd:
+                batch_error = rbm.persistent_contrastive_divergence(batch)
+            else:
+                batch_error = rbm.contrastive_divergence(batch)
             epoch_error += batch_error
         print('Epoch Error (epoch=%d): %.4f' % (epoch, epoch_error))
 
-    save_path = os.path.abspath('../../resource/representation/{}_medical_concept_embedding.npy'.format(data_source))
-    weight_mat = rbm.weights.cpu().data.numpy()
-    np.save(save_path, weight_mat)
+    return rbm.weights.cpu().data.numpy()
 
 
 class DataLoader(object):
@@ -49,24 +89,32 @@ class DataLoader(object):
             disease = np.load(os.path.join(file_folder, 'disease_list_{}.npy'.format(i)))
             disease_category = np.load(os.path.join(file_folder, 'disease_category_list_{}.npy'.format(i)))
             data_list.append(np.concatenate([risk_factor, disease, disease_category], axis=1))
-        self._data = np.concatenate([data_list[0], data_list[1], data_list[2], data_list[3], data_list[4]], axis=0)
+        self._data = np.concatenate(data_list, axis=0).astype(np.float32)
         self._batch_size = batch_size
-
-    def get_batch_list(self):
+        self.num_visible = self._data.shape[1]
+
+    def __iter__(self):
+        """
+        每个batch在迭代到时才取出，不预先复制整个epoch的数据
+        batch_size为None时整个数据集作为一个batch（不复制）
+        """
+        if self._batch_size is None:
+            yield self._data
+            return
         batch_num = len(self._data) // self._batch_size
-        batch_data_list = list()
-        idx_permutation = [i for i in range(len(self._data))]
-        np.random.shuffle(idx_permutation)
+        idx_permutation = np.random.permutation(len(self._data))
         for i in range(batch_num):
-            idx_list = np.array(idx_permutation[i*self._batch_size: (i+1)*self._batch_size])
-            batch_data_list.append(np.array(self._data[idx_list], dtype=float))
-        return batch_data_list
+            yield self._data[idx_permutation[i * self._batch_size: (i + 1) * self._batch_size]]
 
 
 class RestrictedBoltzmannMachine(object):
 
     def __init__(self, num_visible, num_hidden, k, learning_rate=1e-3, momentum_coefficient=0.5, weight_decay=1e-4,
-                 use_cuda=True):
+                 use_cuda=True, num_chains=None, in_place=False):
+        """
+        :param num_chains: PCD的fantasy chain数量，只用于persistent_contrastive_divergence
+        :param in_place: PCD的Gibbs采样与参数更新使用预分配的缓冲区原地计算，每步不分配新的tensor
+        """
         self.num_visible = num_visible
         self.num_hidden = num_hidden
         self.k = k
@@ -92,6 +140,11 @@ class RestrictedBoltzmannMachine(object):
             self.visible_bias_momentum = self.visible_bias_momentum.cuda()
             self.hidden_bias_momentum = self.hidden_bias_momentum.cuda()
 
+        self.num_chains = num_chains
+        self.in_place = in_place
+        self.chain_hidden = None  # [num_chains, num_hidden]，PCD各条链当前的隐层状态
+        self._buffer = dict()
+
     def sample_hidden(self, visible_probabilities):
         hidden_activations = torch.matmul(visible_probabilities, self.weights) + self.hidden_bias
         hidden_probabilities = self._sigmoid(hidden_activations)
@@ -146,6 +199,106 @@ class RestrictedBoltzmannMachine(object):
 
         return error
 
+    def persistent_contrastive_divergence(self, input_data):
+        """
+        PCD: 负相的Gibbs链（fantasy particles）在参数更新之间保持，每次从上一次的状态继续推进k步
+        链的数量与batch大小无关，负相统计量按链数取平均后换算到batch的尺度，更新规则与contrastive_divergence相同
+        正相使用隐层概率而非采样值；返回值为batch的重构误差
+        """
+        if self.num_chains is None:
+            raise ValueError('num_chains should be set for persistent contrastive divergence')
+        if self.chain_hidden is None:
+            self.chain_hidden = torch.bernoulli(torch.full((self.num_chains, self.num_hidden), 0.5,
+                                                           device=self.weights.device))
+        if self.in_place:
+            return self._persistent_contrastive_divergence_in_place(input_data)
+        batch_size = input_data.size(0)
+
+        # Positive phase
+        positive_hidden_probabilities = self.sample_hidden(input_data)
+        positive_associations = torch.matmul(input_data.t(), positive_hidden_probabilities)
+
+        # Negative phase
+        hidden_activations = self.chain_hidden
+        visible_probabilities = None
+        hidden_probabilities = None
+        for step in range(self.k):
+            visible_probabilities = self.sample_visible(hidden_activations)
+            hidden_probabilities = self.sample_hidden(visible_probabilities)
+            hidden_activations = torch.bernoulli(hidden_probabilities)
+        self.chain_hidden = hidden_activations
+        scale = batch_size / self.num_chains
+        negative_associations = torch.matmul(visible_probabilities.t(), hidden_probabilities) * scale
+
+        # Update parameters
+        self.weights_momentum *= self.momentum_coefficient
+        self.weights_momentum += (positive_associations - negative_associations)
+
+        self.visible_bias_momentum *= self.momentum_coefficient
+        self.visible_bias_momentum += torch.sum(input_data, dim=0) - torch.sum(visible_probabilities, dim=0) * scale
+
+        self.hidden_bias_momentum *= self.momentum_coefficient
+        self.hidden_bias_momentum += (torch.sum(positive_hidden_probabilities, dim=0) -
+                                      torch.sum(hidden_probabilities, dim=0) * scale)
+
+        self.weights += self.weights_momentum * self.learning_rate / batch_size
+        self.visible_bias += self.visible_bias_momentum * self.learning_rate / batch_size
+        self.hidden_bias += self.hidden_bias_momentum * self.learning_rate / batch_size
+
+        self.weights -= self.weights * self.weight_decay  # L2 weight decay
+
+        # Compute reconstruction error
+        error = torch.sum((input_data - self.sample_visible(positive_hidden_probabilities))**2)
+
+        return error
+
+    def _get_buffer(self, name, *shape):
+        key = (name, shape)
+        if key not in self._buffer:
+            self._buffer[key] = torch.empty(*shape, device=self.weights.device)
+        return self._buffer[key]
+
+    def _persistent_contrastive_divergence_in_place(self, input_data):
+        """与persistent_contrastive_divergence相同，所有中间结果写入按形状缓存的缓冲区"""
+        batch_size = input_data.size(0)
+        scale = batch_size / self.num_chains
+        step_size = self.learning_rate / batch_size
+        positive_hidden = self._get_buffer('positive_hidden', batch_size, self.num_hidden)
+        reconstruction = self._get_buffer('reconstruction', batch_size, self.num_visible)
+        chain_visible = self._get_buffer('chain_visible', self.num_chains, self.num_visible)
+        chain_hidden = self._get_buffer('chain_hidden', self.num_chains, self.num_hidden)
+        visible_sum = self._get_buffer('visible_sum', self.num_visible)
+        hidden_sum = self._get_buffer('hidden_sum', self.num_hidden)
+
+        # Positive phase
+        torch.addmm(self.hidden_bias, input_data, self.weights, out=positive_hidden).sigmoid_()
+
+        # Negative phase
+        for step in range(self.k):
+            torch.addmm(self.visible_bias, self.chain_hidden, self.weights.t(), out=chain_visible).sigmoid_()
+            torch.addmm(self.hidden_bias, chain_visible, self.weights, out=chain_hidden).sigmoid_()
+            torch.bernoulli(chain_hidden, out=self.chain_hidden)
+
+        # Update parameters，momentum = momentum * m + positive - negative * scale
+        self.weights_momentum.mul_(self.momentum_coefficient)
+        self.weights_momentum.addmm_(input_data.t(), positive_hidden)
+        self.weights_momentum.addmm_(chain_visible.t(), chain_hidden, alpha=-scale)
+        self.visible_bias_momentum.mul_(self.momentum_coefficient)
+        self.visible_bias_momentum.add_(torch.sum(input_data, dim=0, out=visible_sum))
+        self.visible_bias_momentum.add_(torch.sum(chain_visible, dim=0, out=visible_sum), alpha=-scale)
+        self.hidden_bias_momentum.mul_(self.momentum_coefficient)
+        self.hidden_bias_momentum.add_(torch.sum(positive_hidden, dim=0, out=hidden_sum))
+        self.hidden_bias_momentum.add_(torch.sum(chain_hidden, dim=0, out=hidden_sum), alpha=-scale)
+
+        self.weights.add_(self.weights_momentum, alpha=step_size)
+        self.visible_bias.add_(self.visible_bias_momentum, alpha=step_size)
+        self.hidden_bias.add_(self.hidden_bias_momentum, alpha=step_size)
+        self.weights.mul_(1 - self.weight_decay)  # L2 weight decay
+
+        # Compute reconstruction error
+        torch.addmm(self.visible_bias, positive_hidden, self.weights.t(), out=reconstruction).sigmoid_()
+        return torch.sum(reconstruction.sub_(input_data).pow_(2))
+
     def _sigmoid(self, x):
         return 1 / (1 + torch.exp(-x))
 
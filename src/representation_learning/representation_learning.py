@@ -1,51 +1,136 @@
 import os
+import sys
+src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(src)
+
+import argparse
+import queue
+import threading
 import numpy as np
 from torch import nn, optim
 import torch
 from torch.nn import functional as func
+from artifact_registry import ArtifactRegistry, PATIENT_REPRESENTATION
 """
 20200715复核
 20200731复核，将representation模块换为autoencoder
 """
 
 
+# 每个fold的数据由以下文件按列拼接而成
+DATA_PART = ['feature_list', 'treatment_list', 'risk_factor_list', 'disease_list', 'disease_category_list']
+
+
 class DataLoader(object):
-    def __init__(self, file_folder_, batch_size_):
+    def __init__(self, file_folder_, batch_size_, num_fold=5, chunk_size=65536, prefetch=4, dtype=np.float32):
         """
+        各fold的npy文件以memmap方式打开，不拼接、不整体载入内存，归一化统计量由一次分块的流式扫描得到
+        每个batch在取出时才按行读取并归一化，由后台线程预取
         注意，由于此处使用BCE损失，因此所有数据要被事先压缩到0-1之间
         :param file_folder_:
         :param batch_size_:
         """
-        data_list = list()
-        for i in range(5):
-            feature = np.load(os.path.join(file_folder_, 'feature_list_{}.npy').format(i))
-            treatment = np.load(os.path.join(file_folder_, 'treatment_list_{}.npy').format(i))
-            risk_factor = np.load(os.path.join(file_folder_, 'risk_factor_list_{}.npy'.format(i)))
-            disease = np.load(os.path.join(file_folder_, 'disease_list_{}.npy'.format(i)))
-            disease_category = np.load(os.path.join(file_folder_, 'disease_category_list_{}.npy'.format(i)))
-            data_list.append(np.concatenate([feature, treatment, risk_factor, disease, disease_category], axis=1))
-        self._data = np.concatenate([data_list[0], data_list[1], data_list[2], data_list[3], data_list[4]], axis=0)
-        self._data = np.array(self._data, dtype=float)
-
-        max_value = np.max(self._data, axis=0)[np.newaxis, :] + 0.0001
-        min_value = np.min(self._data, axis=0)[np.newaxis, :] - 0.0001
-        self._data = (self._data - min_value) / (max_value - min_value)
-
+        self._fold_data = list()
+        for i in range(num_fold):
+            self._fold_data.append([np.load(os.path.join(file_folder_, '{}_{}.npy'.format(part, i)), mmap_mode='r')
+                                    for part in DATA_PART])
+        self._fold_offset = np.cumsum([0] + [len(parts[0]) for parts in self._fold_data])
+        self._chunk_size = chunk_size
+        self._prefetch = prefetch
+        self._dtype = dtype
         self._batch_size = batch_size_
-        self.length = len(self._data)
+        self.length = int(self._fold_offset[-1])
+
+        min_value, max_value = None, None
+        for begin, end in self._chunk_range():
+            chunk = self._read_rows(np.arange(begin, end))
+            chunk_min, chunk_max = np.min(chunk, axis=0), np.max(chunk, axis=0)
+            min_value = chunk_min if min_value is None else np.minimum(min_value, chunk_min)
+            max_value = chunk_max if max_value is None else np.maximum(max_value, chunk_max)
+        self._min_value = min_value - 0.0001
+        self._scale = (max_value + 0.0001) - self._min_value
 
-    def get_batch_list(self):
-        batch_num = len(self._data) // self._batch_size
-        batch_data_list = list()
-        idx_permutation = [i for i in range(len(self._data))]
-        np.random.shuffle(idx_permutation)
+    def _chunk_range(self):
+        for begin in range(0, self.length, self._chunk_size):
+            yield begin, min(begin + self._chunk_size, self.length)
+
+    def _read_rows(self, index):
+        """按全局行号（升序）读取原始数据，float64 [len(index), num_columns]"""
+        fold = np.searchsorted(self._fold_offset, index, side='right') - 1
+        rows = list()
+        for i in np.unique(fold).tolist():
+            local = index[fold == i] - self._fold_offset[i]
+            rows.append(np.concatenate([np.asarray(part[local], dtype=float) for part in self._fold_data[i]], axis=1))
+        return np.concatenate(rows, axis=0)
+
+    def get_rows(self, index, dtype=None):
+        """读取并归一化指定的行（升序的全局行号）"""
+        data = (self._read_rows(np.asarray(index)) - self._min_value) / self._scale
+        return data.astype(self._dtype if dtype is None else dtype, copy=False)
+
+    def _iter_batch(self):
+        batch_num = self.length // self._batch_size
+        idx_permutation = np.random.permutation(self.length)
         for i in range(batch_num):
-            idx_list = np.array(idx_permutation[i*self._batch_size: (i+1)*self._batch_size])
-            batch_data_list.append(np.array(self._data[idx_list], dtype=float))
-        return batch_data_list
+            # batch内按行号排序以顺序读取memmap，batch的损失为求和，与行的顺序无关
+            yield self.get_rows(np.sort(idx_permutation[i * self._batch_size: (i + 1) * self._batch_size]))
+
+    def __iter__(self):
+        """每个epoch重新打乱，舍弃不足一个batch的尾部"""
+        if self._prefetch <= 0:
+            for batch in self._iter_batch():
+                yield batch
+            return
+        batch_queue = queue.Queue(maxsize=self._prefetch)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for item in self._iter_batch():
+                    if stop.is_set():
+                        return
+                    batch_queue.put(item)
+            except Exception as e:
+                batch_queue.put(e)
+                return
+            batch_queue.put(None)
+
+        worker = threading.Thread(target=produce, daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = batch_queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            while worker.is_alive():
+                try:
+                    batch_queue.get_nowait()
+                except queue.Empty:
+                    worker.join(0.01)
+
+    def __len__(self):
+        return self.length // self._batch_size
+
+    def normalization(self):
+        """:return: (min_value, scale)，归一化为 (x - min_value) / scale"""
+        return self._min_value.copy(), self._scale.copy()
+
+    def fold_range(self):
+        """各fold在全局行号中的[begin, end)"""
+        return list(zip(self._fold_offset[:-1].tolist(), self._fold_offset[1:].tolist()))
+
+    def iter_chunks(self, dtype=None):
+        """按原始顺序分块输出归一化后的数据"""
+        for begin, end in self._chunk_range():
+            yield begin, self.get_rows(np.arange(begin, end), dtype)
 
     def get_data(self):
-        return self._data
+        return np.concatenate([chunk for _, chunk in self.iter_chunks(float)], axis=0)
 
 
 class Autoencoder(nn.Module):
@@ -70,59 +155,182 @@ class Autoencoder(nn.Module):
         return self.encode(x.view(-1, self._input_num))
 
 
+class PatientEncoder(object):
+    """
+    训练好的Autoencoder与其归一化参数，用于新入院患者的增量编码，无需重新训练
+    输入为原始特征行（列顺序与DATA_PART拼接后一致），超出训练数据范围的值归一化后截断到[0, 1]
+    """
+    def __init__(self, model, min_value, scale, device='cpu'):
+        self.model = model.to(device)
+        self.min_value = np.asarray(min_value, dtype=float)
+        self.scale = np.asarray(scale, dtype=float)
+        self.device = device
+
+    @classmethod
+    def load(cls, path, device='cpu'):
+        checkpoint = torch.load(path, map_location=device)
+        model = Autoencoder(checkpoint['input_num'], checkpoint['hidden_num'])
+        model.load_state_dict(checkpoint['state_dict'])
+        return cls(model, checkpoint['min_value'].numpy(), checkpoint['scale'].numpy(), device)
+
+    def save(self, path):
+        torch.save({'state_dict': self.model.state_dict(), 'input_num': self.model.fc1.in_features,
+                    'hidden_num': self.model.fc1.out_features, 'min_value': torch.from_numpy(self.min_value),
+                    'scale': torch.from_numpy(self.scale)}, path)
+
+    def normalize(self, rows):
+        return np.clip((np.asarray(rows, dtype=float) - self.min_value) / self.scale, 0, 1)
+
+    def encode(self, rows, chunk_size=4096):
+        """:return: float32 [len(rows), hidden_num]"""
+        self.model.eval()
+        output = np.empty([len(rows), self.model.fc1.out_features], dtype=np.float32)
+        for begin in range(0, len(rows), chunk_size):
+            data = torch.from_numpy(self.normalize(rows[begin: begin + chunk_size])).float().to(self.device)
+            with torch.inference_mode():
+                output[begin: begin + len(data)] = self.model.output_representation(data).cpu().numpy()
+        return output
+
+    def fine_tune(self, rows, epochs=1, batch_size_=32, lr=1e-4):
+        """在新数据上热启动微调，归一化参数保持不变以保证表示空间一致，返回各epoch的平均损失"""
+        data = torch.from_numpy(self.normalize(rows)).float().to(self.device)
+        optimizer = optim.Adam(self.model.parameters(), lr=lr)
+        self.model.train()
+        epoch_loss = list()
+        for _ in range(epochs):
+            total_loss = 0
+            for index in torch.randperm(len(data)).split(batch_size_):
+                batch = data[index]
+                optimizer.zero_grad()
+                loss = func.binary_cross_entropy(self.model(batch), batch, reduction='sum')
+                loss.backward()
+                optimizer.step()
+                total_loss += loss.item()
+            epoch_loss.append(total_loss / len(data))
+        return epoch_loss
+
+
+def read_parts(file_folder_, suffix):
+    """读取{part}_{suffix}.npy并按DATA_PART的顺序拼接，例如新入院患者导出的feature_list_20260101.npy等"""
+    return np.concatenate([np.load(os.path.join(file_folder_, '{}_{}.npy'.format(part, suffix)))
+                           for part in DATA_PART], axis=1)
+
+
 input_num = 127
 hidden_num = 5
 log_interval = 1600
 batch_size = 32
 epoch_num = 30
 data_source = 'mimic'
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = Autoencoder(input_num, hidden_num).to(device)
-optimizer = optim.Adam(model.parameters(), lr=1e-3)
-file_folder = os.path.abspath('../../resource/preprocessed_data/{}_five_part_five_fold'.format(data_source))
-data_loader = DataLoader(file_folder, batch_size)
+CHECKPOINT_NAME = '{}_autoencoder.ckpt'
+# 注册表中产物的格式版本，2: 产物中包含CHECKPOINT_NAME，不含checkpoint的旧产物不会命中
+ARTIFACT_FORMAT = 2
 
 
 def main():
     """
     使用变分自编码器学习Patient Feature，注意保留患者顺序
+    模型与数据只在此处创建，import本模块不加载任何数据
     :return:
     """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--export_chunk_size', type=int, default=4096, help='patients encoded per chunk.')
+    parser.add_argument('--save_raw', action='store_true', help='also save normalized raw data (_pat_repre_raw_).')
+    parser.add_argument('--registry', type=str, default=None, help='artifact registry folder, reuse and store the representations there.')
+    parser.add_argument('--force', action='store_true',
+                        help='with --registry, retrain even if cached representations are valid.')
+    parser.add_argument('--new_data', type=str, default=None, help='encode {part}_{new_suffix}.npy in this folder.')
+    parser.add_argument('--new_suffix', type=str, default='new')
+    parser.add_argument('--checkpoint', type=str, default=None, help='default: saved with the representations.')
+    parser.add_argument('--fine_tune_epochs', type=int, default=0, help='warm-start fine-tuning on the new data.')
+    args = parser.parse_args()
+    if args.new_data is not None:
+        encode_new(args)
+        return
+
+    file_folder = os.path.abspath('../../resource/preprocessed_data/{}_five_part_five_fold'.format(data_source))
+    save_path = os.path.abspath('../../resource/representation/')
+    if args.registry is None:
+        # 未指定--registry时直接写出到固定路径，不在注册表中保留副本
+        if not os.path.exists(save_path):
+            os.makedirs(save_path)
+        train_and_export(args, file_folder, save_path)
+        return
+    registry = ArtifactRegistry(args.registry)
+    inputs = {'data': file_folder}
+    params = {'input_num': input_num, 'hidden_num': hidden_num, 'batch_size': batch_size, 'epoch_num': epoch_num,
+              'save_raw': args.save_raw, 'format': ARTIFACT_FORMAT}
+    artifact = None if args.force else registry.lookup(PATIENT_REPRESENTATION, inputs, params)
+    if artifact is not None:
+        print('reuse patient representation: {}'.format(artifact.folder))
+    else:
+        stage_folder = registry.stage(PATIENT_REPRESENTATION)
+        train_and_export(args, file_folder, stage_folder)
+        artifact = registry.commit(stage_folder, PATIENT_REPRESENTATION, inputs, params)
+    artifact.export(save_path, registry)
+
+
+def train_and_export(args, file_folder, folder):
+    """训练Autoencoder，并将患者表示与编码器checkpoint写入folder"""
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = Autoencoder(input_num, hidden_num).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=1e-3)
+    data_loader = DataLoader(file_folder, batch_size)
     for epoch in range(1, epoch_num + 1):
-        train(epoch)
-    rep = model.output_representation(torch.from_numpy(data_loader.get_data()).float().to(device))\
-        .cpu().data.numpy()
+        train(model, optimizer, data_loader, device, epoch)
+    export_representation(model, data_loader, folder, device, args.export_chunk_size, args.save_raw)
+    PatientEncoder(model, *data_loader.normalization(), device=device).save(
+        os.path.join(folder, CHECKPOINT_NAME.format(data_source)))
+
+
+def encode_new(args):
+    """对新入院患者只做编码（可选热启动微调），结果写入新数据所在的目录"""
     save_path = os.path.abspath('../../resource/representation/')
-    fold_save_size = len(rep) // 5
-    np.save(os.path.join(save_path, '{}_pat_representation_{}.npy'
-                         .format(data_source, 0)), rep[0: fold_save_size])
-    np.save(os.path.join(save_path, '{}_pat_representation_{}.npy'
-                         .format(data_source, 1)), rep[fold_save_size: fold_save_size*2])
-    np.save(os.path.join(save_path, '{}_pat_representation_{}.npy'
-                         .format(data_source, 2)), rep[fold_save_size*2: fold_save_size*3])
-    np.save(os.path.join(save_path, '{}_pat_representation_{}.npy'
-                         .format(data_source, 3)), rep[fold_save_size*3: fold_save_size*4])
-    np.save(os.path.join(save_path, '{}_pat_representation_{}.npy'
-                         .format(data_source, 4)), rep[fold_save_size*4:])
-
-    data = data_loader.get_data()
-    np.save(os.path.join(save_path, '{}_pat_repre_raw_{}.npy'
-                         .format(data_source, 0)), data[0: fold_save_size])
-    np.save(os.path.join(save_path, '{}_pat_repre_raw_{}.npy'
-                         .format(data_source, 1)), data[fold_save_size: fold_save_size*2])
-    np.save(os.path.join(save_path, '{}_pat_repre_raw_{}.npy'
-                         .format(data_source, 2)), data[fold_save_size*2: fold_save_size*3])
-    np.save(os.path.join(save_path, '{}_pat_repre_raw_{}.npy'
-                         .format(data_source, 3)), data[fold_save_size*3: fold_save_size*4])
-    np.save(os.path.join(save_path, '{}_pat_repre_raw_{}.npy'
-                         .format(data_source, 4)), data[fold_save_size*4:])
-
-
-def train(epoch_):
+    checkpoint = args.checkpoint if args.checkpoint is not None else \
+        os.path.join(save_path, CHECKPOINT_NAME.format(data_source))
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    encoder = PatientEncoder.load(checkpoint, device)
+    rows = read_parts(args.new_data, args.new_suffix)
+    if args.fine_tune_epochs > 0:
+        print('fine-tune loss: {}'.format(encoder.fine_tune(rows, args.fine_tune_epochs, batch_size)))
+        encoder.save(os.path.join(args.new_data, CHECKPOINT_NAME.format('{}_{}'.format(data_source, args.new_suffix))))
+    np.save(os.path.join(args.new_data, '{}_pat_representation_{}.npy'.format(data_source, args.new_suffix)),
+            encoder.encode(rows, args.export_chunk_size))
+
+
+def export_representation(model, data_loader, save_path, device, chunk_size=4096, save_raw=False):
+    """
+    按fold分块编码，结果直接写入预分配的memmap文件，峰值内存只与chunk_size有关
+    fold的边界与数据文件一致；save_raw为True时同时写出归一化后的原始数据（_pat_repre_raw_）
+    """
+    model.eval()
+    for fold, (fold_begin, fold_end) in enumerate(data_loader.fold_range()):
+        rep_out = np.lib.format.open_memmap(
+            os.path.join(save_path, '{}_pat_representation_{}.npy'.format(data_source, fold)), mode='w+',
+            dtype=np.float32, shape=(fold_end - fold_begin, model.fc1.out_features))
+        raw_out = None
+        if save_raw:
+            raw_out = np.lib.format.open_memmap(
+                os.path.join(save_path, '{}_pat_repre_raw_{}.npy'.format(data_source, fold)), mode='w+',
+                dtype=float, shape=(fold_end - fold_begin, model.fc1.in_features))
+        for begin in range(fold_begin, fold_end, chunk_size):
+            end = min(begin + chunk_size, fold_end)
+            data = data_loader.get_rows(np.arange(begin, end), dtype=float)
+            with torch.inference_mode():
+                rep = model.output_representation(torch.from_numpy(data).float().to(device))
+            rep_out[begin - fold_begin: end - fold_begin] = rep.cpu().numpy()
+            if raw_out is not None:
+                raw_out[begin - fold_begin: end - fold_begin] = data
+        rep_out.flush()
+        if raw_out is not None:
+            raw_out.flush()
+        del rep_out, raw_out
+
+
+def train(model, optimizer, data_loader, device, epoch_):
     model.train()
     train_loss = 0
-    batch_list = data_loader.get_batch_list()
-    for batch_idx, data in enumerate(batch_list):
+    for batch_idx, data in enumerate(data_loader):
         data = torch.from_numpy(data).float().to(device)
         optimizer.zero_grad()
         recon_batch = model(data)
@@ -133,7 +341,7 @@ def train(epoch_):
         if batch_idx % log_interval == 0:
             print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
                 epoch_, batch_idx * len(data), data_loader.length,
-                100. * batch_idx / len(batch_list),
+                100. * batch_idx / len(data_loader),
                 loss.item() / len(data)))
 
     print('====> Epoch: {} Average loss: {:.4f}'.format(